@@ -0,0 +1,466 @@
+import asyncio
+import datetime
+import itertools
+import logging
+import queue
+import threading
+
+from ibapi import comm
+from ibapi.client import EClient
+from ibapi.common import MAX_MSG_LEN, NO_VALID_ID
+from ibapi.errors import BAD_LENGTH, CONNECT_FAIL
+from ibapi.utils import BadMessage
+from ibapi.wrapper import EWrapper
+
+from RateLimiter import TokenBucket
+
+DEFAULT_TIMEOUT = 10
+FIRST_REQ_ID = 1000000
+## TWS codes 2100-2169 are notices (data farm status and the like), not request failures
+WARNING_CODES = range(2100, 2170)
+## marks the end of a subscription's stream
+_END = object()
+
+
+class IBError(Exception):
+
+    def __init__(self, reqId, errorCode, errorString):
+        Exception.__init__(self, "IB error id %d errorcode %d string %s" % (reqId, errorCode, errorString))
+        self.reqId = reqId
+        self.errorCode = errorCode
+        self.errorString = errorString
+
+
+class _LoopQueue(queue.Queue):
+    """
+    Stands in for EClient.msg_queue: the reader thread still puts the raw messages,
+    but the first message of a batch schedules one drain on the event loop and the
+    following ones just join the batch until it is drained
+    """
+
+    def __init__(self, loop, drain):
+        queue.Queue.__init__(self)
+        self._loop = loop
+        self._drain = drain
+        self.scheduled = False
+
+    def _put(self, item):
+        self.queue.append(item)
+        if not self.scheduled:
+            self.scheduled = True
+            self._loop.call_soon_threadsafe(self._drain)
+
+    def takeAll(self):
+        with self.mutex:
+            batch = list(self.queue)
+            self.queue.clear()
+            self.scheduled = False
+        return batch
+
+
+class _Pending(object):
+    ## one-shot request: callbacks accumulate until the end marker resolves the future
+
+    def __init__(self, future):
+        self.future = future
+        self.results = []
+
+    def push(self, item):
+        self.results.append(item)
+
+    def finish(self, exc=None):
+        if self.future.done():
+            return
+        if exc is not None:
+            self.future.set_exception(exc)
+        else:
+            self.future.set_result(self.results)
+
+
+class Subscription(object):
+    """
+    Async iterator over the callbacks of one streaming request
+    Each item is a (callback name, arguments without the reqId) tuple. If the
+    consumer falls maxsize items behind, the oldest are dropped (and counted).
+    Leaving an `async with` block or calling cancel() cancels the request.
+    """
+
+    def __init__(self, app, reqId, cancel, maxsize=0):
+        self.app = app
+        self.reqId = reqId
+        self._cancel = cancel
+        self._queue = asyncio.Queue(maxsize)
+        self._error = None
+        self.done = False
+        self.dropped = 0
+
+    def push(self, item):
+        if self.done:
+            return
+        if self._queue.full():
+            self._queue.get_nowait()
+            self.dropped += 1
+        self._queue.put_nowait(item)
+
+    def finish(self, exc=None):
+        if self.done:
+            return
+        self.done = True
+        self._error = exc
+        if self._queue.full():
+            self._queue.get_nowait()
+            self.dropped += 1
+        self._queue.put_nowait(_END)
+
+    def cancel(self):
+        if not self.done:
+            self.app._requests.pop(self.reqId, None)
+            if self.app.isConnected():
+                self._cancel(self.reqId)
+            self.finish()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        item = await self._queue.get()
+        if item is _END:
+            ## keep the marker so that iterating again also stops
+            self._queue.put_nowait(_END)
+            if self._error is not None:
+                raise self._error
+            raise StopAsyncIteration
+        return item
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.cancel()
+
+
+class AsyncApp(EWrapper, EClient):
+    """
+    asyncio front end over the EClient/EWrapper pair
+    No thread runs the message loop: messages are decoded and dispatched on the
+    event loop, so request methods simply await a future that the callbacks resolve,
+    and any number of requests can be in flight without a thread or a sleep per waiter.
+    Outgoing requests go through a token bucket to stay under the TWS message rate.
+    """
+
+    def __init__(self, maxMsgRate: float = 40.):
+        EWrapper.__init__(self)
+        EClient.__init__(self, wrapper=self)
+        self._reqIds = itertools.count(FIRST_REQ_ID)
+        self._requests = {}
+        self._timeWaiters = []
+        self._timeInFlight = False
+        self._bucket = TokenBucket(maxMsgRate)
+        self._loop = None
+        self._loopThread = None
+        self._connected = None
+        self.nextOrderId = None
+
+    ## connection
+    async def connect_async(self, host="127.0.0.1", port=7496, clientId=0, timeout=DEFAULT_TIMEOUT):
+        """
+        Connects and waits for nextValidId, i.e. until the API is ready for requests
+        """
+        self._loop = asyncio.get_running_loop()
+        self._loopThread = threading.get_ident()
+        ## has to be in place before connect() hands the queue to the reader thread
+        self.msg_queue = _LoopQueue(self._loop, self._drain)
+        self._connected = self._loop.create_future()
+        ## the handshake blocks on the socket, keep it off the loop
+        await self._loop.run_in_executor(None, self.connect, host, port, clientId)
+        if not self.isConnected():
+            raise ConnectionError("could not connect to %s:%d" % (host, port))
+        threading.Thread(target=self._watchReader, name="AsyncAppReaderWatch", daemon=True).start()
+        await asyncio.wait_for(asyncio.shield(self._connected), timeout)
+        return self
+
+    def _watchReader(self):
+        self.reader.join()
+        try:
+            self._loop.call_soon_threadsafe(self._readerDone)
+        except RuntimeError:
+            ## the loop was closed first
+            pass
+
+    def _readerDone(self):
+        self._drain()
+        self.disconnect()
+
+    def _drain(self):
+        for text in self.msg_queue.takeAll():
+            if len(text) > MAX_MSG_LEN:
+                self.error(NO_VALID_ID, BAD_LENGTH.code(), "%s:%d:%s" % (BAD_LENGTH.msg(), len(text), text))
+                self.disconnect()
+                return
+            try:
+                self.decoder.interpret(comm.read_fields(text))
+            except BadMessage:
+                logging.info("BadMessage")
+            except Exception:
+                ## one failing callback must not lose the rest of the batch
+                logging.exception("error handling message %s", text)
+
+    def _onLoop(self, func, *args):
+        ## connect() reports errors from the executor thread
+        if threading.get_ident() == self._loopThread:
+            func(*args)
+        else:
+            self._loop.call_soon_threadsafe(func, *args)
+
+    def next_req_id(self):
+        return next(self._reqIds)
+
+    async def _throttle(self):
+        if not self.isConnected():
+            raise ConnectionError("not connected to TWS")
+        while not self._bucket.tryAcquire():
+            await asyncio.sleep(self._bucket.delayFor())
+
+    async def _request(self, send, cancel=None, timeout=DEFAULT_TIMEOUT):
+        """
+        Sends a one-shot request and waits for the list of its callbacks
+        :param send: function of the reqId sending the request
+        :param cancel: function of the reqId cancelling it if we give up waiting
+        """
+        await self._throttle()
+        reqId = self.next_req_id()
+        pending = self._requests[reqId] = _Pending(self._loop.create_future())
+        send(reqId)
+        try:
+            return await asyncio.wait_for(pending.future, timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            self._requests.pop(reqId, None)
+            if cancel is not None and self.isConnected():
+                cancel(reqId)
+            raise
+
+    async def _subscribe(self, send, cancel, maxsize=0):
+        await self._throttle()
+        reqId = self.next_req_id()
+        subscription = self._requests[reqId] = Subscription(self, reqId, cancel, maxsize)
+        send(reqId)
+        return subscription
+
+    ## awaitable requests
+    async def current_time(self, timeout=DEFAULT_TIMEOUT):
+        """
+        :return: server time as unix time, as an int
+        """
+        if not self.isConnected():
+            raise ConnectionError("not connected to TWS")
+        future = self._loop.create_future()
+        self._timeWaiters.append(future)
+        ## currentTime carries no reqId: one request answers every waiter. It is sent
+        ## from its own task, so cancelling the caller that started it loses nothing
+        if not self._timeInFlight:
+            self._timeInFlight = True
+            self._loop.create_task(self._sendCurrentTime()).add_done_callback(self._currentTimeSent)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            ## the answer was lost, the next call asks again
+            self._timeInFlight = False
+            raise
+        finally:
+            if future in self._timeWaiters:
+                self._timeWaiters.remove(future)
+
+    async def _sendCurrentTime(self):
+        await self._throttle()
+        self.reqCurrentTime()
+
+    def _currentTimeSent(self, task):
+        exc = ConnectionError("reqCurrentTime not sent") if task.cancelled() else task.exception()
+        if exc is None:
+            return
+        self._timeInFlight = False
+        (waiters, self._timeWaiters) = (self._timeWaiters, [])
+        for future in waiters:
+            if not future.done():
+                future.set_exception(exc)
+
+    async def contract_details(self, contract, timeout=DEFAULT_TIMEOUT):
+        return await self._request(lambda reqId: self.reqContractDetails(reqId, contract),
+                                   timeout=timeout)
+
+    async def resolve(self, contract, timeout=DEFAULT_TIMEOUT):
+        """
+        From a partially formed contract, returns a fully fledged version
+        """
+        details = await self.contract_details(contract, timeout)
+        if not details:
+            raise LookupError("no contract matches %s" % contract)
+        if len(details) > 1:
+            logging.warning("%d contracts match %s, using the first one", len(details), contract)
+        return getattr(details[0], "contract", None) or details[0].summary
+
+    async def history(self, contract, endDateTime="", duration="1 Y", barSize="1 day",
+                      whatToShow="TRADES", useRTH=1, timeout=60):
+        """
+        :return: list of BarData up to endDateTime (now by default)
+        """
+        if endDateTime == "":
+            endDateTime = datetime.datetime.today().strftime("%Y%m%d %H:%M:%S")
+        return await self._request(
+            lambda reqId: self.reqHistoricalData(reqId, contract, endDateTime, duration, barSize,
+                                                 whatToShow, useRTH, 1, False, []),
+            cancel=self.cancelHistoricalData, timeout=timeout)
+
+    async def snapshot(self, contract, genericTickList="", regulatorySnapshot=False,
+                       timeout=DEFAULT_TIMEOUT):
+        """
+        :return: list of (callback name, arguments) ticks of one market data snapshot
+        """
+        return await self._request(
+            lambda reqId: self.reqMktData(reqId, contract, genericTickList, True,
+                                          regulatorySnapshot, []),
+            timeout=timeout)
+
+    ## streaming subscriptions
+    async def market_data(self, contract, genericTickList="", maxsize=0):
+        return await self._subscribe(
+            lambda reqId: self.reqMktData(reqId, contract, genericTickList, False, False, []),
+            self.cancelMktData, maxsize)
+
+    async def tick_by_tick(self, contract, tickType="Last", maxsize=0):
+        return await self._subscribe(
+            lambda reqId: self.reqTickByTickData(reqId, contract, tickType),
+            self.cancelTickByTickData, maxsize)
+
+    async def realtime_bars(self, contract, whatToShow="TRADES", useRTH=True, maxsize=0):
+        return await self._subscribe(
+            lambda reqId: self.reqRealTimeBars(reqId, contract, 5, whatToShow, useRTH, []),
+            self.cancelRealTimeBars, maxsize)
+
+    async def market_depth(self, contract, numRows=5, maxsize=0):
+        return await self._subscribe(
+            lambda reqId: self.reqMktDepth(reqId, contract, numRows, []),
+            self.cancelMktDepth, maxsize)
+
+    ## wrapper callbacks, all called on the event loop
+    def _push(self, reqId, name, *args):
+        request = self._requests.get(reqId)
+        if request is not None:
+            request.push((name, args))
+
+    def _finish(self, reqId, exc=None):
+        request = self._requests.pop(reqId, None)
+        if request is not None:
+            request.finish(exc)
+
+    def nextValidId(self, orderId):
+        self.nextOrderId = orderId
+        if self._connected is not None and not self._connected.done():
+            self._connected.set_result(orderId)
+
+    def error(self, reqId, errorCode, errorString):
+        self._onLoop(self._error, reqId, errorCode, errorString)
+
+    def _error(self, reqId, errorCode, errorString):
+        if errorCode in WARNING_CODES:
+            logging.info("IB notice %d %s", errorCode, errorString)
+        elif reqId in self._requests:
+            self._finish(reqId, IBError(reqId, errorCode, errorString))
+        else:
+            logging.warning("IB error id %d errorcode %d string %s", reqId, errorCode, errorString)
+            if (errorCode == CONNECT_FAIL.code() and self._connected is not None
+                    and not self._connected.done()):
+                self._connected.set_exception(IBError(reqId, errorCode, errorString))
+
+    def connectionClosed(self):
+        self._onLoop(self._closed)
+
+    def _closed(self):
+        exc = ConnectionError("connection to TWS closed")
+        (requests, self._requests) = (self._requests, {})
+        for request in requests.values():
+            request.finish(exc)
+        self._timeInFlight = False
+        (waiters, self._timeWaiters) = (self._timeWaiters, [])
+        for future in waiters:
+            if not future.done():
+                future.set_exception(exc)
+        if self._connected is not None and not self._connected.done():
+            self._connected.set_exception(exc)
+
+    def currentTime(self, time):
+        self._timeInFlight = False
+        (waiters, self._timeWaiters) = (self._timeWaiters, [])
+        for future in waiters:
+            if not future.done():
+                future.set_result(time)
+
+    def contractDetails(self, reqId, contractDetails):
+        if reqId in self._requests:
+            self._requests[reqId].push(contractDetails)
+
+    def contractDetailsEnd(self, reqId):
+        self._finish(reqId)
+
+    def historicalData(self, reqId, bar):
+        if reqId in self._requests:
+            self._requests[reqId].push(bar)
+
+    def historicalDataEnd(self, reqId, start, end):
+        self._finish(reqId)
+
+    def tickPrice(self, reqId, tickType, price, attrib):
+        self._push(reqId, "tickPrice", tickType, price, attrib)
+
+    def tickSize(self, reqId, tickType, size):
+        self._push(reqId, "tickSize", tickType, size)
+
+    def tickGeneric(self, reqId, tickType, value):
+        self._push(reqId, "tickGeneric", tickType, value)
+
+    def tickString(self, reqId, tickType, value):
+        self._push(reqId, "tickString", tickType, value)
+
+    def tickOptionComputation(self, reqId, tickType, *values):
+        self._push(reqId, "tickOptionComputation", tickType, *values)
+
+    def tickSnapshotEnd(self, reqId):
+        self._finish(reqId)
+
+    def tickByTickAllLast(self, reqId, *args):
+        self._push(reqId, "tickByTickAllLast", *args)
+
+    def tickByTickBidAsk(self, reqId, *args):
+        self._push(reqId, "tickByTickBidAsk", *args)
+
+    def tickByTickMidPoint(self, reqId, *args):
+        self._push(reqId, "tickByTickMidPoint", *args)
+
+    def realtimeBar(self, reqId, *args):
+        self._push(reqId, "realtimeBar", *args)
+
+    def updateMktDepth(self, reqId, *args):
+        self._push(reqId, "updateMktDepth", *args)
+
+    def updateMktDepthL2(self, reqId, *args):
+        self._push(reqId, "updateMktDepthL2", *args)
+
+
+async def _example():
+    from ContractSamples import ContractSamples
+    app = await AsyncApp().connect_async("127.0.0.1", 7496, 10)
+    print("Current time is ", await app.current_time())
+    contract = await app.resolve(ContractSamples.USStockAtSmart())
+    ## requests run concurrently, no thread or sleep per waiter
+    (bars, snapshot) = await asyncio.gather(app.history(contract, duration="1 M"),
+                                            app.snapshot(contract))
+    print(len(bars), "bars,", len(snapshot), "snapshot ticks")
+    async with await app.tick_by_tick(contract, "BidAsk") as ticks:
+        async for (name, args) in ticks:
+            print(name, args)
+            break
+    app.disconnect()
+
+
+if __name__ == '__main__':
+    asyncio.run(_example())
@@ -0,0 +1,289 @@
+import collections
+import logging
+import threading
+import time
+
+from RateLimiter import TokenBucket
+
+# outcomes of a basket order
+QUEUED = "QUEUED"
+SENT = "SENT"
+ACKED = "ACKED"
+REJECTED = "REJECTED"
+TIMED_OUT = "TIMED_OUT"
+# stopped by the pre-trade risk gate, never sent
+BLOCKED = "BLOCKED"
+RESOLVED = {ACKED, REJECTED, TIMED_OUT, BLOCKED}
+# errors rejecting or cancelling an order. Market data shares the reqId numbers
+# with the orderIds, so other codes are never taken for an order's: an order whose
+# rejection is not listed here times out instead
+ORDER_ERRORS = {103, 104, 105, 106, 107, 109, 110, 111, 113, 116, 117, 118, 119, 120, 121,
+                122, 123, 124, 125, 126, 129, 131, 132, 133, 134, 135, 136, 137, 140, 141,
+                144, 146, 147, 148, 151, 152, 153, 154, 155, 156, 158, 159, 160, 161, 163,
+                164, 201, 202, 203, 382, 383, 387, 388, 10147, 10148, 10149}
+
+
+def isOrderError(errorCode: int):
+    return errorCode in ORDER_ERRORS
+
+
+class BasketEntry(object):
+    __slots__ = ("orderId", "contract", "order", "outcome", "status", "sent", "acked",
+                 "errorCode", "errorString", "riskReasons")
+
+    def __init__(self, orderId: int, contract, order):
+        self.orderId = orderId
+        self.contract = contract
+        self.order = order
+        self.outcome = QUEUED
+        # first status reported by TWS
+        self.status = None
+        self.sent = 0.
+        self.acked = 0.
+        self.errorCode = 0
+        self.errorString = ""
+        # RiskGate REASONS bits
+        self.riskReasons = 0
+
+
+class Basket(object):
+    """
+    Orders submitted together; placed once every order has gone out (or been
+    blocked), done once every order is acknowledged, rejected or timed out
+    """
+
+    def __init__(self, entries, ackTimeout: float, callback=None):
+        self.entries = entries
+        self.ackTimeout = ackTimeout
+        self.callback = callback
+        self.nResolved = 0
+        self.nUnsent = 0
+        self.placed = threading.Event()
+        self.done = threading.Event()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def wait(self, timeout: float = None):
+        return self.done.wait(timeout)
+
+    def waitPlaced(self, timeout: float = None):
+        """
+        Waits until every order has been sent, not acknowledged: safe from the
+        message loop thread, before placing orders with higher ids directly
+        """
+        return self.placed.wait(timeout)
+
+    def outcomes(self):
+        """
+        :return: dict outcome -> number of orders
+        """
+        return collections.Counter(entry.outcome for entry in self.entries)
+
+    def ackLatencies(self):
+        return [entry.acked - entry.sent for entry in self.entries if entry.outcome == ACKED]
+
+
+class BasketOrderEngine(object):
+    """
+    Places baskets of thousands of orders as fast as the message rate allows
+    A basket's ids are reserved as one block and its orders queued in id order,
+    under one lock, so ids reach TWS increasing whatever the number of submitting
+    threads. A single sender thread drains the queue through a token bucket at
+    maxMsgRate, never above it. Every order then waits for its first openOrder or
+    orderStatus (acked), an order error (rejected) or ackTimeout (timed out).
+    Pass the application's shared TokenBucket as throttle when other requests go
+    out through the same connection. With a RiskGate, baskets are checked before
+    anything else: blocked orders get no id and never reach the throttle.
+    """
+
+    def __init__(self, client, orderIds, maxMsgRate: float = 40., throttle: TokenBucket = None,
+                 riskGate=None, placeOrder=None, clock=time.monotonic):
+        """
+        :param placeOrder: sends one order, client.placeOrder by default; pass one
+        that skips the checks when the client's placeOrder makes them itself
+        """
+        self.client = client
+        self._placeOrder = placeOrder if placeOrder is not None else client.placeOrder
+        self.orderIds = orderIds
+        self.riskGate = riskGate
+        # no burst: a full bucket would let through twice the rate in the first second
+        self.throttle = throttle if throttle is not None else TokenBucket(maxMsgRate, burst=1,
+                                                                          clock=clock)
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._queue = collections.deque()
+        # orderId -> (basket, entry) until the order is resolved
+        self._inFlight = {}
+        self._thread = None
+        self._running = False
+        self.nSent = 0
+
+    def submit(self, pairs, ackTimeout: float = 10., callback=None, link=None):
+        """
+        Queues (contract, order) pairs; their orderIds are set here
+        :param callback: called with the basket once every order is resolved
+        :param link: called with the first reserved id before the orders are queued
+        :return: the Basket
+        """
+        pairs = list(pairs)
+        if not pairs:
+            raise ValueError("empty basket")
+        reasons = self.riskGate.check(pairs) if self.riskGate is not None else None
+        blocked = reasons is not None and reasons.any()
+        with self._lock:
+            if blocked and link is not None:
+                # a group goes out whole or not at all
+                entries = [BasketEntry(0, contract, order) for (contract, order) in pairs]
+            else:
+                passed = [i for i in range(len(pairs)) if not blocked or not reasons[i]]
+                first = self.orderIds.reserve(len(passed)) if passed else 0
+                if link is not None:
+                    link(first)
+                entries = [BasketEntry(0, contract, order) for (contract, order) in pairs]
+                for (n, i) in enumerate(passed):
+                    entries[i].orderId = entries[i].order.orderId = first + n
+            basket = Basket(entries, ackTimeout, callback)
+            for (i, entry) in enumerate(entries):
+                if entry.orderId:
+                    self._inFlight[entry.orderId] = (basket, entry)
+                    self._queue.append((basket, entry))
+                    basket.nUnsent += 1
+                    continue
+                entry.outcome = BLOCKED
+                entry.riskReasons = int(reasons[i])
+                basket.nResolved += 1
+            if basket.nResolved:
+                logging.warning("%d basket orders blocked by the risk gate", basket.nResolved)
+            if not basket.nUnsent:
+                basket.placed.set()
+            self._ready.notify()
+        if basket.nResolved == len(basket):
+            basket.done.set()
+            self._finish([basket])
+            return basket
+        self._start()
+        return basket
+
+    def submitGroup(self, group, ackTimeout: float = 10., callback=None):
+        """
+        Queues an OrderGroup (bracket, OCA group, hedged order): its ids are reserved
+        and linked in one step, and its orders queued back to back, so they go out in
+        one paced run that nothing else is interleaved with
+        :return: the Basket, also kept as group.basket
+        """
+        group.basket = self.submit(group.pairs(), ackTimeout, callback, link=group.link)
+        return group.basket
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._send, name="BasketOrderEngine", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            self._running = False
+            self._ready.notify()
+            # nothing more goes out: release the waitPlaced callers
+            for (basket, entry) in self._queue:
+                basket.placed.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _send(self):
+        while True:
+            done = []
+            with self._lock:
+                while self._running and not self._queue and not done:
+                    # wake up now and then to time out unacknowledged orders
+                    if not self._ready.wait(0.5):
+                        done = self._expire()
+                if not self._running:
+                    return
+                queued = self._queue.popleft() if self._queue else None
+            self._finish(done)
+            if queued is None:
+                continue
+            (basket, entry) = queued
+            self.throttle.acquire()
+            entry.sent = self._clock()
+            entry.outcome = SENT
+            self._placeOrder(entry.orderId, entry.contract, entry.order)
+            basket.nUnsent -= 1
+            if not basket.nUnsent:
+                basket.placed.set()
+            self.nSent += 1
+            if self.nSent % 256 == 0:
+                self.poll()
+
+    def _resolve(self, basket, entry, outcome: str):
+        # called with the lock held; returns the basket if it just completed
+        del self._inFlight[entry.orderId]
+        entry.outcome = outcome
+        basket.nResolved += 1
+        if basket.nResolved == len(basket):
+            basket.done.set()
+            return basket
+        return None
+
+    def _finish(self, done):
+        # basket callbacks run off the lock
+        for basket in done:
+            if basket is not None and basket.callback is not None:
+                try:
+                    basket.callback(basket)
+                except Exception:
+                    logging.exception("basket callback failed")
+
+    def _expire(self):
+        now = self._clock()
+        expired = [(basket, entry) for (basket, entry) in self._inFlight.values()
+                   if entry.outcome == SENT and now - entry.sent > basket.ackTimeout]
+        if expired:
+            logging.warning("%d basket orders not acknowledged in time", len(expired))
+        return [self._resolve(basket, entry, TIMED_OUT) for (basket, entry) in expired]
+
+    def poll(self):
+        """
+        Times out the orders sent longer than their basket's ackTimeout ago
+        """
+        with self._lock:
+            done = self._expire()
+        self._finish(done)
+
+    def pending(self):
+        with self._lock:
+            return len(self._queue)
+
+    ## callbacks
+    def _ack(self, orderId, status):
+        with self._lock:
+            found = self._inFlight.get(orderId)
+            if found is None:
+                return
+            (basket, entry) = found
+            (entry.status, entry.acked) = (status, self._clock())
+            done = self._resolve(basket, entry, ACKED)
+        self._finish([done])
+
+    def openOrder(self, orderId: int, contract, order, orderState):
+        self._ack(orderId, orderState.status)
+
+    def orderStatus(self, orderId: int, status: str, *args):
+        self._ack(orderId, status)
+
+    def error(self, reqId: int, errorCode: int, errorString: str):
+        if not isOrderError(errorCode):
+            return
+        with self._lock:
+            found = self._inFlight.get(reqId)
+            if found is None:
+                return
+            (basket, entry) = found
+            (entry.errorCode, entry.errorString) = (errorCode, errorString)
+            done = self._resolve(basket, entry, REJECTED)
+        self._finish([done])
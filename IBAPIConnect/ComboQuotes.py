@@ -0,0 +1,224 @@
+import threading
+import time
+
+import numpy as np
+
+from ibapi.contract import Contract
+
+from QuoteStore import FIELD_INDEX, TICK_TO_FIELD
+
+BID = FIELD_INDEX["BID"]
+ASK = FIELD_INDEX["ASK"]
+BID_SIZE = FIELD_INDEX["BID_SIZE"]
+ASK_SIZE = FIELD_INDEX["ASK_SIZE"]
+QUOTE_FIELDS = {BID, ASK, BID_SIZE, ASK_SIZE}
+# neutral bid, ask, bid size and ask size terms of the legs a combo does not have
+PADDING = (0., 0., np.inf, np.inf)
+
+
+class SyntheticComboEngine(object):
+    """
+    Synthetic bid/ask/mid of BAG contracts computed from their legs' L1 quotes
+    Every leg is subscribed once however many combos share it. The combos are kept
+    as a sparse leg-to-combo incidence matrix of signed ratios (BUY +ratio, SELL
+    -ratio), stored combo-major with a leg-major index, so a leg tick recomputes
+    only the combos containing that leg:
+        bid = sum(w > 0: w * legBid) + sum(w < 0: w * legAsk)
+        ask = sum(w > 0: w * legAsk) + sum(w < 0: w * legBid)
+    Sizes are how many combos the legs' displayed sizes fill. Prices are ratio
+    weighted leg prices, as IB quotes spreads, without price multipliers.
+    """
+
+    def __init__(self, quoteStore, client=None, firstReqId: int = 700000, clock=time.time):
+        self.quoteStore = quoteStore
+        self.client = client
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._nextReqId = firstReqId
+        self.combo2idx = {}
+        self.comboKeys = []
+        # legs, by conId
+        self.leg2row = {}
+        self.legContracts = []
+        self.legSlots = np.zeros(0, dtype=np.int64)
+        self.slot2row = {}
+        self.reqId2row = {}
+        self.row2reqId = {}
+        self.subscribed = False
+        # incidence entries, appended combo by combo
+        self._entryCombo = []
+        self._entryLeg = []
+        self._entryWeight = []
+        self._comboStart = np.zeros(1, dtype=np.int64)
+        self._legPtr = np.zeros(1, dtype=np.int64)
+        self._legOrder = np.zeros(0, dtype=np.int64)
+        self._legCache = {}
+
+        self.bid = np.zeros(0)
+        self.ask = np.zeros(0)
+        self.bidSize = np.zeros(0)
+        self.askSize = np.zeros(0)
+        self.updated = np.zeros(0)
+        self.nRecomputed = 0
+
+    @property
+    def mid(self):
+        return 0.5 * (self.bid + self.ask)
+
+    def _legRow(self, comboLeg):
+        row = self.leg2row.get(comboLeg.conId)
+        if row is None:
+            row = self.leg2row[comboLeg.conId] = len(self.legContracts)
+            contract = Contract()
+            contract.conId = comboLeg.conId
+            contract.exchange = comboLeg.exchange
+            self.legContracts.append(contract)
+            slot = self.quoteStore.addInstrument(comboLeg.conId)
+            self.legSlots = np.append(self.legSlots, slot)
+            self.slot2row[slot] = row
+            if self.subscribed:
+                self._subscribe(row)
+        return row
+
+    def addCombo(self, key, contract: Contract):
+        """
+        Adds a BAG contract; its legs are subscribed if the engine is started
+        :return: the combo index
+        """
+        if contract.secType != "BAG" or not contract.comboLegs:
+            raise ValueError("%r is not a combo contract" % (key,))
+        with self._lock:
+            idx = self.combo2idx.get(key)
+            if idx is not None:
+                return idx
+            idx = self.combo2idx[key] = len(self.comboKeys)
+            self.comboKeys.append(key)
+            for leg in contract.comboLegs:
+                self._entryCombo.append(idx)
+                self._entryLeg.append(self._legRow(leg))
+                self._entryWeight.append(leg.ratio if leg.action == "BUY" else -leg.ratio)
+            for name in ("bid", "ask", "bidSize", "askSize"):
+                setattr(self, name, np.append(getattr(self, name), np.nan))
+            self.updated = np.append(self.updated, 0.)
+            self._build()
+            self._recompute(*self._gather(np.array([idx])))
+        return idx
+
+    def _build(self):
+        combo = np.array(self._entryCombo, dtype=np.int64)
+        leg = np.array(self._entryLeg, dtype=np.int64)
+        self._legOf = leg
+        self._weight = np.array(self._entryWeight, dtype=float)
+        self._buy = self._weight > 0
+        self._absWeight = np.abs(self._weight)
+        self._comboStart = np.searchsorted(combo, np.arange(len(self.comboKeys) + 1))
+        # leg-major view of the same entries: the combos of leg r are
+        # combo[_legOrder[_legPtr[r]:_legPtr[r + 1]]]
+        self._legOrder = np.argsort(leg, kind="stable")
+        self._legPtr = np.searchsorted(leg[self._legOrder], np.arange(len(self.legContracts) + 1))
+        self._entryComboArr = combo
+        self._legCache = {}
+
+    def combosOfLeg(self, row: int):
+        return np.unique(self._entryComboArr[self._legOrder[self._legPtr[row]:self._legPtr[row + 1]]])
+
+    def _gather(self, combos):
+        """
+        Precomputes the recomputation of combos as two flat gathers: the leg quote
+        each term reads (the bid of a bought leg is the combo's bid side, of a sold
+        leg its ask side), and the (leg, term, combo) layout of the terms, padded
+        to the longest combo with a neutral term
+        """
+        starts = self._comboStart[combos]
+        lengths = self._comboStart[combos + 1] - starts
+        offsets = np.cumsum(lengths) - lengths
+        entries = np.arange(lengths.sum()) - np.repeat(offsets, lengths) + np.repeat(starts, lengths)
+        m = len(entries)
+        buy = self._buy[entries]
+        w = self._weight[entries]
+        fields = np.where(buy, [[BID], [ASK], [BID_SIZE], [ASK_SIZE]], [[ASK], [BID], [ASK_SIZE], [BID_SIZE]])
+        quoteIdx = self.legSlots[self._legOf[entries]] * self.quoteStore.values.shape[1] + fields
+        scale = np.stack([w, w, 1. / np.abs(w), 1. / np.abs(w)])
+        column = np.arange(lengths.max())[:, None]
+        padded = np.where(column < lengths, offsets + column, m)
+        termIdx = padded[:, None, :] + (m + 1) * np.arange(4)[:, None]
+        return combos, quoteIdx, scale, termIdx
+
+    def _recompute(self, combos, quoteIdx, scale, termIdx):
+        # combos have a handful of legs: a padded layout summed and minimized over its
+        # leg axis costs far less than reduceat (minimum.reduceat especially)
+        m = quoteIdx.shape[1]
+        terms = np.empty((4, m + 1))
+        np.multiply(self.quoteStore.values.take(quoteIdx), scale, out=terms[:, :m])
+        terms[:, m] = PADDING
+        byLeg = terms.take(termIdx)
+        (self.bid[combos], self.ask[combos]) = byLeg[:, :2].sum(axis=0)
+        (self.bidSize[combos], self.askSize[combos]) = byLeg[:, 2:].min(axis=0)
+        self.updated[combos] = self._clock()
+        self.nRecomputed += len(combos)
+
+    def legUpdated(self, row: int):
+        """
+        Recomputes the combos containing one leg
+        """
+        with self._lock:
+            layout = self._legCache.get(row)
+            if layout is None:
+                layout = self._legCache[row] = self._gather(self.combosOfLeg(row))
+            self._recompute(*layout)
+
+    def recomputeAll(self):
+        with self._lock:
+            combos = np.arange(len(self.comboKeys))
+            if len(combos):
+                self._recompute(*self._gather(combos))
+
+    def quote(self, key):
+        """
+        :return: dict of the synthetic BID, ASK, MID, BID_SIZE, ASK_SIZE and UPDATED time
+        """
+        idx = self.combo2idx[key]
+        return {"BID": self.bid[idx], "ASK": self.ask[idx], "MID": 0.5 * (self.bid[idx] + self.ask[idx]),
+                "BID_SIZE": self.bidSize[idx], "ASK_SIZE": self.askSize[idx], "UPDATED": self.updated[idx]}
+
+    ## leg subscriptions
+    def _subscribe(self, row: int):
+        reqId = self._nextReqId
+        self._nextReqId += 1
+        self.reqId2row[reqId] = row
+        self.row2reqId[row] = reqId
+        self.quoteStore.bindReqId(reqId, self.legContracts[row].conId)
+        self.client.reqMktData(reqId, self.legContracts[row], "", False, False, [])
+
+    def start(self):
+        """
+        Streams every leg once
+        """
+        with self._lock:
+            self.subscribed = True
+            for row in range(len(self.legContracts)):
+                if row not in self.row2reqId:
+                    self._subscribe(row)
+
+    def stop(self):
+        with self._lock:
+            self.subscribed = False
+            for (row, reqId) in list(self.row2reqId.items()):
+                self.client.cancelMktData(reqId)
+                self.quoteStore.unbindReqId(reqId)
+                del self.reqId2row[reqId]
+                del self.row2reqId[row]
+
+    ## callbacks, called after the QuoteStore is updated
+    def tickPrice(self, reqId: int, tickType: int, price: float, attrib=None):
+        self._tick(reqId, tickType)
+
+    def tickSize(self, reqId: int, tickType: int, size: int):
+        self._tick(reqId, tickType)
+
+    def _tick(self, reqId, tickType):
+        if TICK_TO_FIELD.get(tickType) not in QUOTE_FIELDS:
+            return
+        row = self.slot2row.get(self.quoteStore.reqId2slot.get(reqId, -1))
+        if row is not None:
+            self.legUpdated(row)
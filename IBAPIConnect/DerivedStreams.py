@@ -0,0 +1,326 @@
+import math
+import time
+
+import numpy as np
+
+from QuoteStore import FIELD_INDEX, TICK_TO_FIELD
+from TickRingBuffer import TickRingBuffer, FLAG_TICK_BY_TICK, FLAG_RT_VOLUME, FLAG_QUOTE_CONTINUES
+
+# derived values are published as (time, value) records
+VALUE_DTYPE = np.dtype([("time", "<i8"), ("value", "<f8")])
+BID = FIELD_INDEX["BID"]
+ASK = FIELD_INDEX["ASK"]
+LAST = FIELD_INDEX["LAST"]
+SIZE_TO_SIDE = {FIELD_INDEX["BID_SIZE"]: BID, FIELD_INDEX["ASK_SIZE"]: ASK}
+# which trade records a trade-based stream counts; counting both sources for the
+# same instrument would count every trade twice
+SOURCES = {"tickByTick": FLAG_TICK_BY_TICK, "rtVolume": FLAG_RT_VOLUME,
+           "any": FLAG_TICK_BY_TICK | FLAG_RT_VOLUME}
+TRADE_FLAGS = SOURCES["any"]
+
+
+class SlotState(object):
+    """
+    Latest quote and trade of one instrument, kept once and read by all its streams
+    """
+
+    def __init__(self, slot):
+        self.slot = slot
+        self.bid = self.ask = math.nan
+        self.bidSize = self.askSize = math.nan
+        self.lastPrice = math.nan
+        self.streams = []
+
+
+class DerivedStream(object):
+    """
+    Base of the incremental operators: each update costs O(1) and every new value
+    is appended to the output ring, which any number of consumers read with their
+    own cursor
+    """
+    name = None
+    # trade-based streams are also keyed by their trade source
+    tradeBased = False
+
+    def __init__(self, state: SlotState, capacity: int = 4096):
+        self.state = state
+        self.output = TickRingBuffer(capacity, dtype=VALUE_DTYPE)
+        self.value = math.nan
+        self.time = 0
+        self.refCount = 0
+
+    def _emit(self, timeNs, value):
+        # NaN never equals itself: a stream without a value would push on every tick
+        if value != self.value and not (value != value and self.value != self.value):
+            self.value = value
+            self.time = timeNs
+            self.output.push((timeNs, value))
+
+    def onQuote(self, timeNs):
+        pass
+
+    def onTrade(self, timeNs, price, size, flags):
+        pass
+
+    def reset(self):
+        self.value = math.nan
+
+    def read(self, since: int):
+        """
+        :return: (records, next sequence, records lost to overrun), see TickRingBuffer.read
+        """
+        return self.output.read(since)
+
+    def column(self, n: int = None):
+        """
+        Latest n values (all those still in the ring by default), oldest first
+        """
+        return self.output.latest(n or self.output.capacity)["value"]
+
+
+class Spread(DerivedStream):
+    name = "SPREAD"
+
+    def onQuote(self, timeNs):
+        s = self.state
+        self._emit(timeNs, s.ask - s.bid)
+
+
+class Microprice(DerivedStream):
+    """
+    Size-weighted mid: leans towards the side with less size, i.e. the side
+    more likely to be taken out
+    """
+    name = "MICROPRICE"
+
+    def onQuote(self, timeNs):
+        s = self.state
+        depth = s.bidSize + s.askSize
+        if depth > 0:
+            self._emit(timeNs, (s.bid * s.askSize + s.ask * s.bidSize) / depth)
+        else:
+            self._emit(timeNs, 0.5 * (s.bid + s.ask))
+
+
+class Vwap(DerivedStream):
+    """
+    Session VWAP of the trades of one source; reset() starts a new session
+    """
+    name = "VWAP"
+    tradeBased = True
+
+    def __init__(self, state: SlotState, capacity: int = 4096, source: str = "tickByTick"):
+        DerivedStream.__init__(self, state, capacity)
+        self.flags = SOURCES[source]
+        self.notional = 0.
+        self.volume = 0.
+
+    def onTrade(self, timeNs, price, size, flags):
+        if flags & self.flags and size > 0:
+            self.notional += price * size
+            self.volume += size
+            self._emit(timeNs, self.notional / self.volume)
+
+    def reset(self):
+        DerivedStream.reset(self)
+        self.notional = self.volume = 0.
+
+
+class SignedVolume(DerivedStream):
+    """
+    Cumulative buy minus sell volume. Trades are signed against the prevailing
+    quote (at or above the mid is a buy, below a sell); at the mid, or without
+    a quote, the tick rule against the previous trade decides
+    """
+    name = "SIGNED_VOLUME"
+    tradeBased = True
+
+    def __init__(self, state: SlotState, capacity: int = 4096, source: str = "tickByTick"):
+        DerivedStream.__init__(self, state, capacity)
+        self.flags = SOURCES[source]
+        self.buyVolume = 0.
+        self.sellVolume = 0.
+        self.nTrades = 0
+        self._lastSign = 0
+
+    def onTrade(self, timeNs, price, size, flags):
+        if not (flags & self.flags and size > 0):
+            return
+        s = self.state
+        mid = 0.5 * (s.bid + s.ask)
+        if price > mid:
+            sign = 1
+        elif price < mid:
+            sign = -1
+        elif price > s.lastPrice:
+            sign = 1
+        elif price < s.lastPrice:
+            sign = -1
+        else:
+            # unchanged price (or nothing to compare with, NaN): keep the previous side
+            sign = self._lastSign
+        self._lastSign = sign
+        if sign > 0:
+            self.buyVolume += size
+        elif sign < 0:
+            self.sellVolume += size
+        self.nTrades += 1
+        self._emit(timeNs, self.buyVolume - self.sellVolume)
+
+    @property
+    def imbalance(self):
+        total = self.buyVolume + self.sellVolume
+        return (self.buyVolume - self.sellVolume) / total if total else math.nan
+
+    def reset(self):
+        DerivedStream.reset(self)
+        self.buyVolume = self.sellVolume = 0.
+        self.nTrades = self._lastSign = 0
+
+
+STREAM_TYPES = {cls.name: cls for cls in (Spread, Microprice, Vwap, SignedVolume)}
+
+
+class DerivedStreamEngine(object):
+    """
+    Computes derived streams from a tick ring
+    Streams are shared: asking twice for the same (name, slot, source) returns the
+    same operator, so N consumers of a VWAP cost one computation. The engine either
+    reads a ring written elsewhere (e.g. SharedMarketDataReader.ring) with poll(), or
+    owns one fed through its EWrapper-signature callbacks, which poll as they go.
+    """
+
+    def __init__(self, ring: TickRingBuffer = None, quoteStore=None, autoPoll: bool = None,
+                 clock=time.time_ns):
+        self.ownsRing = ring is None
+        self.ring = TickRingBuffer() if ring is None else ring
+        self.quoteStore = quoteStore
+        self.autoPoll = self.ownsRing if autoPoll is None else autoPoll
+        self._clock = clock
+        self.states = {}
+        self.streams = {}
+        self.nextSeq = self.ring.writeSeq
+        self.nLost = 0
+
+    def _slotOf(self, instrument):
+        if isinstance(instrument, (int, np.integer)):
+            return int(instrument)
+        slot = self.quoteStore.slotOf(instrument) if self.quoteStore is not None else -1
+        if slot < 0:
+            raise KeyError("unknown instrument %r" % (instrument,))
+        return slot
+
+    def stream(self, name: str, instrument, source: str = "tickByTick", capacity: int = 4096):
+        """
+        Returns the shared stream, creating it on first use
+        :param instrument: QuoteStore slot or key
+        :param source: trade source of VWAP and SIGNED_VOLUME: tickByTick, rtVolume or any
+        """
+        slot = self._slotOf(instrument)
+        cls = STREAM_TYPES[name]
+        key = (name, slot, source if cls.tradeBased else None)
+        stream = self.streams.get(key)
+        if stream is None:
+            state = self.states.get(slot)
+            if state is None:
+                state = self.states[slot] = SlotState(slot)
+            if cls.tradeBased:
+                stream = cls(state, capacity, source)
+            else:
+                stream = cls(state, capacity)
+            self.streams[key] = stream
+            state.streams.append(stream)
+        stream.refCount += 1
+        return stream
+
+    def release(self, stream: DerivedStream):
+        """
+        Drops one consumer of a stream; the last one stops its computation
+        """
+        stream.refCount -= 1
+        if stream.refCount > 0:
+            return
+        stream.state.streams.remove(stream)
+        self.streams = {key: s for (key, s) in self.streams.items() if s is not stream}
+
+    def resetSession(self):
+        for stream in self.streams.values():
+            stream.reset()
+
+    def poll(self):
+        """
+        Applies the ring records written since the last poll
+        :return: number of records processed
+        """
+        (records, self.nextSeq, lost) = self.ring.read(self.nextSeq)
+        self.nLost += lost
+        states = self.states
+        for (timeNs, slot, field, flags, price, size) in records.tolist():
+            state = states.get(slot)
+            if state is not None:
+                self._apply(state, timeNs, field, flags, price, size)
+        return len(records)
+
+    def _apply(self, state, timeNs, field, flags, price, size):
+        if field == BID or field == ASK:
+            if field == BID:
+                if price == price:
+                    state.bid = price
+                if size == size:
+                    state.bidSize = size
+            else:
+                if price == price:
+                    state.ask = price
+                if size == size:
+                    state.askSize = size
+            if flags & FLAG_QUOTE_CONTINUES:
+                # half of a bid/ask pair: the quote is evaluated on the other half
+                return
+            for stream in state.streams:
+                stream.onQuote(timeNs)
+        elif field == LAST and flags & TRADE_FLAGS:
+            # L1 LAST/LAST_SIZE ticks do not delimit trades, only flagged sources count
+            for stream in state.streams:
+                stream.onTrade(timeNs, price, size, flags)
+            state.lastPrice = price
+
+    ## callbacks, for an engine owning its ring
+    def _append(self, reqId, field, price, size, flags):
+        slot = self.quoteStore.reqId2slot.get(reqId, -1)
+        state = self.states.get(slot)
+        if state is None:
+            return
+        timeNs = self._clock()
+        self.ring.append(timeNs, slot, field, price, size, flags)
+        if not self.autoPoll:
+            return
+        if self.nextSeq == self.ring.writeSeq - 1:
+            # caught up: apply the record we just wrote without reading it back
+            self.nextSeq += 1
+            self._apply(state, timeNs, field, flags, price, size)
+        else:
+            self.poll()
+
+    def tickPrice(self, reqId: int, tickType: int, price: float, attrib=None):
+        field = TICK_TO_FIELD.get(tickType)
+        if field == BID or field == ASK:
+            self._append(reqId, field, np.nan if price == -1 else price, np.nan, 0)
+
+    def tickSize(self, reqId: int, tickType: int, size: int):
+        side = SIZE_TO_SIDE.get(TICK_TO_FIELD.get(tickType))
+        if side is not None:
+            self._append(reqId, side, np.nan, size, 0)
+
+    def tickByTickAllLast(self, reqId: int, tickType: int, time: int, price: float, size: int, *args):
+        self._append(reqId, LAST, price, size, FLAG_TICK_BY_TICK)
+
+    def tickByTickBidAsk(self, reqId: int, time: int, bidPrice: float, askPrice: float,
+                         bidSize: int, askSize: int, *args):
+        self._append(reqId, BID, bidPrice, bidSize, FLAG_TICK_BY_TICK | FLAG_QUOTE_CONTINUES)
+        self._append(reqId, ASK, askPrice, askSize, FLAG_TICK_BY_TICK)
+
+    def rtVolume(self, reqId: int, price: float, size: float):
+        """
+        One RTVolume (generic tick 233) trade
+        """
+        self._append(reqId, LAST, price, size, FLAG_RT_VOLUME)
@@ -0,0 +1,660 @@
+import collections
+import copy
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from ibapi.commission_report import CommissionReport
+from ibapi.common import UNSET_DOUBLE
+from ibapi.execution import Execution
+from ibapi.order_state import OrderState
+from ibapi.ticktype import TickTypeEnum
+
+from RiskGate import instrumentKey
+
+# how an order works, whatever its orderType
+MARKET = "MARKET"
+LIMIT = "LIMIT"
+STOP = "STOP"
+STOP_LIMIT = "STOP_LIMIT"
+TOUCHED = "TOUCHED"
+TOUCHED_LIMIT = "TOUCHED_LIMIT"
+TRAIL = "TRAIL"
+TRAIL_LIMIT = "TRAIL_LIMIT"
+CLOSE = "CLOSE"
+CLOSE_LIMIT = "CLOSE_LIMIT"
+ORDER_TYPES = {"MKT": MARKET, "LMT": LIMIT, "STP": STOP, "STP LMT": STOP_LIMIT,
+               "MIT": TOUCHED, "LIT": TOUCHED_LIMIT, "TRAIL": TRAIL, "TRAIL LIMIT": TRAIL_LIMIT,
+               "MOC": CLOSE, "LOC": CLOSE_LIMIT,
+               # protected and market-to-limit orders fill like market orders here
+               "MKT PRT": MARKET, "MTL": MARKET, "BOX TOP": MARKET, "STP PRT": STOP}
+# what a triggered order becomes
+TRIGGERED = {STOP: MARKET, STOP_LIMIT: LIMIT, TOUCHED: MARKET, TOUCHED_LIMIT: LIMIT,
+             TRAIL: MARKET, TRAIL_LIMIT: LIMIT}
+
+BID_TICKS = {TickTypeEnum.BID, TickTypeEnum.DELAYED_BID}
+ASK_TICKS = {TickTypeEnum.ASK, TickTypeEnum.DELAYED_ASK}
+LAST_TICKS = {TickTypeEnum.LAST, TickTypeEnum.DELAYED_LAST}
+BID_SIZE_TICKS = {TickTypeEnum.BID_SIZE, TickTypeEnum.DELAYED_BID_SIZE}
+ASK_SIZE_TICKS = {TickTypeEnum.ASK_SIZE, TickTypeEnum.DELAYED_ASK_SIZE}
+
+SIDES = {"BUY": "BOT", "SELL": "SLD"}
+
+# TWS error codes
+DUPLICATE_ORDER_ID = 103
+CANNOT_MODIFY_FILLED = 104
+ORDER_REJECTED = 201
+ORDER_CANCELLED = 202
+CANCEL_NOT_FOUND = 10147
+
+
+def _isSet(value):
+    return value != UNSET_DOUBLE and value is not None
+
+
+class SimOrder(object):
+    __slots__ = ("orderId", "contract", "order", "key", "buy", "kind", "status", "filled",
+                 "remaining", "avgPrice", "lastPrice", "permId", "seq", "parent", "children",
+                 "trailStop")
+
+    def __init__(self, orderId: int, contract, order, key, permId: int):
+        self.orderId = orderId
+        self.contract = contract
+        self.order = order
+        self.key = key
+        self.buy = order.action == "BUY"
+        self.kind = None
+        self.status = None
+        self.filled = 0.
+        self.remaining = float(order.totalQuantity)
+        self.avgPrice = 0.
+        self.lastPrice = 0.
+        self.permId = permId
+        # bumped whenever the order leaves the book, making its heap entries stale
+        self.seq = 0
+        self.parent = None
+        self.children = []
+        self.trailStop = None
+
+    @property
+    def working(self):
+        return self.status in ("PreSubmitted", "Submitted")
+
+
+class SimInstrument(object):
+    """
+    The quote of one instrument and the orders resting on it
+    Resting orders are in four heaps, buy orders checked against the ask and sell
+    orders against the bid: "below" heaps hold orders working when the price is at
+    or below their level (buy limits, buy MIT, sell stops), "above" heaps those
+    working at or above it (sell limits, sell MIT, buy stops).
+    """
+
+    def __init__(self):
+        self.bid = self.ask = self.last = float("nan")
+        self.bidSize = self.askSize = 0.
+        # (sort key, sequence, order): below heaps are keyed on -level
+        self.buyBelow = []
+        self.buyAbove = []
+        self.sellBelow = []
+        self.sellAbove = []
+        self.markets = []
+        self.trailing = []
+        self.closing = []
+
+
+class ExchangeSimulator(object):
+    """
+    Local matching simulator standing in for EClient on the order path
+    placeOrder, cancelOrder, reqGlobalCancel, reqIds, reqOpenOrders, reqExecutions and
+    reqPositions are answered through the wrapper with the callbacks TWS would make
+    (openOrder, orderStatus, execDetails, commissionReport, error...), synchronously
+    from the calling thread. Orders match against quotes set with setQuote, or fed
+    through tickPrice/tickSize/tickByTickBidAsk, so a TickJournalReplayer can drive
+    it from a recorded session. Buy orders trade at the ask and sell orders at the
+    bid, limits with price improvement; stops and touched orders trigger on the
+    same side of the quote; MOC and LOC orders wait for auction(). Orders held with
+    transmit False are released by the next transmitted order of their group;
+    children wait for their parent to fill and cancel their siblings when they
+    fill; OCA groups cancel (type 1) or reduce (types 2 and 3) their other members.
+    Order types without a model trade as limit orders at their lmtPrice if they have
+    one and as market orders otherwise.
+    """
+
+    def __init__(self, wrapper, account: str = "DU0000000", firstOrderId: int = 1,
+                 commissionPerShare: float = 0.005, minCommission: float = 1.,
+                 maxCommissionPct: float = 0.01, useSizes: bool = False, clock=time.time):
+        """
+        :param useSizes: fill no more than the displayed size of each quote
+        """
+        self.wrapper = wrapper
+        self.account = account
+        self.commissionPerShare = commissionPerShare
+        self.minCommission = minCommission
+        self.maxCommissionPct = maxCommissionPct
+        self.useSizes = useSizes
+        self._clock = clock
+        self._lock = threading.RLock()
+        self.clientId = 0
+        self.connected = False
+        self.nextId = firstOrderId
+        self._permIds = itertools.count(1000000)
+        self._execIds = itertools.count(1)
+        self._seq = itertools.count()
+        self.instruments = collections.defaultdict(SimInstrument)
+        self.orders = {}
+        self.held = {}
+        self.ocaGroups = collections.defaultdict(list)
+        self.reqId2key = {}
+        # (Contract, Execution, CommissionReport) of the session
+        self.executions = []
+        # (account, key) -> [contract, position, average cost]
+        self.positions = {}
+        self._approximated = set()
+        # instruments to work again, drained by the outermost _schedule
+        self._pending = collections.deque()
+        self._draining = False
+        self.nOrders = 0
+        self.nFills = 0
+
+    ## EClient
+    def connect(self, host: str = "", port: int = 0, clientId: int = 0):
+        self.clientId = clientId
+        self.connected = True
+        self.wrapper.nextValidId(self.nextId)
+
+    def disconnect(self):
+        self.connected = False
+
+    def isConnected(self):
+        return self.connected
+
+    def serverVersion(self):
+        return 0
+
+    def reqIds(self, numIds: int):
+        self.wrapper.nextValidId(self.nextId)
+
+    def placeOrder(self, orderId: int, contract, order):
+        with self._lock:
+            self.nOrders += 1
+            sim = self.orders.get(orderId)
+            if sim is not None:
+                self._modify(sim, contract, order)
+                return
+            if self.held.pop(orderId, None) is None and orderId < self.nextId:
+                self.wrapper.error(orderId, DUPLICATE_ORDER_ID, "Duplicate order id")
+                return
+            self.nextId = max(self.nextId, orderId + 1)
+            if not order.transmit:
+                self.held[orderId] = (contract, order)
+                return
+            group = {orderId, order.parentId}
+            for heldId in sorted(self.held):
+                (heldContract, heldOrder) = self.held[heldId]
+                if heldId in group or (heldOrder.parentId and heldOrder.parentId in group):
+                    del self.held[heldId]
+                    self._accept(heldId, heldContract, heldOrder)
+            self._accept(orderId, contract, order)
+
+    def cancelOrder(self, orderId: int, *args):
+        with self._lock:
+            if self.held.pop(orderId, None) is not None:
+                return
+            sim = self.orders.get(orderId)
+            if sim is None or not sim.working:
+                self.wrapper.error(orderId, CANCEL_NOT_FOUND,
+                                   "OrderId %d that needs to be cancelled is not found." % orderId)
+                return
+            self._cancel(sim)
+
+    def reqGlobalCancel(self):
+        with self._lock:
+            self.held.clear()
+            for sim in list(self.orders.values()):
+                if sim.working:
+                    self._cancel(sim)
+
+    def reqOpenOrders(self):
+        with self._lock:
+            for sim in self.orders.values():
+                if sim.working:
+                    self._openOrder(sim)
+                    self._orderStatus(sim)
+            self.wrapper.openOrderEnd()
+
+    reqAllOpenOrders = reqOpenOrders
+
+    def reqExecutions(self, reqId: int, execFilter):
+        with self._lock:
+            for (contract, execution, report) in self.executions:
+                if execFilter.clientId and execution.clientId != execFilter.clientId:
+                    continue
+                if execFilter.acctCode and execution.acctNumber != execFilter.acctCode:
+                    continue
+                # execution times have two spaces between date and time, filters one
+                if execFilter.time and execution.time.replace("  ", " ") < execFilter.time:
+                    continue
+                if execFilter.symbol and contract.symbol != execFilter.symbol:
+                    continue
+                if execFilter.secType and contract.secType != execFilter.secType:
+                    continue
+                if execFilter.exchange and execution.exchange != execFilter.exchange:
+                    continue
+                if execFilter.side and execution.side != SIDES.get(execFilter.side):
+                    continue
+                self.wrapper.execDetails(reqId, contract, execution)
+                self.wrapper.commissionReport(report)
+            self.wrapper.execDetailsEnd(reqId)
+
+    def reqPositions(self):
+        with self._lock:
+            for ((account, key), (contract, position, avgCost)) in self.positions.items():
+                self.wrapper.position(account, contract, position, avgCost)
+            self.wrapper.positionEnd()
+
+    ## quotes
+    def bindReqId(self, reqId: int, contract):
+        """
+        Routes the market data callbacks of reqId to the instrument of contract
+        """
+        self.reqId2key[reqId] = instrumentKey(contract)
+
+    def setQuote(self, key, bid: float = None, ask: float = None, bidSize: float = None,
+                 askSize: float = None, last: float = None):
+        """
+        Updates the quote of an instrument and works the orders resting on it
+        :param key: instrumentKey of the contract
+        """
+        with self._lock:
+            inst = self.instruments[key]
+            if bid is not None:
+                inst.bid = bid
+            if ask is not None:
+                inst.ask = ask
+            if bidSize is not None:
+                inst.bidSize = bidSize
+            if askSize is not None:
+                inst.askSize = askSize
+            if last is not None:
+                inst.last = last
+            self._schedule(inst)
+
+    def auction(self, key, price: float):
+        """
+        Closing auction at price: MOC orders fill, LOC orders fill if price is within
+        their limit and are cancelled otherwise
+        """
+        with self._lock:
+            inst = self.instruments[key]
+            (closing, inst.closing) = (inst.closing, [])
+            for (seq, sim) in closing:
+                if seq != sim.seq or not sim.working:
+                    continue
+                limit = sim.order.lmtPrice
+                if sim.kind == CLOSE or (price <= limit if sim.buy else price >= limit):
+                    self._fill(sim, price, sim.remaining)
+                else:
+                    self._cancel(sim)
+
+    def tickPrice(self, reqId: int, tickType: int, price: float, attrib=None):
+        key = self.reqId2key.get(reqId)
+        if key is None:
+            return
+        if tickType in BID_TICKS:
+            self.setQuote(key, bid=price)
+        elif tickType in ASK_TICKS:
+            self.setQuote(key, ask=price)
+        elif tickType in LAST_TICKS:
+            self.setQuote(key, last=price)
+
+    def tickSize(self, reqId: int, tickType: int, size: int):
+        key = self.reqId2key.get(reqId)
+        if key is None:
+            return
+        if tickType in BID_SIZE_TICKS:
+            self.instruments[key].bidSize = size
+        elif tickType in ASK_SIZE_TICKS:
+            self.instruments[key].askSize = size
+
+    def tickByTickBidAsk(self, reqId: int, time: int, bidPrice: float, askPrice: float,
+                         bidSize: int, askSize: int, tickAttribBidAsk=None):
+        key = self.reqId2key.get(reqId)
+        if key is not None:
+            self.setQuote(key, bidPrice, askPrice, bidSize, askSize)
+
+    def tickByTickAllLast(self, reqId: int, tickType: int, time: int, price: float, size: int,
+                          tickAttribLast=None, exchange: str = "", specialConditions: str = ""):
+        key = self.reqId2key.get(reqId)
+        if key is not None:
+            self.setQuote(key, last=price)
+
+    def _ignored(self, *args):
+        pass
+
+    # the other callbacks of a replayed journal
+    tickGeneric = tickString = tickSnapshotEnd = tickByTickMidPoint = _ignored
+    updateMktDepth = updateMktDepthL2 = realtimeBar = _ignored
+
+    def replay(self, replayer):
+        """
+        Drives the simulator from a TickJournalReplayer, as fast as possible
+        :return: number of callbacks replayed
+        """
+        # the journal binds its contracts as it is read
+        (nCalls, nBound) = (0, 0)
+        contracts = replayer.contracts
+        for (nowNs, name, args) in replayer.reader:
+            if len(contracts) != nBound:
+                for (reqId, contract) in contracts.items():
+                    self.bindReqId(reqId, contract)
+                nBound = len(contracts)
+            getattr(self, name)(*args)
+            nCalls += 1
+        return nCalls
+
+    ## callbacks
+    def _openOrder(self, sim):
+        state = OrderState()
+        state.status = sim.status
+        self.wrapper.openOrder(sim.orderId, sim.contract, sim.order, state)
+
+    def _orderStatus(self, sim):
+        self.wrapper.orderStatus(sim.orderId, sim.status, sim.filled, sim.remaining, sim.avgPrice,
+                                 sim.permId, sim.order.parentId, sim.lastPrice, self.clientId, "",
+                                 UNSET_DOUBLE)
+
+    def _setStatus(self, sim, status: str):
+        sim.status = status
+        self._orderStatus(sim)
+
+    ## matching
+    def _accept(self, orderId: int, contract, order):
+        order = copy.copy(order)
+        sim = self.orders[orderId] = SimOrder(orderId, contract, order, instrumentKey(contract),
+                                              next(self._permIds))
+        (order.orderId, order.permId, order.clientId) = (orderId, sim.permId, self.clientId)
+        if order.parentId:
+            parent = self.orders.get(order.parentId)
+            if parent is None or (not parent.working and parent.status != "Filled"):
+                sim.status = "Inactive"
+                self.wrapper.error(orderId, ORDER_REJECTED,
+                                   "Order rejected - reason:parent order %d is not working"
+                                   % order.parentId)
+                self._orderStatus(sim)
+                return
+            sim.parent = parent
+            parent.children.append(sim)
+        if order.ocaGroup:
+            self.ocaGroups[order.ocaGroup].append(sim)
+        sim.status = "PreSubmitted"
+        self._openOrder(sim)
+        self._orderStatus(sim)
+        if sim.parent is not None and sim.parent.status != "Filled":
+            # waits for its parent to fill
+            return
+        self._activate(sim)
+
+    def _kind(self, order):
+        kind = ORDER_TYPES.get(order.orderType)
+        if kind is None:
+            kind = LIMIT if _isSet(order.lmtPrice) and order.lmtPrice else MARKET
+            if order.orderType not in self._approximated:
+                self._approximated.add(order.orderType)
+                logging.info("simulating %s orders as %s orders", order.orderType, kind)
+        return kind
+
+    def _activate(self, sim, kind: str = None):
+        sim.kind = kind or self._kind(sim.order)
+        inst = self.instruments[sim.key]
+        waiting = sim.kind not in (MARKET, LIMIT)
+        if sim.status != ("PreSubmitted" if waiting else "Submitted"):
+            self._setStatus(sim, "PreSubmitted" if waiting else "Submitted")
+        if sim.remaining <= 0:
+            self._setStatus(sim, "Filled")
+            self._filled(sim)
+            return
+        sim.seq = next(self._seq)
+        order = sim.order
+        if sim.kind == MARKET:
+            inst.markets.append((sim.seq, sim))
+        elif sim.kind == LIMIT:
+            self._push(inst, sim, order.lmtPrice, below=sim.buy)
+        elif sim.kind in (STOP, STOP_LIMIT):
+            self._push(inst, sim, order.auxPrice, below=not sim.buy)
+        elif sim.kind in (TOUCHED, TOUCHED_LIMIT):
+            self._push(inst, sim, order.auxPrice, below=sim.buy)
+        elif sim.kind in (TRAIL, TRAIL_LIMIT):
+            if _isSet(order.trailStopPrice):
+                sim.trailStop = order.trailStopPrice
+            inst.trailing.append((sim.seq, sim))
+        else:
+            inst.closing.append((sim.seq, sim))
+        self._schedule(inst)
+
+    def _push(self, inst, sim, level: float, below: bool):
+        if sim.buy:
+            heap = inst.buyBelow if below else inst.buyAbove
+        else:
+            heap = inst.sellBelow if below else inst.sellAbove
+        heapq.heappush(heap, (-level if below else level, sim.seq, sim))
+
+    def _schedule(self, inst):
+        """
+        Works the orders of inst, or queues it when called from the matching loop: an
+        order activated while an instrument is worked (a triggered stop, the child of
+        a filled parent) is matched on the next pass rather than by recursion
+        """
+        if inst not in self._pending:
+            self._pending.append(inst)
+        if self._draining:
+            return
+        self._draining = True
+        try:
+            while self._pending:
+                self._work(self._pending.popleft())
+        finally:
+            self._pending.clear()
+            self._draining = False
+
+    def _work(self, inst):
+        if inst.markets:
+            (markets, inst.markets) = (inst.markets, [])
+            for (seq, sim) in markets:
+                if seq == sim.seq and sim.working:
+                    self._take(inst, sim)
+        if inst.trailing:
+            self._trail(inst)
+        ask = inst.ask
+        bid = inst.bid
+        if ask == ask:
+            self._cross(inst, inst.buyBelow, lambda level: -level >= ask)
+            self._cross(inst, inst.buyAbove, lambda level: level <= ask)
+        if bid == bid:
+            self._cross(inst, inst.sellBelow, lambda level: -level >= bid)
+            self._cross(inst, inst.sellAbove, lambda level: level <= bid)
+
+    def _cross(self, inst, heap, crossed):
+        while heap and crossed(heap[0][0]):
+            (level, seq, sim) = heap[0]
+            if seq != sim.seq or not sim.working:
+                heapq.heappop(heap)
+                continue
+            if sim.kind == LIMIT:
+                if not self._take(inst, sim):
+                    return
+                if sim.working and heap and heap[0][2] is sim:
+                    # partly filled on the displayed size: stays at the top
+                    return
+            else:
+                heapq.heappop(heap)
+                sim.seq = next(self._seq)
+                self._trigger(sim)
+
+    def _trigger(self, sim):
+        kind = TRIGGERED[sim.kind]
+        if kind == LIMIT and sim.kind == TRAIL_LIMIT:
+            offset = sim.order.lmtPriceOffset
+            sim.order.lmtPrice = sim.trailStop + (offset if sim.buy else -offset)
+        self._activate(sim, kind)
+
+    def _trail(self, inst):
+        (trailing, triggered) = ([], [])
+        for (seq, sim) in inst.trailing:
+            if seq != sim.seq or not sim.working:
+                continue
+            price = inst.ask if sim.buy else inst.bid
+            if price != price:
+                trailing.append((seq, sim))
+                continue
+            order = sim.order
+            amount = order.auxPrice if _isSet(order.auxPrice) and order.auxPrice else \
+                price * order.trailingPercent / 100.
+            stop = price + amount if sim.buy else price - amount
+            if sim.trailStop is None or (stop < sim.trailStop if sim.buy else stop > sim.trailStop):
+                sim.trailStop = stop
+            if price >= sim.trailStop if sim.buy else price <= sim.trailStop:
+                triggered.append(sim)
+            else:
+                trailing.append((seq, sim))
+        inst.trailing = trailing
+        for sim in triggered:
+            if sim.working:
+                sim.seq = next(self._seq)
+                self._trigger(sim)
+
+    def _take(self, inst, sim):
+        """
+        Fills an order against the quote, as much as the displayed size allows
+        :return: False if nothing could be filled
+        """
+        price = inst.ask if sim.buy else inst.bid
+        if price != price:
+            inst.markets.append((sim.seq, sim))
+            return False
+        quantity = sim.remaining
+        if self.useSizes:
+            available = inst.askSize if sim.buy else inst.bidSize
+            quantity = min(quantity, available)
+            if quantity <= 0:
+                return False
+            if sim.buy:
+                inst.askSize -= quantity
+            else:
+                inst.bidSize -= quantity
+        self._fill(sim, price, quantity)
+        return True
+
+    def _fill(self, sim, price: float, quantity: float):
+        now = self._clock()
+        sim.avgPrice = (sim.avgPrice * sim.filled + price * quantity) / (sim.filled + quantity)
+        sim.filled += quantity
+        sim.remaining -= quantity
+        sim.lastPrice = price
+        self.nFills += 1
+        contract = sim.contract
+        order = sim.order
+        execution = Execution()
+        execution.execId = "%08x.%08x.01.01" % (sim.permId, next(self._execIds))
+        execution.time = time.strftime("%Y%m%d  %H:%M:%S", time.localtime(now))
+        execution.acctNumber = order.account or self.account
+        execution.exchange = contract.exchange
+        execution.side = "BOT" if sim.buy else "SLD"
+        execution.shares = quantity
+        execution.price = price
+        execution.permId = sim.permId
+        execution.clientId = self.clientId
+        execution.orderId = sim.orderId
+        execution.cumQty = sim.filled
+        execution.avgPrice = sim.avgPrice
+        execution.orderRef = order.orderRef
+        report = CommissionReport()
+        report.execId = execution.execId
+        multiplier = float(contract.multiplier) if contract.multiplier else 1.
+        report.commission = min(max(self.commissionPerShare * quantity, self.minCommission),
+                                self.maxCommissionPct * quantity * price * multiplier)
+        report.currency = contract.currency
+        report.realizedPNL = self._book(execution.acctNumber, sim, quantity, price, multiplier)
+        report.yield_ = UNSET_DOUBLE
+        self.executions.append((contract, execution, report))
+        self.wrapper.execDetails(-1, contract, execution)
+        self._setStatus(sim, "Filled" if sim.remaining <= 0 else "Submitted")
+        self.wrapper.commissionReport(report)
+        if sim.remaining <= 0:
+            sim.seq = next(self._seq)
+            self._filled(sim)
+        self._oca(sim, quantity)
+
+    def _book(self, account, sim, quantity, price, multiplier):
+        # position and average cost per share times multiplier, as IB reports it
+        entry = self.positions.get((account, sim.key))
+        if entry is None:
+            entry = self.positions[(account, sim.key)] = [sim.contract, 0., 0.]
+        (position, avgCost) = entry[1:]
+        signed = quantity if sim.buy else -quantity
+        cost = price * multiplier
+        realized = UNSET_DOUBLE
+        if position and (position > 0) != (signed > 0):
+            closed = min(abs(signed), abs(position))
+            realized = closed * (cost - avgCost) * (1 if position > 0 else -1)
+        after = position + signed
+        if after == 0:
+            avgCost = 0.
+        elif position == 0 or (position > 0) != (after > 0):
+            avgCost = cost
+        elif (position > 0) == (signed > 0):
+            avgCost = (avgCost * abs(position) + cost * abs(signed)) / abs(after)
+        entry[1:] = (after, avgCost)
+        return realized
+
+    def _filled(self, sim):
+        for child in sim.children:
+            if child.status == "PreSubmitted" and child.kind is None:
+                self._activate(child)
+        parent = sim.parent
+        if parent is not None:
+            # bracket legs cancel each other
+            for sibling in parent.children:
+                if sibling is not sim and sibling.working:
+                    self._cancel(sibling)
+
+    def _oca(self, sim, quantity: float):
+        group = sim.order.ocaGroup
+        if not group:
+            return
+        for member in self.ocaGroups.get(group, ()):
+            if member is sim or not member.working:
+                continue
+            if sim.order.ocaType == 1:
+                self._cancel(member)
+                continue
+            member.remaining -= quantity
+            if member.remaining <= 0:
+                member.remaining = 0.
+                self._cancel(member)
+            else:
+                self._orderStatus(member)
+
+    def _cancel(self, sim):
+        sim.seq = next(self._seq)
+        self.wrapper.error(sim.orderId, ORDER_CANCELLED, "Order Canceled - reason:")
+        self._setStatus(sim, "Cancelled")
+        for child in sim.children:
+            if child.working:
+                self._cancel(child)
+
+    def _modify(self, sim, contract, order):
+        if not sim.working:
+            self.wrapper.error(sim.orderId, CANNOT_MODIFY_FILLED, "Can't modify a filled order.")
+            return
+        order = copy.copy(order)
+        (order.orderId, order.permId, order.clientId) = (sim.orderId, sim.permId, self.clientId)
+        sim.order = order
+        sim.remaining = order.totalQuantity - sim.filled
+        sim.seq = next(self._seq)
+        self._openOrder(sim)
+        if sim.parent is not None and sim.parent.status != "Filled":
+            return
+        self._activate(sim)
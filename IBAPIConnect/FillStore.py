@@ -0,0 +1,401 @@
+import collections
+import glob
+import logging
+import os.path
+import threading
+import time
+
+import numpy as np
+
+from ibapi.common import UNSET_DOUBLE
+from ibapi.execution import ExecutionFilter
+
+# one array per column, one row per fill; strings are interned as ids
+COLUMNS = (("time", np.float64),        # epoch seconds
+           ("orderId", np.int64), ("permId", np.int64), ("clientId", np.int64),
+           ("conId", np.int64), ("account", np.int32), ("symbol", np.int32),
+           ("exchange", np.int32), ("currency", np.int32),
+           ("side", np.int8),           # 1 bought, -1 sold
+           ("shares", np.float64), ("price", np.float64), ("multiplier", np.float64),
+           ("cumQty", np.float64), ("avgPrice", np.float64), ("liquidity", np.int8),
+           # NaN until the commission report has arrived
+           ("commission", np.float64), ("realizedPNL", np.float64))
+STRING_COLUMNS = ("account", "symbol", "exchange", "currency")
+INDEXES = ("orderId", "conId", "account")
+FILTER_TIME = "%Y%m%d %H:%M:%S"
+
+
+_midnights = {}
+
+
+def executionTime(text: str):
+    """
+    :param text: Execution.time, "yyyymmdd  hh:mm:ss" with an optional time zone,
+    read as local time
+    :return: (epoch seconds, yyyymmdd day)
+    """
+    parts = text.split()
+    midnight = _midnights.get(parts[0])
+    if midnight is None:
+        midnight = _midnights[parts[0]] = time.mktime(time.strptime(parts[0], "%Y%m%d"))
+    (hours, minutes, seconds) = parts[1].split(":")
+    # seconds from local midnight: off by the shift on the night of a daylight saving change
+    stamp = midnight + int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+    return (stamp, int(parts[0]))
+
+
+def revisionBase(execId: str):
+    """
+    An execId without its revision: corrections of an execution, e.g.
+    0000e0d5.6552fd76.01.01 and 0000e0d5.6552fd76.01.02, share it
+    """
+    return execId.rsplit(".", 1)[0] if execId.count(".") >= 3 else execId
+
+
+def revisionOf(execId: str):
+    """
+    The revision of an execId, "" if it has none: fixed width, so comparable as strings
+    """
+    return execId.rsplit(".", 1)[1] if execId.count(".") >= 3 else ""
+
+
+def multiplierOf(contract):
+    try:
+        return float(contract.multiplier) if contract.multiplier else 1.
+    except ValueError:
+        return 1.
+
+
+class FillDay(object):
+    """
+    The fills of one trading day, as columns
+    """
+
+    def __init__(self, day: int, capacity: int = 1024):
+        self.day = day
+        self.n = 0
+        self.columns = {name: np.zeros(capacity, dtype=dtype) for (name, dtype) in COLUMNS}
+        self.execIds = []
+        # value -> rows
+        self.indexes = {name: collections.defaultdict(list) for name in INDEXES}
+
+    def __len__(self):
+        return self.n
+
+    def _grow(self):
+        for (name, values) in self.columns.items():
+            grown = np.zeros(2 * values.shape[0], dtype=values.dtype)
+            grown[:self.n] = values[:self.n]
+            self.columns[name] = grown
+
+    def append(self, execId: str, values):
+        if self.n == self.columns["time"].shape[0]:
+            self._grow()
+        row = self.n
+        for (name, value) in values.items():
+            self.columns[name][row] = value
+        self.execIds.append(execId)
+        self.n += 1
+        self._index(row)
+        return row
+
+    def _index(self, row: int):
+        for name in INDEXES:
+            self.indexes[name][self.columns[name][row].item()].append(row)
+
+    def column(self, name: str):
+        return self.columns[name][:self.n]
+
+    def rows(self, criteria):
+        """
+        :param criteria: index name -> value, all of which must match
+        :return: sorted row numbers, every row (a slice) without criteria
+        """
+        found = None
+        for (name, value) in criteria.items():
+            rows = self.indexes[name].get(value, ())
+            found = set(rows) if found is None else found.intersection(rows)
+        if found is None:
+            return slice(0, self.n)
+        return np.array(sorted(found), dtype=np.int64)
+
+
+class FillStore(object):
+    """
+    Executions joined with their commission reports, stored as columns per day
+    execDetails and commissionReport arrive separately, the commission usually
+    later, keyed only by execId: whichever comes second finds the first through
+    a dict, and a commission without its execution waits until the execution
+    comes. Fills are kept in one FillDay per trading day, with row indexes by
+    orderId, conId and account, so the end of day TCA and P&L are array
+    operations over the selected rows. Executions replayed by reqExecutions are
+    recognized by execId and dropped, corrections (same execId up to the last
+    dot) overwrite the fill they correct, older revisions being dropped. Days are saved as one npz file each;
+    after a restart, executionFilter() asks only for the executions after the
+    last one stored.
+    """
+
+    def __init__(self, maxOrphans: int = 10000):
+        self.maxOrphans = maxOrphans
+        self._lock = threading.RLock()
+        self.days = {}
+        # execId -> (FillDay, row), execId up to the revision -> execId
+        self.execId2row = {}
+        self.base2execId = {}
+        self.strings = []
+        self.string2id = {}
+        # commission reports that came before their execution
+        self._orphanCommissions = collections.OrderedDict()
+        self._dirty = set()
+        self.lastTime = 0.
+        self.nDuplicates = 0
+        self.nCorrections = 0
+
+    def __len__(self):
+        return len(self.execId2row)
+
+    def intern(self, text: str):
+        sid = self.string2id.get(text)
+        if sid is None:
+            sid = self.string2id[text] = len(self.strings)
+            self.strings.append(text)
+        return sid
+
+    def _day(self, day: int):
+        fills = self.days.get(day)
+        if fills is None:
+            fills = self.days[day] = FillDay(day)
+        return fills
+
+    ## callbacks
+    def execDetails(self, reqId: int, contract, execution):
+        """
+        Live executions (reqId -1) and replies to reqExecutions alike
+        """
+        execId = execution.execId
+        with self._lock:
+            if execId in self.execId2row:
+                self.nDuplicates += 1
+                return
+            (stamp, day) = executionTime(execution.time)
+            values = {"time": stamp, "orderId": execution.orderId, "permId": execution.permId,
+                      "clientId": execution.clientId, "conId": contract.conId,
+                      "account": self.intern(execution.acctNumber),
+                      "symbol": self.intern(contract.symbol),
+                      "exchange": self.intern(execution.exchange),
+                      "currency": self.intern(contract.currency),
+                      "side": 1 if execution.side == "BOT" else -1,
+                      "shares": execution.shares, "price": execution.price,
+                      "multiplier": multiplierOf(contract), "cumQty": execution.cumQty,
+                      "avgPrice": execution.avgPrice, "liquidity": execution.lastLiquidity,
+                      "commission": np.nan, "realizedPNL": np.nan}
+            base = revisionBase(execId)
+            corrected = self.base2execId.get(base)
+            if corrected is not None and revisionOf(execId) <= revisionOf(corrected):
+                # an older revision, replayed after its correction
+                self.nDuplicates += 1
+                return
+            if corrected is not None:
+                self._correct(corrected, execId, values)
+            else:
+                fills = self._day(day)
+                self.execId2row[execId] = (fills, fills.append(execId, values))
+                self._dirty.add(day)
+            self.base2execId[base] = execId
+            self.lastTime = max(self.lastTime, stamp)
+            commission = self._orphanCommissions.pop(execId, None)
+            if commission is not None:
+                self._addCommission(commission)
+
+    def _correct(self, oldExecId: str, execId: str, values):
+        # the correction takes the row of the fill it replaces
+        (fills, row) = self.execId2row.pop(oldExecId)
+        self.nCorrections += 1
+        for name in INDEXES:
+            fills.indexes[name][fills.columns[name][row].item()].remove(row)
+        for (name, value) in values.items():
+            fills.columns[name][row] = value
+        fills._index(row)
+        fills.execIds[row] = execId
+        self.execId2row[execId] = (fills, row)
+        self._dirty.add(fills.day)
+
+    def _addCommission(self, commissionReport):
+        (fills, row) = self.execId2row[commissionReport.execId]
+        fills.columns["commission"][row] = commissionReport.commission
+        realized = commissionReport.realizedPNL
+        fills.columns["realizedPNL"][row] = realized if realized != UNSET_DOUBLE else np.nan
+        self._dirty.add(fills.day)
+
+    def commissionReport(self, commissionReport):
+        with self._lock:
+            if commissionReport.execId in self.execId2row:
+                self._addCommission(commissionReport)
+                return
+            self._orphanCommissions[commissionReport.execId] = commissionReport
+            while len(self._orphanCommissions) > self.maxOrphans:
+                self._orphanCommissions.popitem(last=False)
+
+    ## replay
+    def executionFilter(self, clientId: int = 0, acctCode: str = "", overlap: float = 1.):
+        """
+        Filter of the executions not stored yet, from overlap seconds before the
+        last one; the overlapping ones are dropped as duplicates
+        """
+        execFilter = ExecutionFilter()
+        execFilter.clientId = clientId
+        execFilter.acctCode = acctCode
+        if self.lastTime:
+            execFilter.time = time.strftime(FILTER_TIME, time.localtime(self.lastTime - overlap))
+        return execFilter
+
+    def replay(self, client, reqId: int, clientId: int = 0, acctCode: str = ""):
+        client.reqExecutions(reqId, self.executionFilter(clientId, acctCode))
+
+    ## persistence
+    def save(self, directory: str, everything: bool = False):
+        """
+        Writes the days changed since the last save, one fills_yyyymmdd.npz each
+        """
+        with self._lock:
+            days = list(self.days) if everything else sorted(self._dirty)
+            strings = np.array(self.strings, dtype=str)
+            for day in days:
+                fills = self.days[day]
+                path = os.path.join(directory, "fills_%d.npz" % day)
+                tmp = path + ".tmp"
+                with open(tmp, "wb") as f:
+                    np.savez(f, strings=strings, execIds=np.array(fills.execIds, dtype=str),
+                             **{name: fills.column(name) for (name, dtype) in COLUMNS})
+                os.replace(tmp, path)
+            self._dirty.clear()
+        return days
+
+    def load(self, directory: str):
+        """
+        Reads back every day saved in directory
+        """
+        paths = sorted(glob.glob(os.path.join(directory, "fills_*.npz")))
+        with self._lock:
+            for path in paths:
+                data = np.load(path)
+                # ids are remapped to the strings of this store
+                remap = np.array([self.intern(str(text)) for text in data["strings"]],
+                                 dtype=np.int32)
+                execIds = [str(execId) for execId in data["execIds"]]
+                day = int(os.path.basename(path)[len("fills_"):-len(".npz")])
+                self.days.pop(day, None)
+                fills = self._day(day)
+                for (row, execId) in enumerate(execIds):
+                    values = {name: data[name][row] for (name, dtype) in COLUMNS}
+                    for name in STRING_COLUMNS:
+                        values[name] = remap[values[name]]
+                    self.execId2row[execId] = (fills, fills.append(execId, values))
+                    self.base2execId[revisionBase(execId)] = execId
+                if execIds:
+                    self.lastTime = max(self.lastTime, float(fills.column("time").max()))
+            logging.info("loaded %d fills from %d days", len(self), len(paths))
+        return len(paths)
+
+    ## queries
+    def select(self, days=None, **criteria):
+        """
+        Columns of the matching fills, days concatenated in order
+        :param days: yyyymmdd days, every day if None
+        :param criteria: orderId, conId, account (name)
+        :return: dict column -> array
+        """
+        if "account" in criteria:
+            criteria["account"] = self.string2id.get(criteria["account"], -1)
+        with self._lock:
+            selected = [self.days[day] for day in sorted(self.days if days is None else days)
+                        if day in self.days]
+            parts = collections.defaultdict(list)
+            for fills in selected:
+                rows = fills.rows(criteria)
+                for (name, dtype) in COLUMNS:
+                    parts[name].append(fills.column(name)[rows])
+                parts["day"].append(np.full(len(parts["time"][-1]), fills.day, dtype=np.int64))
+        result = {}
+        for (name, dtype) in COLUMNS + (("day", np.int64),):
+            result[name] = np.concatenate(parts[name]) if parts[name] else np.zeros(0, dtype=dtype)
+        return result
+
+    def names(self, ids):
+        """
+        :return: the strings of interned ids
+        """
+        return np.array(self.strings, dtype=object)[ids]
+
+    def byOrder(self, days=None, **criteria):
+        """
+        Per order: side, filled quantity, VWAP, commission, first and last fill time
+        Orders are told apart by permId: orderIds repeat across clientIds, and orders
+        entered in TWS all have orderId 0
+        """
+        fills = self.select(days, **criteria)
+        (permIds, inverse) = np.unique(fills["permId"], return_inverse=True)
+        n = len(permIds)
+        quantity = np.bincount(inverse, fills["shares"], n)
+        signed = np.bincount(inverse, fills["side"] * fills["shares"], n)
+        notional = np.bincount(inverse, fills["shares"] * fills["price"], n)
+        first = np.full(n, np.inf)
+        np.minimum.at(first, inverse, fills["time"])
+        last = np.full(n, -np.inf)
+        np.maximum.at(last, inverse, fills["time"])
+        rowOf = np.zeros(n, dtype=np.int64)
+        rowOf[inverse] = np.arange(len(inverse))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            vwap = notional / quantity
+        return {"permId": permIds, "orderId": fills["orderId"][rowOf],
+                "clientId": fills["clientId"][rowOf], "conId": fills["conId"][rowOf],
+                "account": fills["account"][rowOf], "side": np.sign(signed),
+                "quantity": quantity, "vwap": vwap,
+                "multiplier": fills["multiplier"][rowOf],
+                "commission": np.bincount(inverse, np.nan_to_num(fills["commission"]), n),
+                "first": first, "last": last}
+
+    def tca(self, arrival, days=None, **criteria):
+        """
+        Slippage of every order against its arrival (decision) price
+        :param arrival: permId -> arrival price; orders without one get NaN
+        :return: byOrder() columns and arrival, slippageBps (positive is a cost) and
+        cost, the slippage in currency with the commission added
+        """
+        orders = self.byOrder(days, **criteria)
+        price = np.array([arrival.get(permId, np.nan) for permId in orders["permId"].tolist()])
+        with np.errstate(invalid="ignore", divide="ignore"):
+            slippage = orders["side"] * (orders["vwap"] - price) / price * 1e4
+        orders["arrival"] = price
+        orders["slippageBps"] = slippage
+        orders["cost"] = orders["side"] * (orders["vwap"] - price) * orders["quantity"] * \
+            orders["multiplier"] + orders["commission"]
+        return orders
+
+    def pnl(self, marks=None, days=None, **criteria):
+        """
+        Per (account, conId): quantities bought and sold, net position change, cash
+        flow, commission, IB's realized P&L and, with marks, the P&L marked to market
+        :param marks: conId -> price
+        """
+        fills = self.select(days, **criteria)
+        # conIds fit in 32 bits
+        keys = (fills["account"].astype(np.int64) << 32) | fills["conId"]
+        (unique, inverse) = np.unique(keys, return_inverse=True)
+        n = len(unique)
+        signed = fills["side"] * fills["shares"]
+        bought = np.bincount(inverse, np.where(signed > 0, signed, 0.), n)
+        sold = np.bincount(inverse, np.where(signed < 0, -signed, 0.), n)
+        cash = np.bincount(inverse, -signed * fills["price"] * fills["multiplier"], n)
+        commission = np.bincount(inverse, np.nan_to_num(fills["commission"]), n)
+        conIds = unique & 0xFFFFFFFF
+        rowOf = np.zeros(n, dtype=np.int64)
+        rowOf[inverse] = np.arange(len(inverse))
+        result = {"account": unique >> 32, "conId": conIds, "bought": bought, "sold": sold,
+                  "net": bought - sold, "cash": cash, "commission": commission,
+                  "realizedPNL": np.bincount(inverse, np.nan_to_num(fills["realizedPNL"]), n)}
+        if marks is not None:
+            mark = np.array([marks.get(conId, np.nan) for conId in conIds.tolist()])
+            result["mark"] = mark
+            result["pnl"] = cash + result["net"] * mark * fills["multiplier"][rowOf] - commission
+        return result
@@ -0,0 +1,208 @@
+import threading
+
+import numpy as np
+
+from ibapi.ticktype import TickTypeEnum
+
+
+# values carried by tickOptionComputation, in storage order
+GREEKS = ("IMPLIED_VOL", "DELTA", "OPT_PRICE", "PV_DIVIDEND",
+          "GAMMA", "VEGA", "THETA", "UND_PRICE")
+GREEK_INDEX = {name: idx for (idx, name) in enumerate(GREEKS)}
+
+# option computation tick types, live and delayed share a row
+COMPUTATIONS = ("BID", "ASK", "LAST", "MODEL")
+COMPUTATION_INDEX = {name: idx for (idx, name) in enumerate(COMPUTATIONS)}
+TICK_TO_COMPUTATION = {
+    TickTypeEnum.BID_OPTION_COMPUTATION: 0,
+    TickTypeEnum.ASK_OPTION_COMPUTATION: 1,
+    TickTypeEnum.LAST_OPTION_COMPUTATION: 2,
+    TickTypeEnum.MODEL_OPTION: 3,
+}
+for (_name, _idx) in (("DELAYED_BID_OPTION", 0), ("DELAYED_ASK_OPTION", 1),
+                      ("DELAYED_LAST_OPTION", 2), ("DELAYED_MODEL_OPTION", 3)):
+    if hasattr(TickTypeEnum, _name):
+        TICK_TO_COMPUTATION[getattr(TickTypeEnum, _name)] = _idx
+del _name, _idx
+
+# greeks aggregated over the portfolio, weighted by position * multiplier
+AGGREGATED = ("DELTA", "GAMMA", "VEGA", "THETA")
+AGG_COLUMNS = np.array([GREEK_INDEX[name] for name in AGGREGATED])
+# dollar delta needs the underlying price, it is kept as an extra aggregate column
+DOLLAR_DELTA = len(AGGREGATED)
+
+
+class GreeksStore(object):
+    """
+    Columnar store of tickOptionComputation values, indexed by option slot,
+    computation tick type (bid/ask/last/model) and greek
+    Position-weighted portfolio greeks are kept up to date incrementally: every tick
+    applies the difference between the option's new and previous contribution, so
+    one option update costs O(1) whatever the size of the book. Each option may also
+    belong to a group (typically its underlying) whose aggregates are kept the same way.
+    """
+
+    def __init__(self, capacity: int = 1024, aggComputation: str = "MODEL",
+                 resyncEvery: int = 1000000):
+        self._lock = threading.Lock()
+        self.key2slot = {}
+        self.slot2key = []
+        self.reqId2slot = {}
+        self.group2idx = {}
+        self.aggRow = COMPUTATION_INDEX[aggComputation]
+        self.resyncEvery = resyncEvery
+        self._nUpdates = 0
+
+        self.greeks = np.full((capacity, len(COMPUTATIONS), len(GREEKS)), np.nan)
+        self.position = np.zeros(capacity)
+        self.multiplier = np.ones(capacity)
+        self.group = np.full(capacity, -1, dtype=np.int64)
+        # what each slot currently contributes to the aggregates
+        self.contribution = np.zeros((capacity, len(AGGREGATED) + 1))
+        self.portfolio = np.zeros(len(AGGREGATED) + 1)
+        self.groupTotals = np.zeros((0, len(AGGREGATED) + 1))
+
+    @property
+    def capacity(self):
+        return self.greeks.shape[0]
+
+    def _grow(self):
+        n = self.capacity
+        grown = np.full((2 * n, len(COMPUTATIONS), len(GREEKS)), np.nan)
+        grown[:n] = self.greeks
+        self.greeks = grown
+        self.position = np.concatenate([self.position, np.zeros(n)])
+        self.multiplier = np.concatenate([self.multiplier, np.ones(n)])
+        self.group = np.concatenate([self.group, np.full(n, -1, dtype=np.int64)])
+        self.contribution = np.concatenate([self.contribution, np.zeros_like(self.contribution)])
+
+    def addOption(self, key, multiplier: float = 100., group=None):
+        """
+        Returns the slot of an option, allocating it the first time
+        :param group: optional aggregation group, e.g. the underlying symbol
+        """
+        with self._lock:
+            slot = self.key2slot.get(key)
+            if slot is None:
+                slot = len(self.slot2key)
+                if slot == self.capacity:
+                    self._grow()
+                self.slot2key.append(key)
+                self.key2slot[key] = slot
+            self.multiplier[slot] = multiplier
+            if group is not None:
+                groupIdx = self.group2idx.get(group)
+                if groupIdx is None:
+                    groupIdx = self.group2idx[group] = len(self.group2idx)
+                    self.groupTotals = np.vstack([self.groupTotals,
+                                                  np.zeros(len(AGGREGATED) + 1)])
+                if self.group[slot] >= 0:
+                    self.groupTotals[self.group[slot]] -= self.contribution[slot]
+                self.group[slot] = groupIdx
+                self.groupTotals[groupIdx] += self.contribution[slot]
+            self._applyContribution(slot)
+        return slot
+
+    def bindReqId(self, reqId: int, key, multiplier: float = 100., group=None):
+        slot = self.addOption(key, multiplier, group)
+        self.reqId2slot[reqId] = slot
+        return slot
+
+    def unbindReqId(self, reqId: int):
+        return self.reqId2slot.pop(reqId, -1)
+
+    def setPosition(self, key, position: float):
+        """
+        Updates the position held in an option and its weight in the aggregates
+        """
+        with self._lock:
+            slot = self.key2slot.get(key)
+            if slot is None:
+                raise KeyError("unknown option %r" % (key,))
+            self.position[slot] = position
+            self._applyContribution(slot)
+
+    def tickOptionComputation(self, reqId: int, tickType: int, impliedVol: float,
+                              delta: float, optPrice: float, pvDividend: float,
+                              gamma: float, vega: float, theta: float, undPrice: float):
+        """
+        Stores one tickOptionComputation; values IB reports as not computed (None)
+        leave the previous value in place
+        :return: the slot updated, -1 if the reqId or tick type is not tracked
+        """
+        slot = self.reqId2slot.get(reqId, -1)
+        row = TICK_TO_COMPUTATION.get(tickType)
+        if slot < 0 or row is None:
+            return -1
+        values = self.greeks[slot, row]
+        for (idx, value) in enumerate((impliedVol, delta, optPrice, pvDividend,
+                                       gamma, vega, theta, undPrice)):
+            if value is not None:
+                values[idx] = value
+        if row == self.aggRow:
+            with self._lock:
+                self._applyContribution(slot)
+        return slot
+
+    def _applyContribution(self, slot):
+        values = self.greeks[slot, self.aggRow]
+        weight = self.position[slot] * self.multiplier[slot]
+        new = np.empty(len(AGGREGATED) + 1)
+        new[:DOLLAR_DELTA] = values[AGG_COLUMNS] * weight
+        new[DOLLAR_DELTA] = new[0] * values[GREEK_INDEX["UND_PRICE"]]
+        # greeks not computed yet do not contribute
+        new[np.isnan(new)] = 0.
+        change = new - self.contribution[slot]
+        self.contribution[slot] = new
+        self.portfolio += change
+        if self.group[slot] >= 0:
+            self.groupTotals[self.group[slot]] += change
+        self._nUpdates += 1
+        if self._nUpdates >= self.resyncEvery:
+            self._resync()
+
+    def _resync(self):
+        # incremental sums drift by rounding error, rebuild them from the contributions
+        n = len(self.slot2key)
+        self.portfolio = self.contribution[:n].sum(axis=0)
+        totals = np.zeros_like(self.groupTotals)
+        grouped = self.group[:n] >= 0
+        np.add.at(totals, self.group[:n][grouped], self.contribution[:n][grouped])
+        self.groupTotals = totals
+        self._nUpdates = 0
+
+    def recompute(self):
+        """
+        Rebuilds every contribution and aggregate from the stored greeks in one pass
+        """
+        with self._lock:
+            n = len(self.slot2key)
+            values = self.greeks[:n, self.aggRow]
+            weight = (self.position[:n] * self.multiplier[:n])[:, None]
+            contribution = np.empty((n, len(AGGREGATED) + 1))
+            contribution[:, :DOLLAR_DELTA] = values[:, AGG_COLUMNS] * weight
+            contribution[:, DOLLAR_DELTA] = contribution[:, 0] * values[:, GREEK_INDEX["UND_PRICE"]]
+            self.contribution[:n] = np.nan_to_num(contribution, nan=0.)
+            self._resync()
+
+    def portfolioGreeks(self):
+        """
+        :return: dict of position-weighted DELTA, GAMMA, VEGA, THETA and DOLLAR_DELTA
+        """
+        totals = self.portfolio.copy()
+        result = dict(zip(AGGREGATED, totals[:DOLLAR_DELTA]))
+        result["DOLLAR_DELTA"] = totals[DOLLAR_DELTA]
+        return result
+
+    def groupGreeks(self, group):
+        totals = self.groupTotals[self.group2idx[group]].copy()
+        result = dict(zip(AGGREGATED, totals[:DOLLAR_DELTA]))
+        result["DOLLAR_DELTA"] = totals[DOLLAR_DELTA]
+        return result
+
+    def column(self, greek: str, computation: str = "MODEL"):
+        """
+        :return: a view on one greek of one computation type for all allocated options
+        """
+        return self.greeks[:len(self.slot2key), COMPUTATION_INDEX[computation],
+                           GREEK_INDEX[greek]]
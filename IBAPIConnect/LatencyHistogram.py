@@ -0,0 +1,273 @@
+import collections
+import logging
+import queue
+import threading
+import time
+
+import numpy as np
+
+NS_PER_US = 1000
+DEFAULT_MAX_NS = 60 * 10 ** 9
+
+
+class LogHistogram(object):
+    """
+    HDR-style log-linear histogram of non-negative integers (nanoseconds here)
+    Values below 2^subBucketBits are counted exactly; above, each power of two is
+    split into 2^(subBucketBits-1) buckets, so the relative error stays below
+    2^-(subBucketBits-1) whatever the magnitude. Recording is a bit_length, a shift
+    and one list increment.
+    """
+
+    def __init__(self, subBucketBits: int = 7, maxValue: int = DEFAULT_MAX_NS):
+        self.subBucketBits = subBucketBits
+        self._half = 1 << (subBucketBits - 1)
+        self._linear = 1 << subBucketBits
+        self.maxValue = maxValue
+        self.counts = [0] * (self.index(maxValue) + 1)
+        self.total = 0
+        self.sum = 0
+        self.min = None
+        self.max = 0
+        self.nClamped = 0
+
+    def index(self, value: int):
+        if value < self._linear:
+            return value
+        shift = value.bit_length() - self.subBucketBits
+        return shift * self._half + (value >> shift)
+
+    def lowValue(self, idx: int):
+        """
+        Smallest value counted in bucket idx
+        """
+        if idx < self._linear:
+            return idx
+        shift = (idx >> (self.subBucketBits - 1)) - 1
+        return (idx - shift * self._half) << shift
+
+    def record(self, value: int):
+        if value < 0:
+            # clock skew (e.g. exchange time ahead of ours) is clamped and counted
+            self.nClamped += 1
+            value = 0
+        elif value > self.maxValue:
+            self.nClamped += 1
+            value = self.maxValue
+        self.counts[self.index(value)] += 1
+        self.total += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+        if self.min is None or value < self.min:
+            self.min = value
+
+    def merge(self, other):
+        if other.subBucketBits != self.subBucketBits or other.maxValue != self.maxValue:
+            raise ValueError("cannot merge histograms with different layouts")
+        for (idx, count) in enumerate(other.counts):
+            if count:
+                self.counts[idx] += count
+        self.total += other.total
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+        self.nClamped += other.nClamped
+
+    def mean(self):
+        return self.sum / self.total if self.total else float("nan")
+
+    def percentiles(self, ps=(50., 90., 99., 99.9)):
+        """
+        :return: list of values (bucket low bounds) at the requested percentiles
+        """
+        if not self.total:
+            return [float("nan")] * len(ps)
+        cumulative = np.cumsum(self.counts)
+        ranks = np.ceil(np.asarray(ps) / 100. * self.total).clip(1, self.total)
+        idx = np.searchsorted(cumulative, ranks)
+        return [min(self.lowValue(int(i)), self.max) for i in idx]
+
+    def reset(self):
+        self.counts = [0] * len(self.counts)
+        (self.total, self.sum, self.min, self.max, self.nClamped) = (0, 0, None, 0, 0)
+
+    def copy(self):
+        h = LogHistogram(self.subBucketBits, self.maxValue)
+        h.merge(self)
+        return h
+
+    def summary(self, scale: float = NS_PER_US):
+        """
+        :return: dict of count, mean, min, p50, p90, p99, p99.9 and max, divided by scale
+        """
+        (p50, p90, p99, p999) = self.percentiles()
+        return {"count": self.total, "mean": self.mean() / scale,
+                "min": (self.min or 0) / scale, "p50": p50 / scale, "p90": p90 / scale,
+                "p99": p99 / scale, "p99.9": p999 / scale, "max": self.max / scale,
+                "clamped": self.nClamped}
+
+
+class StampingQueue(queue.Queue):
+    """
+    Drop-in for EClient.msg_queue that stamps every socket message as the reader
+    thread queues it, and remembers when the message loop took it off the queue
+    """
+
+    def __init__(self, maxsize=0, clock=time.time_ns):
+        queue.Queue.__init__(self, maxsize)
+        self._clock = clock
+        self.receivedNs = 0
+        self.dequeuedNs = 0
+
+    def _put(self, item):
+        self.queue.append((self._clock(), item))
+
+    def _get(self):
+        (self.receivedNs, item) = self.queue.popleft()
+        self.dequeuedNs = self._clock()
+        return item
+
+
+# position of the exchange time argument in the tick-by-tick callbacks
+EXCHANGE_TIME_ARG = {"tickByTickAllLast": 2, "tickByTickBidAsk": 1, "tickByTickMidPoint": 1}
+DEFAULT_METHODS = ("tickPrice", "tickSize", "tickGeneric", "tickString", "tickOptionComputation",
+                   "tickByTickAllLast", "tickByTickBidAsk", "tickByTickMidPoint",
+                   "updateMktDepth", "updateMktDepthL2", "realtimeBar")
+STAGES = ("exchange", "queue", "decode", "dispatch")
+
+
+class TickLatencyMonitor(object):
+    """
+    Per-stream latency histograms of the market data path
+    For each (callback, reqId) stream it records
+        exchange: exchange time -> socket receipt (tick-by-tick only, 1s exchange resolution)
+        queue:    socket receipt -> taken off the queue by the message loop
+        decode:   taken off the queue (or end of the previous callback of the same
+                  message) -> callback start
+        dispatch: callback start -> callback end
+    install() must run before EClient.connect() so the reader thread gets the
+    stamping queue.
+    """
+
+    def __init__(self, app, methods=DEFAULT_METHODS, subBucketBits: int = 7,
+                 clock=time.time_ns):
+        self.app = app
+        self.methods = methods
+        self.subBucketBits = subBucketBits
+        self._clock = clock
+        self.histograms = collections.defaultdict(self._newHistogram)
+        self._lock = threading.Lock()
+        self._marker = 0
+        self._thread = None
+        self._wakeup = threading.Event()
+
+    def _newHistogram(self):
+        return LogHistogram(self.subBucketBits)
+
+    def install(self):
+        if self.app.isConnected():
+            raise RuntimeError("install the latency monitor before connecting")
+        self.queue = StampingQueue(clock=self._clock)
+        self.app.msg_queue = self.queue
+        for name in self.methods:
+            setattr(self.app, name, self._timed(name, getattr(self.app, name)))
+
+    def _timed(self, name, method):
+        clock = self._clock
+        histograms = self.histograms
+        timeArg = EXCHANGE_TIME_ARG.get(name)
+        q = None
+
+        def timed(*args):
+            nonlocal q
+            q = q or self.queue
+            start = clock()
+            # a message may decode into several callbacks (tickPrice then tickSize):
+            # the decode time of the later ones starts where the previous one ended
+            firstOfMessage = q.dequeuedNs > self._marker
+            decodeStart = q.dequeuedNs if firstOfMessage else self._marker
+            try:
+                return method(*args)
+            finally:
+                end = clock()
+                key = (name, args[0])
+                with self._lock:
+                    if firstOfMessage:
+                        histograms[key + ("queue",)].record(q.dequeuedNs - q.receivedNs)
+                    histograms[key + ("decode",)].record(start - decodeStart)
+                    histograms[key + ("dispatch",)].record(end - start)
+                    if timeArg is not None:
+                        histograms[key + ("exchange",)].record(q.receivedNs - args[timeArg] * 10 ** 9)
+                # stamped after recording so our own bookkeeping is not charged to decode
+                self._marker = clock()
+
+        timed.__name__ = name
+        return timed
+
+    def snapshot(self, reset: bool = False):
+        """
+        :return: dict (callback, reqId, stage) -> LogHistogram copy
+        """
+        with self._lock:
+            snap = {key: h.copy() for (key, h) in self.histograms.items()}
+            if reset:
+                for h in self.histograms.values():
+                    h.reset()
+        return snap
+
+    def byStage(self):
+        """
+        All streams merged per (callback, stage)
+        """
+        merged = {}
+        for ((name, reqId, stage), h) in self.snapshot().items():
+            key = (name, stage)
+            if key not in merged:
+                merged[key] = self._newHistogram()
+            merged[key].merge(h)
+        return merged
+
+    def dump(self, reset: bool = False, path: str = None):
+        """
+        Logs (or appends as CSV to path) one line per stream and stage, in microseconds
+        """
+        now = time.strftime("%Y%m%d %H:%M:%S")
+        lines = []
+        for ((name, reqId, stage), h) in sorted(self.snapshot(reset).items(), key=lambda kv: str(kv[0])):
+            if not h.total:
+                continue
+            s = h.summary()
+            lines.append("%s,%s,%s,%s,%d,%.1f,%.1f,%.1f,%.1f,%.1f,%.1f,%d" % (
+                now, name, reqId, stage, s["count"], s["mean"], s["p50"], s["p90"],
+                s["p99"], s["p99.9"], s["max"], s["clamped"]))
+        if path is not None:
+            with open(path, "a") as f:
+                for line in lines:
+                    f.write(line + "\n")
+        else:
+            for line in lines:
+                logging.info("latency %s", line)
+        return lines
+
+    def startPeriodicDump(self, interval: float = 60., path: str = None):
+        """
+        Dumps and resets the histograms every interval seconds from a background thread
+        """
+        if self._thread is not None:
+            return
+        self._wakeup.clear()
+
+        def loop():
+            while not self._wakeup.wait(interval):
+                self.dump(reset=True, path=path)
+
+        self._thread = threading.Thread(target=loop, name="TickLatencyDump", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,148 @@
+import json
+import logging
+import os.path
+import threading
+
+from ibapi.contract import Contract
+
+MKT_DATA = "mktData"
+MKT_DEPTH = "mktDepth"
+# a request rerouted this many times is given up on rather than chased in a loop
+MAX_REROUTES = 3
+
+
+def routeKey(kind: str, contract: Contract):
+    """
+    Stable identifier of a request kind for a contract: data and depth of the same
+    contract may be routed differently. The contract is identified by its conId when
+    set, else by the fields that identify it in a request
+    """
+    if contract.conId:
+        return "%s:%d" % (kind, contract.conId)
+    fields = (contract.symbol, contract.secType, contract.exchange, contract.currency,
+              contract.localSymbol, contract.lastTradeDateOrContractMonth)
+    return kind + ":" + "/".join(str(v) for v in fields)
+
+
+class TrackedRequest(object):
+    def __init__(self, kind: str, reqId: int, contract: Contract, args: tuple):
+        self.kind = kind
+        self.reqId = reqId
+        # the contract the consumer asked for, and the one the data actually comes from
+        self.contract = contract
+        self.routed = contract
+        # the rest of the request arguments, replayed on a reroute
+        self.args = args
+        self.nReroutes = 0
+
+
+class MarketDataRerouter(object):
+    """
+    Follows rerouteMktDataReq/rerouteMktDepthReq, sent when IB serves a contract's data
+    (typically a CFD) from another conId and exchange
+    The request is sent again for the routed contract under the same reqId, so
+    everything keyed by the reqId (QuoteStore bindings, journal, derived streams)
+    stays attached. Reroutes are counted per requested contract; with a routes file
+    the next run requests those contracts on their route straight away.
+    """
+
+    def __init__(self, client, path: str = None):
+        self.client = client
+        self.path = path
+        self._lock = threading.RLock()
+        self.requests = {}
+        # route key -> (conId, exchange, number of reroutes seen)
+        self.routes = {}
+        self.nPreRouted = 0
+        self._resending = None
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def route(self, kind: str, contract: Contract):
+        """
+        :return: the contract to request: its known route if it was rerouted before
+        """
+        known = self.routes.get(routeKey(kind, contract))
+        if known is None:
+            return contract
+        routed = Contract()
+        (routed.conId, routed.exchange) = known[:2]
+        return routed
+
+    def track(self, kind: str, reqId: int, contract: Contract, args: tuple):
+        """
+        Records a market data or depth request
+        :return: the contract to send, pre-routed if a route is known
+        """
+        with self._lock:
+            if self._resending == (kind, reqId):
+                # our own resend coming back through the client
+                return contract
+            request = self.requests[(kind, reqId)] = TrackedRequest(kind, reqId, contract, args)
+            request.routed = self.route(kind, contract)
+            if request.routed is not contract:
+                self.nPreRouted += 1
+            return request.routed
+
+    def untrack(self, kind: str, reqId: int):
+        with self._lock:
+            self.requests.pop((kind, reqId), None)
+
+    def reroute(self, kind: str, reqId: int, conId: int, exchange: str):
+        """
+        Sends the request again for (conId, exchange) under the same reqId
+        :return: True if the request was resent
+        """
+        with self._lock:
+            request = self.requests.get((kind, reqId))
+            if request is None:
+                logging.warning("reroute of unknown %s request %d to %d@%s", kind, reqId, conId, exchange)
+                return False
+            key = routeKey(kind, request.contract)
+            nSeen = self.routes[key][2] if key in self.routes else 0
+            self.routes[key] = (conId, exchange, nSeen + 1)
+            request.nReroutes += 1
+            if request.nReroutes > MAX_REROUTES:
+                logging.error("%s request %d rerouted %d times, giving up", kind, reqId, request.nReroutes)
+                return False
+            request.routed = self.route(kind, request.contract)
+            self._resending = (kind, reqId)
+            try:
+                if kind == MKT_DATA:
+                    self.client.reqMktData(reqId, request.routed, *request.args)
+                else:
+                    self.client.reqMktDepth(reqId, request.routed, *request.args)
+            finally:
+                self._resending = None
+            if self.path is not None:
+                self.save(self.path)
+            return True
+
+    ## callbacks
+    def rerouteMktDataReq(self, reqId: int, conId: int, exchange: str):
+        return self.reroute(MKT_DATA, reqId, conId, exchange)
+
+    def rerouteMktDepthReq(self, reqId: int, conId: int, exchange: str):
+        return self.reroute(MKT_DEPTH, reqId, conId, exchange)
+
+    def counts(self):
+        """
+        :return: number of reroutes seen per route key
+        """
+        return {key: n for (key, (conId, exchange, n)) in self.routes.items()}
+
+    def save(self, path: str):
+        with self._lock:
+            routes = {key: {"conId": conId, "exchange": exchange, "count": n}
+                      for (key, (conId, exchange, n)) in self.routes.items()}
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(routes, f, indent=1, sort_keys=True)
+        os.replace(tmp, path)
+
+    def load(self, path: str):
+        with open(path) as f:
+            routes = json.load(f)
+        with self._lock:
+            for (key, route) in routes.items():
+                self.routes[key] = (int(route["conId"]), route["exchange"], int(route["count"]))
@@ -0,0 +1,265 @@
+import heapq
+import logging
+import threading
+import time
+
+from RateLimiter import TokenBucket
+
+# tier 0 instruments hold a streaming line; higher tiers are covered by snapshots
+STREAMING_TIER = 0
+DEFAULT_FIRST_REQ_ID = 600000
+
+
+class ScheduledInstrument(object):
+    def __init__(self, key, contract, tier: int):
+        self.key = key
+        self.contract = contract
+        self.tier = tier
+        self.streamReqId = None
+        self.snapshotReqId = None
+        self.snapshotSent = 0.
+        self.lastSnapshot = 0.
+        # bumped whenever the instrument is re-queued so stale heap entries are skipped
+        self.generation = 0
+
+
+class MarketDataLineScheduler(object):
+    """
+    Keeps a universe larger than the account's market data line allowance quoted
+    Tier 0 instruments get a streaming subscription. Every other tier has a maximum
+    age (seconds) and is refreshed by rotating reqMktData(..., snapshot=True) requests,
+    most overdue first. Each in-flight snapshot occupies a line until tickSnapshotEnd
+    (or a timeout), and every request/cancel goes through a message rate token bucket.
+    All L1 values land in the shared QuoteStore keyed by instrument.
+    """
+
+    def __init__(self, client, quoteStore, maxLines: int = 100, tierMaxAge: dict = None,
+                 maxMsgRate: float = 40., snapshotTimeout: float = 11.,
+                 firstReqId: int = DEFAULT_FIRST_REQ_ID, throttle: TokenBucket = None,
+                 clock=time.monotonic):
+        """
+        :param throttle: the application's shared TokenBucket, when other requests
+        go out on the same connection; maxMsgRate is then ignored
+        """
+        self.client = client
+        self.quoteStore = quoteStore
+        self.maxLines = maxLines
+        self.tierMaxAge = dict(tierMaxAge or {1: 5., 2: 30., 3: 300.})
+        self.snapshotTimeout = snapshotTimeout
+        self.throttle = throttle if throttle is not None else TokenBucket(maxMsgRate, clock=clock)
+        self._clock = clock
+        self._nextReqId = firstReqId
+        self._lock = threading.RLock()
+        self._thread = None
+        self._running = False
+
+        self.instruments = {}
+        self.streaming = {}
+        self.reqId2inst = {}
+        self.inFlight = {}
+        # (due time, tier, generation, key) for every snapshot-tier instrument
+        self._dueHeap = []
+        self.nSnapshots = 0
+        self.nTimeouts = 0
+        # moving average of request -> tickSnapshotEnd, seeds the budget check
+        self.avgSnapshotLatency = 2.
+
+    def _newReqId(self):
+        reqId = self._nextReqId
+        self._nextReqId += 1
+        return reqId
+
+    @property
+    def linesInUse(self):
+        return len(self.streaming) + len(self.inFlight)
+
+    def addInstrument(self, key, contract, tier: int):
+        """
+        Adds an instrument to the universe; tier 0 streams, other tiers rotate
+        """
+        if tier != STREAMING_TIER and tier not in self.tierMaxAge:
+            raise ValueError("no max age configured for tier %d" % tier)
+        with self._lock:
+            # a streaming instrument being replaced gives its line back
+            nStreaming = len(self.streaming) - (key in self.streaming)
+            if tier == STREAMING_TIER and nStreaming >= self.maxLines:
+                raise ValueError("streaming set already uses all %d lines" % self.maxLines)
+            if key in self.instruments:
+                self.removeInstrument(key)
+            inst = ScheduledInstrument(key, contract, tier)
+            self.instruments[key] = inst
+            self.quoteStore.addInstrument(key)
+            if tier == STREAMING_TIER:
+                self.streaming[key] = inst
+            else:
+                self._schedule(inst, self._clock())
+        return inst
+
+    def removeInstrument(self, key):
+        with self._lock:
+            inst = self.instruments.pop(key, None)
+            if inst is None:
+                return
+            inst.generation += 1
+            if self.streaming.pop(key, None) is not None and inst.streamReqId is not None:
+                self._cancel(inst.streamReqId)
+                inst.streamReqId = None
+            if inst.snapshotReqId is not None:
+                self._finishSnapshot(inst.snapshotReqId)
+
+    def checkBudget(self):
+        """
+        Logs a warning when the snapshot tiers cannot meet their max age with the
+        lines and message rate left after the streaming set
+        :return: (required snapshots per second, sustainable snapshots per second)
+        """
+        required = 0.
+        for inst in self.instruments.values():
+            if inst.tier != STREAMING_TIER:
+                required += 1. / self.tierMaxAge[inst.tier]
+        freeLines = self.maxLines - len(self.streaming)
+        # each snapshot holds its line until tickSnapshotEnd comes back
+        sustainable = min(self.throttle.rate, freeLines / self.avgSnapshotLatency)
+        if required > sustainable:
+            logging.warning("snapshot tiers need %.1f req/s but only %.1f req/s fit in "
+                            "%d free lines at %.1f msg/s", required, sustainable,
+                            freeLines, self.throttle.rate)
+        return required, sustainable
+
+    def _schedule(self, inst, due):
+        inst.generation += 1
+        heapq.heappush(self._dueHeap, (due, inst.tier, inst.generation, inst.key))
+
+    def _cancel(self, reqId):
+        self.throttle.acquire()
+        self.client.cancelMktData(reqId)
+        self.quoteStore.unbindReqId(reqId)
+        self.reqId2inst.pop(reqId, None)
+
+    def poll(self):
+        """
+        Subscribes pending streaming instruments, expires lost snapshots and sends
+        as many due snapshots as the free lines and the message rate allow
+        :return: number of messages sent
+        """
+        nSent = 0
+        with self._lock:
+            now = self._clock()
+            for inst in self.streaming.values():
+                if inst.streamReqId is None:
+                    if not self.throttle.tryAcquire():
+                        return nSent
+                    inst.streamReqId = self._newReqId()
+                    self.reqId2inst[inst.streamReqId] = inst
+                    self.quoteStore.bindReqId(inst.streamReqId, inst.key)
+                    self.client.reqMktData(inst.streamReqId, inst.contract, "", False, False, [])
+                    nSent += 1
+
+            for (reqId, inst) in list(self.inFlight.items()):
+                if now - inst.snapshotSent > self.snapshotTimeout:
+                    logging.debug("snapshot %d for %s timed out", reqId, inst.key)
+                    self.nTimeouts += 1
+                    self._finishSnapshot(reqId)
+
+            while self._dueHeap and self.linesInUse < self.maxLines:
+                (due, tier, generation, key) = self._dueHeap[0]
+                inst = self.instruments.get(key)
+                if inst is None or inst.generation != generation:
+                    heapq.heappop(self._dueHeap)
+                    continue
+                if due > now or not self.throttle.tryAcquire():
+                    break
+                heapq.heappop(self._dueHeap)
+                reqId = self._newReqId()
+                inst.snapshotReqId = reqId
+                inst.snapshotSent = now
+                self.inFlight[reqId] = inst
+                self.reqId2inst[reqId] = inst
+                self.quoteStore.bindReqId(reqId, key)
+                self.client.reqMktData(reqId, inst.contract, "", True, False, [])
+                self.nSnapshots += 1
+                nSent += 1
+        return nSent
+
+    def _finishSnapshot(self, reqId, completed: bool = False):
+        inst = self.inFlight.pop(reqId, None)
+        self.reqId2inst.pop(reqId, None)
+        self.quoteStore.unbindReqId(reqId)
+        if inst is None:
+            return
+        inst.snapshotReqId = None
+        if inst.key not in self.instruments:
+            return
+        maxAge = self.tierMaxAge[inst.tier]
+        if completed:
+            # ask again early enough for the answer to arrive before the values we
+            # just got reach the tier's max age
+            latency = inst.lastSnapshot - inst.snapshotSent
+            self.avgSnapshotLatency += 0.1 * (latency - self.avgSnapshotLatency)
+            self._schedule(inst, inst.lastSnapshot + max(0., maxAge - latency))
+        else:
+            # failed or lost snapshot: back off instead of looping on the same error
+            self._schedule(inst, self._clock() + min(maxAge, self.snapshotTimeout))
+
+    def tickSnapshotEnd(self, reqId: int):
+        """
+        To be called from the wrapper's tickSnapshotEnd
+        :return: True if the reqId belonged to this scheduler
+        """
+        with self._lock:
+            inst = self.inFlight.get(reqId)
+            if inst is None:
+                return False
+            inst.lastSnapshot = self._clock()
+            self._finishSnapshot(reqId, completed=True)
+        return True
+
+    def error(self, reqId: int, errorCode: int, errorString: str):
+        """
+        Frees the line of a snapshot that failed; the instrument is retried on schedule
+        """
+        with self._lock:
+            if reqId in self.inFlight:
+                logging.info("snapshot %d failed (%d): %s", reqId, errorCode, errorString)
+                self._finishSnapshot(reqId)
+                return True
+        return False
+
+    def freshnessReport(self, now: float = None):
+        """
+        :return: dict tier -> (instrument count, count within max age, worst age in seconds)
+        """
+        staleness = self.quoteStore.stalenessArray(now)
+        report = {}
+        for inst in self.instruments.values():
+            age = staleness[self.quoteStore.slotOf(inst.key)]
+            (count, fresh, worst) = report.get(inst.tier, (0, 0, 0.))
+            maxAge = self.tierMaxAge.get(inst.tier)
+            isFresh = maxAge is None or age <= maxAge
+            report[inst.tier] = (count + 1, fresh + int(isFresh), max(worst, age))
+        return report
+
+    def start(self, pollInterval: float = 0.05):
+        if self._thread is not None:
+            return
+        self.checkBudget()
+        self._running = True
+
+        def loop():
+            while self._running:
+                self.poll()
+                time.sleep(pollInterval)
+
+        self._thread = threading.Thread(target=loop, name="MarketDataLineScheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            for inst in self.streaming.values():
+                if inst.streamReqId is not None:
+                    self._cancel(inst.streamReqId)
+                    inst.streamReqId = None
@@ -0,0 +1,329 @@
+import collections
+import contextlib
+import logging
+import threading
+import time
+
+import numpy as np
+
+from ibapi.common import MarketDataTypeEnum
+from ibapi.ticktype import TickTypeEnum
+
+from QuoteStore import FIELDS, TICK_TO_FIELD
+from RateLimiter import TokenBucket
+
+REALTIME = MarketDataTypeEnum.REALTIME
+FROZEN = MarketDataTypeEnum.FROZEN
+DELAYED = MarketDataTypeEnum.DELAYED
+DELAYED_FROZEN = MarketDataTypeEnum.DELAYED_FROZEN
+# QuoteStore column holding the data type of every stored (slot, field), 0 until known
+DATA_TYPE_COLUMN = "DATA_TYPE"
+# best first: a frozen request gets live data while the market is open, and the
+# last recorded values once it is closed
+LADDER = (REALTIME, DELAYED)
+FROZEN_LADDER = (FROZEN, DELAYED_FROZEN)
+DELAYED_TICKS = {tickType for (name, tickType) in vars(TickTypeEnum).items()
+                 if name.startswith("DELAYED_")}
+
+# not entitled at the requested type: fall down the ladder
+NOT_SUBSCRIBED = {354, 10089}
+# another session holds the live data: fall down, live comes back later
+COMPETING_SESSION = {10186, 10197}
+# not entitled, IB falls back to delayed data by itself
+SHOWING_DELAYED = 10167
+# not entitled and delayed data is not enabled: nothing left to try
+DELAYED_NOT_ENABLED = 10168
+# the request failed for good: max tickers reached, no security definition, rejected
+REQUEST_FAILED = {101, 200, 321, 322}
+
+
+def entitlementKey(contract):
+    """
+    What market data permissions apply to: instruments of the same type, venue and
+    currency share them, so one failure starts the next subscription one rung down
+    """
+    if not contract.secType:
+        return str(contract.conId)
+    return "/".join((contract.secType, contract.primaryExchange or contract.exchange,
+                     contract.currency))
+
+
+class Subscription(object):
+    def __init__(self, reqId: int, contract, args: tuple, key: str, level: int):
+        self.reqId = reqId
+        self.contract = contract
+        self.args = args
+        self.key = key
+        # rung of the ladder requested, and the type IB says it sends
+        self.level = level
+        self.dataType = 0
+        self.failed = False
+
+
+class EntitlementState(object):
+    def __init__(self, retryAfter: float):
+        self.level = 0
+        self.retryAt = 0.
+        self.retryAfter = retryAfter
+
+
+class MarketDataTypeManager(object):
+    """
+    Requests every subscription at the best data type the account gets for it
+    reqMarketDataType is a session setting applying to the requests that follow,
+    so it is sent just before each request that needs a different type than the
+    last one. Entitlement errors move the subscription (and the others on the same
+    entitlement) one rung down the ladder and resubscribe; downgraded entitlements
+    are tried one rung up again after retryAfter seconds, doubling on every new
+    failure up to maxRetryAfter, so mixed entitlements settle without looping.
+    An explicit reqMarketDataType from the application is kept as the best type
+    requested from then on. Requests go out inside sending(), which holds the
+    session type until they are sent. Snapshots are not tracked, only sent at the
+    type of their entitlement, and requests that fail for good are untracked.
+    Resubscriptions are sent from the poll thread started with start(), paced by
+    the throttle.
+    Every stored tick is tagged with the data type of its subscription.
+    """
+
+    def __init__(self, client, quoteStore, allowFrozen: bool = True, retryAfter: float = 1800.,
+                 maxRetryAfter: float = 6 * 3600., maxMsgRate: float = 40.,
+                 throttle: TokenBucket = None, clock=time.monotonic):
+        """
+        :param throttle: the application's shared TokenBucket, when other requests
+        go out on the same connection; maxMsgRate is then ignored
+        """
+        self.client = client
+        self.quoteStore = quoteStore
+        self.ladder = FROZEN_LADDER if allowFrozen else LADDER
+        self.retryAfter = retryAfter
+        self.maxRetryAfter = maxRetryAfter
+        self._clock = clock
+        self.throttle = throttle if throttle is not None else TokenBucket(maxMsgRate)
+        self._lock = threading.RLock()
+        self._thread = None
+        self._running = False
+        self._wakeup = threading.Event()
+        # (subscription, cancel first) waiting to be sent again
+        self._resends = collections.deque()
+        quoteStore.addColumn(DATA_TYPE_COLUMN, np.int8, 0, width=len(FIELDS))
+        self.subscriptions = {}
+        self.entitlements = {}
+        # the type of the session, as last set through reqMarketDataType
+        self.sessionType = REALTIME
+        # rung no request goes above, set by an explicit reqMarketDataType
+        self.floor = 0
+        self._switching = False
+        self.nDowngrades = 0
+        self.nUpgrades = 0
+
+    def _entitlement(self, key):
+        state = self.entitlements.get(key)
+        if state is None:
+            state = self.entitlements[key] = EntitlementState(self.retryAfter)
+        return state
+
+    def _setType(self, dataType: int):
+        if dataType != self.sessionType:
+            self.throttle.acquire()
+            self._switching = True
+            try:
+                self.client.reqMarketDataType(dataType)
+            finally:
+                self._switching = False
+            self.sessionType = dataType
+
+    @contextlib.contextmanager
+    def sending(self, reqId: int = None, contract=None, args: tuple = (), track: bool = True):
+        """
+        Sets the session type a reqMktData should go out with and keeps it until the
+        request is sent in the with block; without a request, only keeps the
+        session type, for an explicit reqMarketDataType
+        A reqId still tracked is being resent (after a fallback or a reroute) and keeps
+        its subscription. Untracked requests (snapshots) go out at the type of their
+        entitlement.
+        """
+        with self._lock:
+            if reqId is not None:
+                sub = self.subscriptions.get(reqId)
+                if sub is not None:
+                    level = sub.level
+                else:
+                    key = entitlementKey(contract)
+                    level = max(self._entitlement(key).level, self.floor)
+                    if track:
+                        self.subscriptions[reqId] = Subscription(reqId, contract, args, key, level)
+                self._setType(self.ladder[level])
+            yield
+
+    def untrack(self, reqId: int):
+        with self._lock:
+            self.subscriptions.pop(reqId, None)
+
+    def reqMarketDataType(self, marketDataType: int):
+        """
+        Follows the session type. A type set by the application rather than by the
+        manager is respected: the ladder becomes the one holding it (frozen or not)
+        and it becomes the floor, so later requests never go out at a better type
+        """
+        self.sessionType = marketDataType
+        if self._switching:
+            return
+        with self._lock:
+            self.ladder = FROZEN_LADDER if marketDataType in FROZEN_LADDER else LADDER
+            self.floor = self.ladder.index(marketDataType)
+
+    def _resubscribe(self, sub, cancel: bool):
+        # called with the lock held: sent by _resend, once the lock is released
+        self._resends.append((sub, cancel))
+
+    def _flush(self):
+        if self._thread is not None:
+            self._wakeup.set()
+        else:
+            self._resend()
+
+    def _resend(self):
+        while True:
+            with self._lock:
+                if not self._resends:
+                    return
+                (sub, cancel) = self._resends.popleft()
+                if self.subscriptions.get(sub.reqId) is not sub:
+                    # cancelled or failed since
+                    continue
+            if cancel:
+                self.throttle.acquire()
+                self.client.cancelMktData(sub.reqId)
+                with self._lock:
+                    # cancelling untracks the request
+                    self.subscriptions[sub.reqId] = sub
+            self.throttle.acquire()
+            self.client.reqMktData(sub.reqId, sub.contract, *sub.args)
+
+    def _fail(self, sub):
+        sub.failed = True
+        self.subscriptions.pop(sub.reqId, None)
+
+    def _downgrade(self, sub):
+        state = self._entitlement(sub.key)
+        if sub.level + 1 >= len(self.ladder):
+            self._fail(sub)
+            logging.error("no market data type left for request %d (%s)", sub.reqId, sub.key)
+            return
+        if state.level <= sub.level:
+            state.level = sub.level + 1
+            if state.retryAt:
+                # a retry failed: wait longer before the next one
+                state.retryAfter = min(2 * state.retryAfter, self.maxRetryAfter)
+            state.retryAt = self._clock() + state.retryAfter
+        sub.level = state.level
+        self.nDowngrades += 1
+        logging.info("request %d (%s) falls back to market data type %d", sub.reqId, sub.key,
+                     self.ladder[sub.level])
+        self._resubscribe(sub, cancel=False)
+
+    def poll(self):
+        """
+        Retries the downgraded entitlements that are due one rung up
+        """
+        now = self._clock()
+        with self._lock:
+            for (key, state) in self.entitlements.items():
+                if state.level == 0 or now < state.retryAt:
+                    continue
+                state.level -= 1
+                state.retryAt = now + state.retryAfter
+                level = max(state.level, self.floor)
+                for sub in list(self.subscriptions.values()):
+                    if sub.key == key and sub.level > level and not sub.failed:
+                        sub.level = level
+                        self.nUpgrades += 1
+                        self._resubscribe(sub, cancel=True)
+        if self._thread is None or threading.current_thread() is not self._thread:
+            self._flush()
+
+    def start(self, pollInterval: float = 10.):
+        if self._thread is not None:
+            return
+        self._running = True
+        self._wakeup.clear()
+
+        def loop():
+            due = 0.
+            while self._running:
+                now = time.monotonic()
+                if now >= due:
+                    self.poll()
+                    due = now + pollInterval
+                self._resend()
+                self._wakeup.wait(max(0., due - time.monotonic()))
+                self._wakeup.clear()
+
+        self._thread = threading.Thread(target=loop, name="MarketDataTypeManager", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def dataTypeOf(self, reqId: int):
+        sub = self.subscriptions.get(reqId)
+        return 0 if sub is None else sub.dataType
+
+    ## callbacks
+    def marketDataType(self, reqId: int, marketDataType: int):
+        with self._lock:
+            sub = self.subscriptions.get(reqId)
+            if sub is None:
+                return
+            sub.dataType = marketDataType
+            state = self._entitlement(sub.key)
+            if sub.level == 0 and marketDataType not in (DELAYED, DELAYED_FROZEN):
+                # the entitlement holds at the top of the ladder again
+                state.retryAfter = self.retryAfter
+                state.retryAt = 0.
+
+    def error(self, reqId: int, errorCode: int, errorString: str):
+        """
+        :return: True if the error was an entitlement error of a tracked request
+        """
+        with self._lock:
+            sub = self.subscriptions.get(reqId)
+            if sub is None:
+                return False
+            if errorCode in NOT_SUBSCRIBED or errorCode in COMPETING_SESSION:
+                self._downgrade(sub)
+            elif errorCode == SHOWING_DELAYED:
+                # already delayed: start the next ones there instead of failing live first
+                state = self._entitlement(sub.key)
+                if state.level < len(self.ladder) - 1:
+                    state.level = len(self.ladder) - 1
+                    state.retryAt = self._clock() + state.retryAfter
+                sub.level = state.level
+            elif errorCode == DELAYED_NOT_ENABLED or errorCode in REQUEST_FAILED:
+                self._fail(sub)
+            else:
+                return False
+        if errorCode in NOT_SUBSCRIBED or errorCode in COMPETING_SESSION:
+            self._flush()
+        return errorCode not in REQUEST_FAILED
+
+    def _tag(self, reqId, tickType):
+        slot = self.quoteStore.reqId2slot.get(reqId, -1)
+        field = TICK_TO_FIELD.get(tickType)
+        if slot < 0 or field is None:
+            return
+        sub = self.subscriptions.get(reqId)
+        dataType = sub.dataType if sub is not None else 0
+        if tickType in DELAYED_TICKS and dataType not in (DELAYED, DELAYED_FROZEN):
+            dataType = DELAYED
+        self.quoteStore.columns[DATA_TYPE_COLUMN][slot, field] = dataType
+
+    def tickPrice(self, reqId: int, tickType: int, price: float, attrib=None):
+        self._tag(reqId, tickType)
+
+    def tickSize(self, reqId: int, tickType: int, size: int):
+        self._tag(reqId, tickType)
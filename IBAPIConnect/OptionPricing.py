@@ -0,0 +1,248 @@
+import datetime
+
+import numpy as np
+
+# vega is quoted per vol point and theta per calendar day, like tickOptionComputation
+VEGA_SCALE = 0.01
+THETA_SCALE = 1. / 365.
+DAYS_PER_YEAR = 365.
+MIN_VOL = 1e-4
+MAX_VOL = 5.
+SQRT_2PI = np.sqrt(2. * np.pi)
+
+
+def normPdf(x):
+    return np.exp(-0.5 * x * x) / SQRT_2PI
+
+
+def normCdf(x):
+    """
+    Cumulative normal to double precision (Hart's algorithm as given by West, 2005)
+    """
+    x = np.asarray(x, dtype=float)
+    z = np.abs(x)
+    e = np.exp(-0.5 * z * z)
+    num = ((((((0.0352624965998911 * z + 0.700383064443688) * z + 6.37396220353165) * z
+              + 33.912866078383) * z + 112.079291497871) * z + 221.213596169931) * z
+           + 220.206867912376)
+    den = (((((((0.0883883476483184 * z + 1.75566716318264) * z + 16.064177579207) * z
+               + 86.7807322029461) * z + 296.564248779674) * z + 637.333633378831) * z
+            + 793.826512519948) * z + 440.413735824752)
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        tail = np.where(z < 7.07106781186547, e * num / den,
+                        e / (z + 1. / (z + 2. / (z + 3. / (z + 4. / (z + 0.65))))) / 2.506628274631)
+    tail = np.where(z > 37., 0., tail)
+    return np.where(x > 0., 1. - tail, tail)
+
+
+def _d1d2(F, K, T, sigma):
+    sqrtT = np.sqrt(T)
+    volT = sigma * sqrtT
+    d1 = (np.log(F / K) + 0.5 * volT * volT) / volT
+    return d1, d1 - volT, sqrtT
+
+
+def blackPrice(isCall, F, K, T, sigma, df):
+    """
+    Black price of a European option on a forward F, discounted by df
+    All arguments broadcast, isCall is a boolean array (or scalar)
+    """
+    (d1, d2, _) = _d1d2(F, K, T, sigma)
+    call = df * (F * normCdf(d1) - K * normCdf(d2))
+    put = df * (K * normCdf(-d2) - F * normCdf(-d1))
+    return np.where(isCall, call, put)
+
+
+def black76(isCall, F, K, T, r, sigma):
+    """
+    Black-76 price and greeks of options on futures
+    :return: dict of arrays PRICE, DELTA, GAMMA, VEGA, THETA (delta/gamma w.r.t. F)
+    """
+    (isCall, F, K, T, sigma) = np.broadcast_arrays(isCall, np.asarray(F, float), K, T, sigma)
+    df = np.exp(-r * T)
+    (d1, d2, sqrtT) = _d1d2(F, K, T, sigma)
+    nd1 = normPdf(d1)
+    price = np.where(isCall, df * (F * normCdf(d1) - K * normCdf(d2)),
+                     df * (K * normCdf(-d2) - F * normCdf(-d1)))
+    delta = df * np.where(isCall, normCdf(d1), normCdf(d1) - 1.)
+    gamma = df * nd1 / (F * sigma * sqrtT)
+    vega = df * F * nd1 * sqrtT
+    theta = -df * F * nd1 * sigma / (2. * sqrtT) + r * price
+    return {"PRICE": price, "DELTA": delta, "GAMMA": gamma,
+            "VEGA": vega * VEGA_SCALE, "THETA": theta * THETA_SCALE}
+
+
+def blackScholes(isCall, S, K, T, r, sigma, q=0.):
+    """
+    Black-Scholes(-Merton) price and greeks of options on a spot with yield q
+    :return: dict of arrays PRICE, DELTA, GAMMA, VEGA, THETA
+    """
+    (isCall, S, K, T, sigma) = np.broadcast_arrays(isCall, np.asarray(S, float), K, T, sigma)
+    df = np.exp(-r * T)
+    dq = np.exp(-q * T)
+    F = S * dq / df
+    (d1, d2, sqrtT) = _d1d2(F, K, T, sigma)
+    nd1 = normPdf(d1)
+    (Nd1, Nd2, Nmd1, Nmd2) = (normCdf(d1), normCdf(d2), normCdf(-d1), normCdf(-d2))
+    price = np.where(isCall, S * dq * Nd1 - K * df * Nd2, K * df * Nmd2 - S * dq * Nmd1)
+    delta = dq * np.where(isCall, Nd1, Nd1 - 1.)
+    gamma = dq * nd1 / (S * sigma * sqrtT)
+    vega = S * dq * nd1 * sqrtT
+    decay = -S * dq * nd1 * sigma / (2. * sqrtT)
+    theta = np.where(isCall, decay - r * K * df * Nd2 + q * S * dq * Nd1,
+                     decay + r * K * df * Nmd2 - q * S * dq * Nmd1)
+    return {"PRICE": price, "DELTA": delta, "GAMMA": gamma,
+            "VEGA": vega * VEGA_SCALE, "THETA": theta * THETA_SCALE}
+
+
+def impliedVolBlack(price, isCall, F, K, T, df, tol: float = 1e-10, maxIter: int = 100):
+    """
+    Vectorized implied volatility on the Black forward formula
+    Newton steps are kept inside a [lo, hi] bracket that shrinks every iteration;
+    any step leaving the bracket (or with a vanishing vega) falls back to bisection,
+    so every option converges. Only unconverged options are iterated.
+    :return: array of implied vols, NaN where the price violates no-arbitrage bounds
+    """
+    (price, isCall, F, K, T, df) = [np.array(a, dtype=dt) for (a, dt) in zip(
+        np.broadcast_arrays(price, isCall, F, K, T, df),
+        (float, bool, float, float, float, float))]
+    intrinsic = df * np.where(isCall, np.maximum(F - K, 0.), np.maximum(K - F, 0.))
+    upper = df * np.where(isCall, F, K)
+    vol = np.full(price.shape, np.nan)
+    valid = (price > intrinsic) & (price < upper) & (T > 0.) & (F > 0.) & (K > 0.)
+    idx = np.flatnonzero(valid)
+    if len(idx) == 0:
+        return vol
+    (p, c, f, k, t, d) = (price.ravel()[idx], isCall.ravel()[idx], F.ravel()[idx],
+                          K.ravel()[idx], T.ravel()[idx], df.ravel()[idx])
+    lo = np.full(len(idx), MIN_VOL)
+    hi = np.full(len(idx), MAX_VOL)
+    # Brenner-Subrahmanyam start, good near the money
+    sigma = np.clip(np.sqrt(2. * np.pi / t) * p / (d * f), 0.05, 1.)
+    out = np.full(len(idx), np.nan)
+    active = np.arange(len(idx))
+    for _ in range(maxIter):
+        (d1, d2, sqrtT) = _d1d2(f, k, t, sigma)
+        diff = blackPrice(c, f, k, t, sigma, d) - p
+        done = np.abs(diff) <= tol * np.maximum(p, 1.)
+        out[active[done]] = sigma[done]
+        keep = ~done
+        if not keep.any():
+            break
+        (active, f, k, t, d, c, p) = (active[keep], f[keep], k[keep], t[keep], d[keep], c[keep], p[keep])
+        (sigma, diff, d1, sqrtT, lo, hi) = (sigma[keep], diff[keep], d1[keep], sqrtT[keep], lo[keep], hi[keep])
+        # price is increasing in vol, so the sign of diff tells which side to keep
+        hi = np.where(diff > 0., sigma, hi)
+        lo = np.where(diff > 0., lo, sigma)
+        vega = d * f * normPdf(d1) * sqrtT
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            step = sigma - diff / vega
+        bisect = ~np.isfinite(step) | (step <= lo) | (step >= hi)
+        sigma = np.where(bisect, 0.5 * (lo + hi), step)
+    else:
+        out[active] = sigma
+    vol.ravel()[idx] = out
+    return vol
+
+
+def impliedVolBlackScholes(price, isCall, S, K, T, r, q=0., **kwargs):
+    df = np.exp(-np.asarray(r) * T)
+    F = np.asarray(S, float) * np.exp(-np.asarray(q) * T) / df
+    return impliedVolBlack(price, isCall, F, K, T, df, **kwargs)
+
+
+def impliedVolBlack76(price, isCall, F, K, T, r, **kwargs):
+    return impliedVolBlack(price, isCall, F, K, T, np.exp(-np.asarray(r) * T), **kwargs)
+
+
+def yearFraction(expiries, now: datetime.datetime = None):
+    """
+    Time to expiry in years from IB's lastTradeDateOrContractMonth strings (YYYYMMDD)
+    Options are taken to expire at the end of their last trading day.
+    """
+    now = now or datetime.datetime.now()
+    expiries = np.atleast_1d(np.asarray(expiries, dtype=str))
+    days = np.array([(datetime.datetime.strptime(e[:8], "%Y%m%d") + datetime.timedelta(days=1)
+                      - now).total_seconds() / 86400. for e in expiries])
+    return np.maximum(days, 0.) / DAYS_PER_YEAR
+
+
+class OptionChainGrid(object):
+    """
+    Flat (expiry, strike, right) grid of one underlying's chain, as described by
+    securityDefinitionOptionParameter, ready to be priced in a single call
+    """
+
+    def __init__(self, expirations, strikes, rights=("C", "P"), now: datetime.datetime = None):
+        expirations = sorted(expirations)
+        strikes = sorted(float(s) for s in strikes)
+        grid = [(e, k, r) for e in expirations for k in strikes for r in rights]
+        self.expiries = np.array([g[0] for g in grid])
+        self.strikes = np.array([g[1] for g in grid])
+        self.isCall = np.array([g[2] == "C" for g in grid])
+        self.T = yearFraction(self.expiries, now) if grid else np.zeros(0)
+
+    def __len__(self):
+        return len(self.strikes)
+
+    def keys(self):
+        return list(zip(self.expiries.tolist(), self.strikes.tolist(),
+                        ["C" if c else "P" for c in self.isCall]))
+
+    def midPrices(self, quoteStore, keyOf=None):
+        """
+        Mid prices of the grid's options from the QuoteStore, NaN where either side
+        is missing
+        :param keyOf: maps an (expiry, strike, right) tuple to the QuoteStore key
+        """
+        keys = self.keys()
+        if keyOf is not None:
+            keys = [keyOf(key) for key in keys]
+        slots = np.array([quoteStore.slotOf(key) for key in keys], dtype=np.int64)
+        mid = np.full(len(keys), np.nan)
+        known = slots >= 0
+        bid = quoteStore.column("BID")[slots[known]]
+        ask = quoteStore.column("ASK")[slots[known]]
+        mid[known] = 0.5 * (bid + ask)
+        return mid
+
+    def impliedVols(self, prices, underPrice: float, r: float, q: float = 0., futures: bool = False):
+        if futures:
+            return impliedVolBlack76(prices, self.isCall, underPrice, self.strikes, self.T, r)
+        return impliedVolBlackScholes(prices, self.isCall, underPrice, self.strikes, self.T, r, q)
+
+    def greeks(self, vols, underPrice: float, r: float, q: float = 0., futures: bool = False):
+        if futures:
+            return black76(self.isCall, underPrice, self.strikes, self.T, r, vols)
+        return blackScholes(self.isCall, underPrice, self.strikes, self.T, r, vols, q)
+
+
+def contractImpliedVolatility(contract, optionPrice: float, underPrice: float, r: float,
+                              q: float = 0., now: datetime.datetime = None):
+    """
+    Local counterpart of EClient.calculateImpliedVolatility for one contract
+    """
+    T = yearFraction([contract.lastTradeDateOrContractMonth], now)
+    futures = contract.secType == "FOP"
+    if futures:
+        vol = impliedVolBlack76(optionPrice, contract.right.startswith("C"), underPrice,
+                                contract.strike, T, r)
+    else:
+        vol = impliedVolBlackScholes(optionPrice, contract.right.startswith("C"), underPrice,
+                                     contract.strike, T, r, q)
+    return float(vol[0])
+
+
+def contractOptionPrice(contract, volatility: float, underPrice: float, r: float,
+                        q: float = 0., now: datetime.datetime = None):
+    """
+    Local counterpart of EClient.calculateOptionPrice for one contract
+    :return: dict of PRICE and greeks as floats
+    """
+    T = yearFraction([contract.lastTradeDateOrContractMonth], now)
+    isCall = contract.right.startswith("C")
+    if contract.secType == "FOP":
+        result = black76(isCall, underPrice, contract.strike, T, r, volatility)
+    else:
+        result = blackScholes(isCall, underPrice, contract.strike, T, r, volatility, q)
+    return {name: float(value[0]) for (name, value) in result.items()}
@@ -0,0 +1,134 @@
+from OrderStore import ARCHIVE_FIELDS, PENDING_SUBMIT, TERMINAL
+from BasketOrders import BLOCKED, REJECTED
+
+# group kinds
+BRACKET = "BRACKET"
+OCA = "OCA"
+HEDGE = "HEDGE"
+# group states, from the members' statuses in the OrderStore
+PENDING = "Pending"
+ACTIVE = "Working"
+DONE = "Done"
+FAILED = "Rejected"
+
+_STATUS = ARCHIVE_FIELDS.index("status")
+_FILLED = ARCHIVE_FIELDS.index("filled")
+
+
+class GroupStatus(object):
+    def __init__(self, state: str, statuses, filled):
+        self.state = state
+        # orderId -> last status (None until known), orderId -> filled quantity
+        self.statuses = statuses
+        self.filled = filled
+
+    def __repr__(self):
+        return "GroupStatus(%s, %s)" % (self.state, self.statuses)
+
+
+class OrderGroup(object):
+    """
+    A parent and its children, or an OCA group, placed as one unit
+    Nothing is linked until the group is submitted: link() then numbers the orders
+    from one block of contiguous ids, parent first, sets the children's parentId,
+    the OCA group name and type, and the transmit flags. With a parent, every order
+    but the last one is sent with transmit False, so TWS holds the group until it
+    is complete and releases it at once; OCA members without a parent are
+    independent orders and are all transmitted.
+    """
+
+    def __init__(self, kind: str, parent=None, children=(), ocaGroup: str = None,
+                 ocaType: int = 0, ocaPrefix: str = "OCA_"):
+        """
+        :param parent: (contract, order), or None
+        :param children: list of (contract, order)
+        :param ocaGroup: OCA group name of the children, made from ocaPrefix and the
+        first order id if not given; only used if ocaType is set
+        """
+        if parent is None and not children:
+            raise ValueError("empty order group")
+        self.kind = kind
+        self.parent = parent
+        self.children = list(children)
+        self.ocaGroup = ocaGroup
+        self.ocaType = ocaType
+        self.ocaPrefix = ocaPrefix
+        self.orderIds = []
+        self.basket = None
+
+    @classmethod
+    def bracket(cls, contract, parent, takeProfit, stopLoss):
+        """
+        Orders as built by OrderSamples.BracketOrder, whatever ids they were given
+        """
+        return cls(BRACKET, (contract, parent), [(contract, takeProfit), (contract, stopLoss)])
+
+    @classmethod
+    def oca(cls, pairs, ocaType: int, ocaGroup: str = None, ocaPrefix: str = "OCA_"):
+        """
+        :param ocaType: 1 cancels the others with block, 2 reduces them with block,
+        3 reduces them without block
+        """
+        return cls(OCA, None, pairs, ocaGroup, ocaType, ocaPrefix)
+
+    @classmethod
+    def hedged(cls, contract, parent, hedgeContract, hedge):
+        """
+        A parent and its hedge order, e.g. OrderSamples.MarketFHedge
+        """
+        return cls(HEDGE, (contract, parent), [(hedgeContract, hedge)])
+
+    def __len__(self):
+        return len(self.children) + (self.parent is not None)
+
+    def pairs(self):
+        """
+        :return: (contract, order) in placement order, parent first
+        """
+        return ([self.parent] if self.parent is not None else []) + self.children
+
+    def link(self, firstId: int):
+        """
+        Numbers and links the orders, from firstId on
+        """
+        pairs = self.pairs()
+        self.orderIds = list(range(firstId, firstId + len(pairs)))
+        for (orderId, (contract, order)) in zip(self.orderIds, pairs):
+            order.orderId = orderId
+            order.transmit = self.parent is None
+        pairs[-1][1].transmit = True
+        for (contract, order) in self.children:
+            if self.parent is not None:
+                order.parentId = firstId
+            if self.ocaType:
+                order.ocaGroup = self.ocaGroup or "%s%d" % (self.ocaPrefix, firstId)
+                order.ocaType = self.ocaType
+
+    def status(self, orderStore, clientId: int = 0):
+        """
+        Status of the group from the OrderStore, archived members included: Rejected
+        if a member was rejected or the risk gate blocked the group, Pending until every member is acknowledged, Working
+        while a member works, Done once they are all terminal
+        """
+        (statuses, filled) = ({}, {})
+        for orderId in self.orderIds:
+            key = (clientId, orderId)
+            rec = orderStore.orders.get(key)
+            if rec is not None:
+                (statuses[orderId], filled[orderId]) = (rec.status, rec.filled)
+                continue
+            archived = orderStore.archive.get(key)
+            (statuses[orderId], filled[orderId]) = \
+                (archived[_STATUS], archived[_FILLED]) if archived is not None else (None, 0.)
+        values = statuses.values()
+        outcomes = self.basket.outcomes() if self.basket is not None else {}
+        rejected = outcomes.get(REJECTED) or outcomes.get(BLOCKED)
+        if rejected or "Inactive" in values:
+            state = FAILED
+        elif None in values or PENDING_SUBMIT in values:
+            state = PENDING
+        elif all(status in TERMINAL for status in values):
+            state = DONE
+        else:
+            state = ACTIVE
+        return GroupStatus(state, statuses, filled)
@@ -0,0 +1,74 @@
+import itertools
+import threading
+
+
+class OrderIdAllocator(object):
+    """
+    Hands out order ids from nextValidId, safely from any number of threads
+    Single ids come from an itertools.count, whose next() is atomic under the GIL,
+    so they take no lock. A block of n contiguous ids (bracket, OCA group, basket)
+    draws n ids in a row from the same counter and checks they are contiguous; if
+    another thread took one in between, the drawn ids are skipped (IB allows gaps)
+    and the block is drawn again. Block draws and resyncs are serialized with each
+    other, never with single ids. Ids are increasing in allocation order; IB wants
+    them increasing in placement order, which is up to whoever sends the orders.
+    """
+
+    def __init__(self, firstId: int = None):
+        self._ids = None if firstId is None else itertools.count(firstId)
+        self._lock = threading.Lock()
+        self.nSkipped = 0
+
+    @property
+    def seeded(self):
+        return self._ids is not None
+
+    def next(self):
+        ids = self._ids
+        if ids is None:
+            raise RuntimeError("no order id available before nextValidId")
+        return next(ids)
+
+    def reserve(self, n: int):
+        """
+        Reserves n contiguous ids
+        :return: the first one
+        """
+        if n < 1:
+            raise ValueError("cannot reserve %d order ids" % n)
+        with self._lock:
+            ids = self._ids
+            if ids is None:
+                raise RuntimeError("no order id available before nextValidId")
+            while True:
+                first = next(ids)
+                last = first
+                for _ in range(n - 1):
+                    last = next(ids)
+                if last - first == n - 1:
+                    return first
+                self.nSkipped += last - first + 1
+
+    def block(self, n: int):
+        """
+        :return: range of n contiguous ids
+        """
+        first = self.reserve(n)
+        return range(first, first + n)
+
+    def resync(self, nextValidId: int):
+        """
+        Follows a nextValidId (initial, or the answer to reqIds): the ids move up to
+        it if it is ahead, ids already handed out are never handed out again
+        """
+        with self._lock:
+            if self._ids is None:
+                self._ids = itertools.count(nextValidId)
+                return
+            # takes one id to compare, skipped if the counter moves up
+            current = next(self._ids)
+            if nextValidId > current:
+                self.nSkipped += nextValidId - current
+                self._ids = itertools.count(nextValidId)
+            else:
+                self.nSkipped += 1
@@ -0,0 +1,189 @@
+import collections
+import logging
+import threading
+import time
+
+from LatencyHistogram import LogHistogram, NS_PER_US
+
+# stages timed from the placeOrder send, the first time the order reaches them;
+# cancelAck is timed from the cancelOrder send, execDetails for every execution
+STATUS_STAGES = ("PreSubmitted", "Submitted", "Filled", "Cancelled")
+STAGES = ("openOrder",) + STATUS_STAGES + ("execDetails", "cancelAck")
+TERMINAL = {"Filled", "Cancelled", "ApiCancelled", "Inactive"}
+_STAGE_BIT = {stage: 1 << i for (i, stage) in enumerate(STAGES)}
+CSV_HEADER = "time,label,orderType,exchange,bucket,stage,count,mean,p50,p90,p99,p99.9,max,clamped"
+
+
+class TrackedOrder(object):
+    __slots__ = ("sentNs", "cancelNs", "key", "seen")
+
+    def __init__(self, sentNs: int, key):
+        self.sentNs = sentNs
+        self.cancelNs = 0
+        self.key = key
+        # bits of the stages already recorded
+        self.seen = 0
+
+
+class OrderLatencyTracker(object):
+    """
+    Latency histograms of the order lifecycle by order type, exchange and time of day
+    Every order sent is stamped; its first openOrder, the first time it reaches each
+    of PreSubmitted, Submitted, Filled and Cancelled, and each of its executions
+    are recorded in LogHistograms as the time elapsed since the send, and cancel
+    acknowledgements since the cancelOrder. Histograms are keyed by (orderType,
+    exchange, time of day bucket of the send, stage). Recording is a dict lookup, a
+    bit test and a histogram increment. The export carries a label (server
+    version, code version) so runs before and after an upgrade can be compared.
+    """
+
+    def __init__(self, bucketMinutes: int = 60, maxTracked: int = 100000, label: str = "",
+                 subBucketBits: int = 7, clock=time.monotonic_ns, wallClock=time.time):
+        self.bucketMinutes = bucketMinutes
+        self.maxTracked = maxTracked
+        self.label = label
+        self.subBucketBits = subBucketBits
+        self._clock = clock
+        self._wallClock = wallClock
+        self._lock = threading.Lock()
+        self.histograms = collections.defaultdict(self._newHistogram)
+        self.tracked = collections.OrderedDict()
+        self._thread = None
+        self._wakeup = threading.Event()
+        self.nUntracked = 0
+
+    def _newHistogram(self):
+        return LogHistogram(self.subBucketBits)
+
+    def _bucket(self):
+        local = time.localtime(self._wallClock())
+        minutes = local.tm_hour * 60 + local.tm_min
+        start = minutes - minutes % self.bucketMinutes
+        return "%02d:%02d" % divmod(start, 60)
+
+    ## requests
+    def placed(self, orderId: int, contract, order):
+        """
+        Stamps an order as it is sent; a modification restarts its stamps
+        """
+        key = (order.orderType, contract.exchange, self._bucket())
+        tracked = TrackedOrder(self._clock(), key)
+        with self._lock:
+            self.tracked[orderId] = tracked
+            self.tracked.move_to_end(orderId)
+            while len(self.tracked) > self.maxTracked:
+                self.tracked.popitem(last=False)
+
+    def cancelled(self, orderId: int):
+        tracked = self.tracked.get(orderId)
+        if tracked is not None:
+            tracked.cancelNs = self._clock()
+
+    def _record(self, orderId: int, stage: str, once: bool = True):
+        now = self._clock()
+        with self._lock:
+            tracked = self.tracked.get(orderId)
+            if tracked is None:
+                self.nUntracked += 1
+                return None
+            bit = _STAGE_BIT[stage]
+            if once and tracked.seen & bit:
+                return tracked
+            tracked.seen |= bit
+            start = tracked.cancelNs if stage == "cancelAck" else tracked.sentNs
+            self.histograms[tracked.key + (stage,)].record(now - start)
+            return tracked
+
+    ## callbacks
+    def openOrder(self, orderId: int, contract, order, orderState):
+        self._record(orderId, "openOrder")
+
+    def orderStatus(self, orderId: int, status: str, *args):
+        if status == "ApiCancelled":
+            status = "Cancelled"
+        if status in _STAGE_BIT:
+            tracked = self._record(orderId, status)
+            if status == "Cancelled" and tracked is not None and tracked.cancelNs:
+                self._record(orderId, "cancelAck")
+        if status in TERMINAL:
+            # late executions of a filled order are still recorded
+            if status != "Filled":
+                with self._lock:
+                    self.tracked.pop(orderId, None)
+
+    def execDetails(self, reqId: int, contract, execution):
+        if reqId == -1:
+            self._record(execution.orderId, "execDetails", once=False)
+
+    ## export
+    def snapshot(self, reset: bool = False):
+        """
+        :return: dict (orderType, exchange, bucket, stage) -> LogHistogram copy
+        """
+        with self._lock:
+            snap = {key: h.copy() for (key, h) in self.histograms.items()}
+            if reset:
+                for h in self.histograms.values():
+                    h.reset()
+        return snap
+
+    def byStage(self, *dimensions):
+        """
+        Histograms merged over everything but the given dimensions and the stage,
+        e.g. byStage("orderType")
+        :param dimensions: any of "orderType", "exchange", "bucket"
+        """
+        names = ("orderType", "exchange", "bucket")
+        kept = [names.index(name) for name in dimensions]
+        merged = {}
+        for (key, h) in self.snapshot().items():
+            mergedKey = tuple(key[i] for i in kept) + (key[-1],)
+            if mergedKey not in merged:
+                merged[mergedKey] = self._newHistogram()
+            merged[mergedKey].merge(h)
+        return merged
+
+    def dump(self, reset: bool = False, path: str = None):
+        """
+        Logs (or appends as CSV to path) one line per histogram, in microseconds
+        """
+        now = time.strftime("%Y%m%d %H:%M:%S")
+        lines = []
+        for (key, h) in sorted(self.snapshot(reset).items()):
+            if not h.total:
+                continue
+            s = h.summary(NS_PER_US)
+            lines.append("%s,%s,%s,%s,%s,%s,%d,%.1f,%.1f,%.1f,%.1f,%.1f,%.1f,%d" % (
+                (now, self.label) + key + (s["count"], s["mean"], s["p50"], s["p90"], s["p99"],
+                                           s["p99.9"], s["max"], s["clamped"])))
+        if path is not None:
+            with open(path, "a") as f:
+                if f.tell() == 0:
+                    f.write(CSV_HEADER + "\n")
+                for line in lines:
+                    f.write(line + "\n")
+        else:
+            for line in lines:
+                logging.info("order latency %s", line)
+        return lines
+
+    def startPeriodicDump(self, interval: float = 60., path: str = None):
+        """
+        Dumps and resets the histograms every interval seconds from a background thread
+        """
+        if self._thread is not None:
+            return
+        self._wakeup.clear()
+
+        def loop():
+            while not self._wakeup.wait(interval):
+                self.dump(reset=True, path=path)
+
+        self._thread = threading.Thread(target=loop, name="OrderLatencyDump", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
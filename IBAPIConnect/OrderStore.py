@@ -0,0 +1,344 @@
+import collections
+import logging
+import threading
+import time
+
+PENDING_SUBMIT = "PendingSubmit"
+# live orders, whatever stage they are at
+WORKING = {"PendingSubmit", "ApiPending", "PreSubmitted", "Submitted", "PendingCancel"}
+TERMINAL = {"Filled", "Cancelled", "ApiCancelled", "Inactive"}
+# status -> the statuses it may move to; statuses not listed may move anywhere. Anything
+# else is an update that arrived out of order, e.g. a Submitted after the Filled
+TRANSITIONS = {
+    "Filled": {"Filled"},
+    # a fill can race a cancel
+    "Cancelled": {"Cancelled", "Filled"},
+    "ApiCancelled": {"ApiCancelled", "Cancelled", "Filled"},
+}
+# fields of the archived orders, one tuple per order
+ARCHIVE_FIELDS = ("clientId", "orderId", "permId", "conId", "symbol", "account", "action",
+                  "totalQuantity", "status", "filled", "avgFillPrice", "commission", "updated")
+_COMMISSION = ARCHIVE_FIELDS.index("commission")
+
+
+class OrderRecord(object):
+    """
+    Everything known about one order: the last openOrder, orderStatus and its
+    executions and commissions
+    """
+    __slots__ = ("key", "clientId", "orderId", "permId", "parentId", "ocaGroup", "account",
+                 "conId", "symbol", "contract", "order", "orderState", "status", "filled",
+                 "remaining", "avgFillPrice", "lastFillPrice", "whyHeld", "executions",
+                 "commissions", "commission", "updated", "terminalSince")
+
+    def __init__(self, key, clientId: int, orderId: int):
+        self.key = key
+        self.clientId = clientId
+        self.orderId = orderId
+        self.permId = 0
+        self.parentId = 0
+        self.ocaGroup = ""
+        self.account = ""
+        self.conId = 0
+        self.symbol = ""
+        self.contract = None
+        self.order = None
+        self.orderState = None
+        self.status = None
+        self.filled = 0.
+        self.remaining = 0.
+        self.avgFillPrice = 0.
+        self.lastFillPrice = 0.
+        self.whyHeld = ""
+        # execId -> Execution, execId -> CommissionReport
+        self.executions = {}
+        self.commissions = {}
+        self.commission = 0.
+        self.updated = 0.
+        self.terminalSince = None
+
+    @property
+    def working(self):
+        return self.status in WORKING
+
+    def archived(self):
+        """
+        :return: the compact tuple kept once the order is archived, see ARCHIVE_FIELDS
+        """
+        order = self.order
+        return (self.clientId, self.orderId, self.permId, self.conId, self.symbol, self.account,
+                order.action if order is not None else "",
+                order.totalQuantity if order is not None else 0., self.status, self.filled,
+                self.avgFillPrice, self.commission, self.updated)
+
+
+class OrderStore(object):
+    """
+    Live order state merged from openOrder, orderStatus, execDetails and commissionReport
+    Orders are keyed by (clientId, orderId), or by permId for orders without an
+    API order id (placed from TWS), with secondary indexes by permId, conId,
+    account, parentId, OCA group and status kept up to date on every update, so
+    queries like "working orders for this conId" intersect index sets instead of
+    scanning. Status updates go through a transition table: late updates cannot
+    move an order back from a terminal status. Terminal orders are moved to a
+    bounded archive of compact tuples after archiveAfter seconds, which leaves time
+    for the executions and commissions that follow the final status. Executions
+    of archived orders only add their commission to the archived tuple, and
+    orders known from executions alone (reqExecutions replays) are archived the
+    same way as terminal ones unless a status comes.
+    """
+
+    def __init__(self, archiveAfter: float = 60., maxArchived: int = 100000,
+                 maxOrphans: int = 10000, clock=time.time):
+        self.archiveAfter = archiveAfter
+        self.maxArchived = maxArchived
+        self.maxOrphans = maxOrphans
+        self._clock = clock
+        self._lock = threading.RLock()
+        self.orders = {}
+        self.byPermId = {}
+        self.execId2key = {}
+        self.indexes = {name: collections.defaultdict(set)
+                        for name in ("conId", "account", "parentId", "ocaGroup", "status")}
+        self.archive = collections.OrderedDict()
+        # commission reports that came before their execution
+        self._orphanCommissions = collections.OrderedDict()
+        # execId -> [archive key, commission counted], executions of archived orders
+        self._archivedExecIds = collections.OrderedDict()
+        self._terminal = collections.deque()
+        self.nOutOfOrder = 0
+
+    def __len__(self):
+        return len(self.orders)
+
+    @staticmethod
+    def _key(clientId: int, orderId: int, permId: int):
+        return (clientId, orderId) if orderId else (None, permId)
+
+    def _record(self, clientId, orderId, permId):
+        key = self._key(clientId, orderId, permId)
+        rec = self.orders.get(key)
+        if rec is None and permId:
+            rec = self.byPermId.get(permId)
+        if rec is None:
+            rec = self.orders[key] = OrderRecord(key, clientId, orderId)
+            self.archive.pop(key, None)
+        if permId and not rec.permId:
+            rec.permId = permId
+            self.byPermId[permId] = rec
+        return rec
+
+    def _index(self, rec, name, value):
+        # unset values (0, "", None) are not indexed
+        old = getattr(rec, name)
+        if old == value:
+            return
+        index = self.indexes[name]
+        if old:
+            keys = index[old]
+            keys.discard(rec.key)
+            if not keys:
+                del index[old]
+        setattr(rec, name, value)
+        if value:
+            index[value].add(rec.key)
+
+    def _setStatus(self, rec, status: str):
+        if rec.status is not None and status != rec.status:
+            allowed = TRANSITIONS.get(rec.status)
+            if allowed is not None and status not in allowed:
+                self.nOutOfOrder += 1
+                logging.debug("order %s: ignoring %s after %s", rec.key, status, rec.status)
+                return
+        self._index(rec, "status", status)
+        if status in TERMINAL:
+            if rec.terminalSince is None:
+                rec.terminalSince = self._clock()
+                self._terminal.append(rec.key)
+        else:
+            rec.terminalSince = None
+
+    def _describe(self, rec, contract, order):
+        rec.contract = contract
+        rec.order = order
+        rec.symbol = contract.symbol
+        self._index(rec, "conId", contract.conId)
+        self._index(rec, "account", order.account)
+        self._index(rec, "parentId", order.parentId)
+        self._index(rec, "ocaGroup", order.ocaGroup)
+
+    ## local submissions
+    def placed(self, orderId: int, contract, order, clientId: int = 0):
+        """
+        Records an order as it is sent, PendingSubmit until TWS acknowledges it
+        """
+        with self._lock:
+            rec = self._record(clientId, orderId, 0)
+            self._describe(rec, contract, order)
+            if rec.status is None:
+                self._setStatus(rec, PENDING_SUBMIT)
+                rec.remaining = order.totalQuantity
+            rec.updated = self._clock()
+            return rec
+
+    ## callbacks
+    def openOrder(self, orderId: int, contract, order, orderState):
+        with self._lock:
+            rec = self._record(order.clientId, orderId, order.permId)
+            self._describe(rec, contract, order)
+            rec.orderState = orderState
+            if orderState.status:
+                self._setStatus(rec, orderState.status)
+            rec.updated = self._clock()
+            self._evict()
+
+    def orderStatus(self, orderId: int, status: str, filled: float, remaining: float,
+                    avgFillPrice: float, permId: int, parentId: int, lastFillPrice: float,
+                    clientId: int, whyHeld: str, mktCapPrice: float = None):
+        with self._lock:
+            rec = self._record(clientId, orderId, permId)
+            self._setStatus(rec, status)
+            # status messages are resent and can come out of order: fills only grow
+            if filled >= rec.filled:
+                (rec.filled, rec.remaining) = (filled, remaining)
+                (rec.avgFillPrice, rec.lastFillPrice) = (avgFillPrice, lastFillPrice)
+            rec.whyHeld = whyHeld
+            if parentId:
+                self._index(rec, "parentId", parentId)
+            rec.updated = self._clock()
+            self._evict()
+
+    def execDetails(self, reqId: int, contract, execution):
+        with self._lock:
+            key = self._key(execution.clientId, execution.orderId, execution.permId)
+            if key in self.archive and key not in self.orders:
+                # a late or replayed execution does not bring an archived order back
+                self._archivedExecution(key, execution.execId)
+                return
+            rec = self._record(execution.clientId, execution.orderId, execution.permId)
+            if rec.status is None and rec.terminalSince is None:
+                # known from its executions only (a reqExecutions replay, an order of an
+                # earlier session): archived like a finished order unless a status comes
+                rec.terminalSince = self._clock()
+                self._terminal.append(rec.key)
+            if rec.contract is None:
+                rec.contract = contract
+                rec.symbol = contract.symbol
+                self._index(rec, "conId", contract.conId)
+                self._index(rec, "account", execution.acctNumber)
+            rec.executions[execution.execId] = execution
+            self.execId2key[execution.execId] = rec.key
+            commission = self._orphanCommissions.pop(execution.execId, None)
+            if commission is not None:
+                self._addCommission(rec, commission)
+            rec.updated = self._clock()
+
+    def _addCommission(self, rec, commissionReport):
+        if commissionReport.execId not in rec.commissions:
+            rec.commission += commissionReport.commission
+        rec.commissions[commissionReport.execId] = commissionReport
+
+    def commissionReport(self, commissionReport):
+        with self._lock:
+            key = self.execId2key.get(commissionReport.execId)
+            rec = self.orders.get(key) if key is not None else None
+            if rec is not None:
+                self._addCommission(rec, commissionReport)
+                rec.updated = self._clock()
+                return
+            entry = self._archivedExecIds.get(commissionReport.execId)
+            if entry is not None:
+                self._addArchivedCommission(entry, commissionReport)
+                return
+            self._orphanCommissions[commissionReport.execId] = commissionReport
+            while len(self._orphanCommissions) > self.maxOrphans:
+                self._orphanCommissions.popitem(last=False)
+
+    ## archive
+    def _evict(self):
+        cutoff = self._clock() - self.archiveAfter
+        while self._terminal:
+            rec = self.orders.get(self._terminal[0])
+            if rec is not None and rec.terminalSince is not None and rec.terminalSince > cutoff:
+                break
+            self._terminal.popleft()
+            if rec is None or rec.terminalSince is None:
+                # gone already, or revived by a later status
+                continue
+            self._archive(rec)
+
+    def _archive(self, rec):
+        self.archive[rec.key] = rec.archived()
+        for name in self.indexes:
+            self._index(rec, name, None)
+        del self.orders[rec.key]
+        if rec.permId:
+            self.byPermId.pop(rec.permId, None)
+        for execId in rec.executions:
+            del self.execId2key[execId]
+            self._archivedExecution(rec.key, execId, execId in rec.commissions)
+        while len(self.archive) > self.maxArchived:
+            self.archive.popitem(last=False)
+
+    def _archivedExecution(self, key, execId: str, counted: bool = False):
+        if execId in self._archivedExecIds:
+            # replayed
+            return
+        entry = self._archivedExecIds[execId] = [key, counted]
+        while len(self._archivedExecIds) > self.maxOrphans:
+            self._archivedExecIds.popitem(last=False)
+        commission = self._orphanCommissions.pop(execId, None)
+        if commission is not None:
+            self._addArchivedCommission(entry, commission)
+
+    def _addArchivedCommission(self, entry, commissionReport):
+        (key, counted) = entry
+        archived = self.archive.get(key)
+        if counted or archived is None:
+            return
+        entry[1] = True
+        self.archive[key] = archived[:_COMMISSION] + \
+            (archived[_COMMISSION] + commissionReport.commission,) + archived[_COMMISSION + 1:]
+
+    def evict(self):
+        """
+        Archives the orders terminal for longer than archiveAfter
+        """
+        with self._lock:
+            self._evict()
+
+    ## queries
+    def get(self, clientId: int, orderId: int):
+        return self.orders.get((clientId, orderId))
+
+    def getByPermId(self, permId: int):
+        return self.byPermId.get(permId)
+
+    def select(self, **criteria):
+        """
+        Orders matching all the given index values, e.g. select(conId=..., status="Submitted")
+        :param criteria: conId, account, parentId, ocaGroup, status
+        """
+        with self._lock:
+            sets = sorted((self.indexes[name].get(value, ()) for (name, value) in criteria.items()),
+                          key=len)
+            if not sets:
+                return list(self.orders.values())
+            keys = set(sets[0]).intersection(*sets[1:])
+            return [self.orders[key] for key in keys]
+
+    def working(self, **criteria):
+        """
+        Working orders matching the given index values, e.g. working(conId=...)
+        """
+        with self._lock:
+            found = []
+            for status in WORKING:
+                found.extend(self.select(status=status, **criteria))
+            return found
+
+    def children(self, parentId: int):
+        return self.select(parentId=parentId)
+
+    def ocaMembers(self, ocaGroup: str):
+        return self.select(ocaGroup=ocaGroup)
@@ -0,0 +1,247 @@
+import copy
+import logging
+import struct
+import threading
+
+from ibapi.client import EClient
+from ibapi.comm import make_field, make_field_handle_empty, make_msg
+from ibapi.common import UNSET_DOUBLE
+from ibapi.errors import NOT_CONNECTED
+
+from RateLimiter import TokenBucket
+from RiskGate import describe
+
+# values the variable fields are probed with: distinct from each other and from
+# anything a real order carries
+PROBES = {"orderId": (987654321, 987654322), "totalQuantity": (123457.0, 123458.0),
+          "lmtPrice": (98765.4321, 98765.4322), "auxPrice": (98764.4321, 98764.4322)}
+# the stock encoder's ways of writing a variable field, see ibapi.comm and placeOrder
+FORMATS = (
+    lambda value: make_field(value)[:-1],
+    lambda value: make_field_handle_empty(value)[:-1],
+    lambda value: make_field(int(value))[:-1],
+    lambda value: make_field(value if value != UNSET_DOUBLE else 0)[:-1],
+)
+# test values telling the formats apart
+FORMAT_TESTS = (1.5, 7, 100.0, UNSET_DOUBLE)
+ORDER_ID_TESTS = (1, 7, 100)
+# stands for the variable fields while the fixed text is cut into chunks
+MARKER = "\x01"
+
+
+class TemplateMismatch(Exception):
+    pass
+
+
+class _Wrapper(object):
+    def error(self, reqId, errorCode: int, errorString: str):
+        raise TemplateMismatch("the stock encoder refused the order (%d): %s" % (errorCode, errorString))
+
+
+class StockEncoder(EClient):
+    """
+    EClient.placeOrder writing to a string instead of the socket
+    """
+
+    def __init__(self, serverVersion: int):
+        EClient.__init__(self, wrapper=_Wrapper())
+        self.serverVersion_ = serverVersion
+        self.connState = EClient.CONNECTED
+        self.msg = None
+
+    def isConnected(self):
+        return True
+
+    def sendMsg(self, msg):
+        self.msg = msg
+
+    def encode(self, orderId: int, contract, order):
+        """
+        :return: the message text placeOrder sends, without the length prefix
+        """
+        self.msg = None
+        self.placeOrder(orderId, contract, order)
+        return self.msg
+
+
+class OrderTemplate(object):
+    """
+    A placeOrder message of one (contract, order) encoded once, with its
+    variable fields (order id, quantity, price) patched in on every send
+    The message is first encoded by the stock encoder; each variable is then
+    changed alone to find the fields it writes, and the format of those fields is
+    matched against the stock encoder's. The fixed text between the variable fields
+    is kept as chunks, so encoding an order is a few string concatenations. The
+    template is refused if it cannot reproduce the stock encoder byte for byte.
+    """
+
+    def __init__(self, contract, order, serverVersion: int, price: str = "lmtPrice"):
+        """
+        :param price: the order's price field, "auxPrice" for stop orders, None
+        when the price never changes (market orders)
+        """
+        self.contract = contract
+        self.order = copy.copy(order)
+        self.serverVersion = serverVersion
+        self.price = price
+        self.variables = ("orderId", "totalQuantity") + ((price,) if price else ())
+        self.encoder = StockEncoder(serverVersion)
+        self._lock = threading.Lock()
+        (self.chunks, self.formats, self.slots) = self._compile()
+        self.verify(PROBES["orderId"][0] - 1, 1, 1.)
+
+    def _encode(self, values):
+        # stock encoding with the variables set
+        order = copy.copy(self.order)
+        for (name, value) in zip(self.variables[1:], values[1:]):
+            setattr(order, name, value)
+        with self._lock:
+            return self.encoder.encode(values[0], self.contract, order)
+
+    def _compile(self):
+        base = [PROBES[name][0] for name in self.variables]
+        fields = self._encode(base).split("\0")
+        # variable index -> field indexes it writes
+        positions = {}
+        for (v, name) in enumerate(self.variables):
+            probe = list(base)
+            probe[v] = PROBES[name][1]
+            changed = self._encode(probe).split("\0")
+            if len(changed) != len(fields):
+                raise TemplateMismatch("%s changes the layout of the message" % name)
+            for i in range(len(fields)):
+                if changed[i] != fields[i]:
+                    positions[i] = v
+            if v not in positions.values():
+                raise TemplateMismatch("%s is not in the message" % name)
+        formats = [self._format(v, min(i for (i, w) in positions.items() if w == v))
+                   for v in range(len(self.variables))]
+        # fixed text between the variable fields, separators included
+        for i in positions:
+            fields[i] = MARKER
+        chunks = "\0".join(fields).split(MARKER)
+        slots = [positions[i] for i in sorted(positions)]
+        return (chunks, formats, slots)
+
+    def _format(self, v, index):
+        base = [PROBES[name][0] for name in self.variables]
+        written = []
+        for value in (FORMAT_TESTS if v else ORDER_ID_TESTS):
+            probe = list(base)
+            probe[v] = value
+            written.append((value, self._encode(probe).split("\0")[index]))
+        for format in FORMATS:
+            try:
+                if all(format(value) == field for (value, field) in written):
+                    return format
+            except (TypeError, ValueError):
+                continue
+        raise TemplateMismatch("no known format for %s" % self.variables[v])
+
+    def text(self, orderId: int, quantity, price=None):
+        values = (orderId, quantity, price)
+        chunks = self.chunks
+        parts = [chunks[0]]
+        for (n, v) in enumerate(self.slots):
+            parts.append(self.formats[v](values[v]))
+            parts.append(chunks[n + 1])
+        return "".join(parts)
+
+    def encode(self, orderId: int, quantity, price=None):
+        """
+        :return: the full message, length prefix included
+        """
+        text = self.text(orderId, quantity, price).encode()
+        return struct.pack("!I", len(text)) + text
+
+    def stockEncode(self, orderId: int, quantity, price=None):
+        return make_msg(self._encode((orderId, quantity, price)[:len(self.variables)]))
+
+    def verify(self, orderId: int, quantity, price=None):
+        """
+        :raise TemplateMismatch: if the template and the stock encoder disagree
+        """
+        ours = self.encode(orderId, quantity, price)
+        stock = self.stockEncode(orderId, quantity, price)
+        if ours != stock:
+            raise TemplateMismatch("template encodes %r, the stock encoder %r" % (ours, stock))
+
+    def patched(self, orderId: int, quantity, price=None):
+        """
+        :return: a copy of the order as sent, for bookkeeping
+        """
+        order = copy.copy(self.order)
+        order.orderId = orderId
+        order.totalQuantity = quantity
+        if self.price:
+            setattr(order, self.price, price)
+        return order
+
+
+class OrderTemplates(object):
+    """
+    Templates by key, sending straight to the client's connection
+    Templates are made for the server version of the connection and dropped when
+    it changes. Every verifyEvery sends, the message is checked against the stock
+    encoder; a template that disagrees is dropped and the stock message sent.
+    Orders go through the risk gate, if any, then the throttle, as placeOrder's do.
+    """
+
+    def __init__(self, client, verifyEvery: int = 1000, maxMsgRate: float = 40.,
+                 throttle: TokenBucket = None, riskGate=None):
+        """
+        :param throttle: the application's shared TokenBucket, when other requests
+        go out on the same connection; maxMsgRate is then ignored
+        """
+        self.client = client
+        self.verifyEvery = verifyEvery
+        self.throttle = throttle if throttle is not None else TokenBucket(maxMsgRate)
+        self.riskGate = riskGate
+        self.templates = {}
+        self._serverVersion = None
+        self.nSent = 0
+        self.nMismatches = 0
+
+    def add(self, key, contract, order, price: str = "lmtPrice"):
+        """
+        :param key: anything identifying the (contract, fixed order fields) pair
+        :return: the OrderTemplate
+        """
+        serverVersion = self.client.serverVersion()
+        if serverVersion != self._serverVersion:
+            self.templates.clear()
+            self._serverVersion = serverVersion
+        template = self.templates[key] = OrderTemplate(contract, order, serverVersion, price)
+        return template
+
+    def get(self, key):
+        return self.templates.get(key)
+
+    def place(self, key, orderId: int, quantity, price=None):
+        """
+        Sends an order from the template of key
+        :return: RiskGate REASONS bits, 0 unless the risk gate blocked the order
+        """
+        template = self.templates[key]
+        if self.riskGate is not None:
+            order = template.patched(orderId, quantity, price)
+            reasons = int(self.riskGate.check([(template.contract, order)])[0])
+            if reasons:
+                logging.warning("order %d blocked by the risk gate: %s", orderId,
+                                ", ".join(describe(reasons)))
+                return reasons
+        if self.client.conn is None:
+            self.client.wrapper.error(orderId, NOT_CONNECTED.code(), NOT_CONNECTED.msg())
+            return 0
+        msg = template.encode(orderId, quantity, price)
+        self.nSent += 1
+        if self.verifyEvery and self.nSent % self.verifyEvery == 0:
+            stock = template.stockEncode(orderId, quantity, price)
+            if stock != msg:
+                self.nMismatches += 1
+                logging.error("order template %r disagrees with the stock encoder, dropped", key)
+                del self.templates[key]
+                msg = stock
+        self.throttle.acquire()
+        self.client.conn.sendMsg(msg)
+        return 0
@@ -0,0 +1,327 @@
+import collections
+import logging
+import threading
+import time
+
+import numpy as np
+
+from ibapi.common import UNSET_DOUBLE
+
+from FillStore import executionTime, multiplierOf
+from RiskGate import instrumentKey
+
+
+class PositionDiff(object):
+    """
+    One (account, instrument) on which the local book and IB disagree
+    """
+    __slots__ = ("account", "key", "symbol", "position", "reported", "avgCost", "reportedAvgCost")
+
+    def __init__(self, account: str, key, symbol: str, position: float, reported: float,
+                 avgCost: float, reportedAvgCost: float):
+        self.account = account
+        self.key = key
+        self.symbol = symbol
+        self.position = position
+        self.reported = reported
+        self.avgCost = avgCost
+        self.reportedAvgCost = reportedAvgCost
+
+    def __repr__(self):
+        return "PositionDiff(%s %s %s: %s vs IB %s, avg cost %.4f vs IB %.4f)" % (
+            self.account, self.key, self.symbol, self.position, self.reported,
+            self.avgCost, self.reportedAvgCost)
+
+
+class PositionEngine(object):
+    """
+    Positions, average costs and realized P&L per (account, instrument), from the fills
+    Every execution updates its slot as it arrives: fills in the direction of the
+    position move the average cost, fills against it realize P&L on the closed
+    quantity at the average cost, and a fill through zero opens the rest at its
+    price. Average costs follow IB's convention, price times multiplier, with the
+    commission of the opening quantity included; the commission of the closing
+    quantity is taken from the realized P&L. Executions replayed by reqExecutions
+    are dropped by execId, and so are those made before their slot last took
+    IB's position, which already counts them; replays never count as recent
+    fills. Slots are rows of aligned arrays (account, position,
+    avgCost, realized, ...) for vectorized risk, and every change is pushed to the
+    risk gate, so it sees positions at fill latency.
+    IB stays the book of record: on positionEnd the positions reported since the
+    last reconciliation (a local position not reported counting as flat) are
+    compared with the local ones and the differences reported; instruments filled
+    in the last settle seconds are skipped, as IB may not have counted their fill
+    yet, and with adopt the others take IB's values.
+    """
+
+    def __init__(self, riskGate=None, capacity: int = 1024, commissionInCost: bool = True,
+                 tolerance: float = 1e-6, costTolerance: float = 1e-4, settle: float = 5.,
+                 adopt: bool = True, maxExecIds: int = 1000000, clock=time.time):
+        """
+        :param commissionInCost: add opening commissions to the average cost as IB
+        does; the simulator leaves them out
+        :param costTolerance: relative average cost difference reported
+        """
+        self.riskGate = riskGate
+        self.commissionInCost = commissionInCost
+        self.tolerance = tolerance
+        self.costTolerance = costTolerance
+        self.settle = settle
+        self.adopt = adopt
+        self.maxExecIds = maxExecIds
+        self._clock = clock
+        self._lock = threading.RLock()
+        self.key2slot = {}
+        self.slot2key = []
+        self.symbols = []
+        self.accounts = []
+        self.account2id = {}
+        self.account = np.zeros(capacity, dtype=np.int32)
+        self.position = np.zeros(capacity)
+        self.avgCost = np.zeros(capacity)
+        self.multiplier = np.ones(capacity)
+        self.realized = np.zeros(capacity)
+        self.commission = np.zeros(capacity)
+        self.lastFill = np.zeros(capacity)
+        # when the slot last matched or took IB's position, in execution time
+        self.reconciled = np.zeros(capacity)
+        # execId -> (slot, opening quantity, closing quantity), until its commission
+        # comes; None for a replayed execution IB's position already counted
+        self._execIds = collections.OrderedDict()
+        self._orphanCommissions = collections.OrderedDict()
+        # IB's positions since the last reconciliation: (account, key) -> (position, avgCost)
+        self._reported = {}
+        self.diffs = []
+        self.nFills = 0
+        self.nDuplicates = 0
+        self.nSkipped = 0
+        self.nReconciliations = 0
+        self._thread = None
+        self._wakeup = threading.Event()
+
+    def __len__(self):
+        return len(self.slot2key)
+
+    @property
+    def capacity(self):
+        return self.position.shape[0]
+
+    def _grow(self):
+        n = self.capacity
+        self.account = np.concatenate([self.account, np.zeros(n, dtype=np.int32)])
+        for name in ("position", "avgCost", "realized", "commission", "lastFill",
+                     "reconciled"):
+            setattr(self, name, np.concatenate([getattr(self, name), np.zeros(n)]))
+        self.multiplier = np.concatenate([self.multiplier, np.ones(n)])
+
+    def slot(self, account: str, contract):
+        key = (account, instrumentKey(contract))
+        slot = self.key2slot.get(key)
+        if slot is not None:
+            return slot
+        with self._lock:
+            slot = self.key2slot.get(key)
+            if slot is None:
+                slot = len(self.slot2key)
+                if slot == self.capacity:
+                    self._grow()
+                accountId = self.account2id.get(account)
+                if accountId is None:
+                    accountId = self.account2id[account] = len(self.accounts)
+                    self.accounts.append(account)
+                self.account[slot] = accountId
+                self.multiplier[slot] = multiplierOf(contract)
+                self.slot2key.append(key)
+                self.symbols.append(contract.symbol)
+                self.key2slot[key] = slot
+            return slot
+
+    def _publish(self, slot: int):
+        if self.riskGate is not None:
+            (account, key) = self.slot2key[slot]
+            self.riskGate.setPosition(key, float(self.position[slot]), account)
+
+    ## callbacks
+    def execDetails(self, reqId: int, contract, execution):
+        with self._lock:
+            if execution.execId in self._execIds:
+                self.nDuplicates += 1
+                return
+            slot = self.slot(execution.acctNumber, contract)
+            if reqId != -1 and executionTime(execution.time)[0] <= self.reconciled[slot]:
+                # a replay of a fill the adopted position includes
+                self.nSkipped += 1
+                self._remember(execution.execId, None)
+                self._orphanCommissions.pop(execution.execId, None)
+                return
+            quantity = execution.shares if execution.side == "BOT" else -execution.shares
+            (opened, closed) = self._apply(slot, quantity, execution.price * self.multiplier[slot])
+            if reqId == -1:
+                self.lastFill[slot] = self._clock()
+            self.nFills += 1
+            self._remember(execution.execId, (slot, opened, closed))
+            commission = self._orphanCommissions.pop(execution.execId, None)
+            if commission is not None:
+                self._addCommission(commission)
+            self._publish(slot)
+
+    def _remember(self, execId: str, entry):
+        self._execIds[execId] = entry
+        while len(self._execIds) > self.maxExecIds:
+            self._execIds.popitem(last=False)
+
+    def _apply(self, slot: int, quantity: float, cost: float):
+        """
+        :return: (opened, closed) absolute quantities
+        """
+        position = self.position[slot]
+        closed = 0.
+        if position and (position > 0) != (quantity > 0):
+            closed = min(abs(quantity), abs(position))
+            self.realized[slot] += closed * (cost - self.avgCost[slot]) * (1 if position > 0 else -1)
+        after = position + quantity
+        opened = abs(quantity) - closed
+        if abs(after) <= self.tolerance:
+            (after, self.avgCost[slot]) = (0., 0.)
+        elif opened and closed:
+            # through zero: the rest opens at the fill price
+            self.avgCost[slot] = cost
+        elif opened:
+            self.avgCost[slot] = (self.avgCost[slot] * abs(position) + cost * opened) / abs(after)
+        self.position[slot] = after
+        return (opened, closed)
+
+    def _addCommission(self, commissionReport):
+        (slot, opened, closed) = self._execIds[commissionReport.execId]
+        commission = commissionReport.commission
+        if commission == UNSET_DOUBLE:
+            return
+        self.commission[slot] += commission
+        onOpened = commission * opened / (opened + closed) if opened + closed else 0.
+        position = abs(self.position[slot])
+        if self.commissionInCost and onOpened and position > self.tolerance:
+            self.avgCost[slot] += onOpened / position
+            self.realized[slot] -= commission - onOpened
+        else:
+            self.realized[slot] -= commission
+
+    def commissionReport(self, commissionReport):
+        with self._lock:
+            if commissionReport.execId in self._execIds:
+                if self._execIds[commissionReport.execId] is not None:
+                    self._addCommission(commissionReport)
+                return
+            self._orphanCommissions[commissionReport.execId] = commissionReport
+            while len(self._orphanCommissions) > self.maxExecIds:
+                self._orphanCommissions.popitem(last=False)
+
+    ## reconciliation
+    def reportPosition(self, account: str, contract, position: float, avgCost: float):
+        """
+        A position callback: IB's position, compared on the next reconcile
+        """
+        with self._lock:
+            slot = self.slot(account, contract)
+            self._reported[self.slot2key[slot]] = (position, avgCost)
+
+    def reconcile(self):
+        """
+        On positionEnd, compares the positions reported since the last reconciliation
+        with the local ones; with adopt, the replayed executions made until now no
+        longer count for the slots compared
+        :return: list of PositionDiff
+        """
+        with self._lock:
+            now = self._clock()
+            # execution times are parsed as local times at whole seconds
+            stamp = float(int(now))
+            diffs = []
+            # local positions IB did not report are flat for IB
+            for (slot, key) in enumerate(self.slot2key):
+                if key not in self._reported and self.position[slot]:
+                    self._reported[key] = (0., 0.)
+            for (key, (reported, reportedAvgCost)) in self._reported.items():
+                slot = self.key2slot[key]
+                if now - self.lastFill[slot] < self.settle:
+                    continue
+                position = float(self.position[slot])
+                avgCost = float(self.avgCost[slot])
+                costDiff = abs(avgCost - reportedAvgCost) > self.costTolerance * abs(reportedAvgCost)
+                if self.adopt:
+                    self.reconciled[slot] = stamp
+                if abs(position - reported) > self.tolerance or (reported and costDiff):
+                    diffs.append(PositionDiff(key[0], key[1], self.symbols[slot], position,
+                                              reported, avgCost, reportedAvgCost))
+                    if self.adopt:
+                        (self.position[slot], self.avgCost[slot]) = (reported, reportedAvgCost)
+                        self._publish(slot)
+            self._reported.clear()
+            self.diffs = diffs
+            self.nReconciliations += 1
+        for diff in diffs:
+            logging.warning("position reconciliation: %s", diff)
+        return diffs
+
+    def startPeriodicReconcile(self, client, interval: float = 300.):
+        """
+        Re-requests the positions every interval seconds from a background thread;
+        the wrapper's position and positionEnd callbacks have to be forwarded to
+        reportPosition and reconcile
+        """
+        if self._thread is not None:
+            return
+        self._wakeup.clear()
+
+        def loop():
+            while not self._wakeup.wait(interval):
+                client.cancelPositions()
+                client.reqPositions()
+
+        self._thread = threading.Thread(target=loop, name="PositionReconcile", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    ## queries
+    def get(self, account: str, contract):
+        """
+        :return: (position, avgCost, realized) of one slot
+        """
+        slot = self.key2slot.get((account, instrumentKey(contract)))
+        if slot is None:
+            return (0., 0., 0.)
+        return (float(self.position[slot]), float(self.avgCost[slot]), float(self.realized[slot]))
+
+    def arrays(self):
+        """
+        Views of the slot arrays, row i being slot2key[i]
+        :return: dict name -> array
+        """
+        n = len(self.slot2key)
+        return {"account": self.account[:n], "position": self.position[:n],
+                "avgCost": self.avgCost[:n], "multiplier": self.multiplier[:n],
+                "realized": self.realized[:n], "commission": self.commission[:n],
+                "lastFill": self.lastFill[:n]}
+
+    def unrealized(self, prices):
+        """
+        :param prices: market prices aligned with the slots, NaN when unknown
+        :return: unrealized P&L per slot
+        """
+        n = len(self.slot2key)
+        return self.position[:n] * (np.asarray(prices) * self.multiplier[:n] - self.avgCost[:n])
+
+    def net(self):
+        """
+        Positions summed over the accounts
+        :return: (instrument keys, positions)
+        """
+        with self._lock:
+            instruments = [key for (account, key) in self.slot2key]
+            index = {}
+            ids = np.array([index.setdefault(key, len(index)) for key in instruments], dtype=np.int64)
+            return (list(index), np.bincount(ids, self.position[:len(ids)], len(index)))
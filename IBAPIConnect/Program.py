@@ -37,6 +37,31 @@ from OrderSamples import OrderSamples
 from AvailableAlgoParams import AvailableAlgoParams
 from ScannerSubscriptionSamples import ScannerSubscriptionSamples
 from FaAllocationSamples import FaAllocationSamples
+from QuoteStore import QuoteStore
+from GreeksStore import GreeksStore
+import OptionPricing
+from TickJournal import TickJournalWriter
+from MarketDataScheduler import MarketDataLineScheduler
+from LatencyHistogram import TickLatencyMonitor
+from SharedMarketData import SharedMarketDataPublisher
+from DerivedStreams import DerivedStreamEngine
+from TickStringParser import TickStringParser
+from ComboQuotes import SyntheticComboEngine
+from MarketDataReroute import MarketDataRerouter, MKT_DATA, MKT_DEPTH
+from MarketDataType import MarketDataTypeManager
+from SnapshotService import SnapshotService
+from OrderIdAllocator import OrderIdAllocator
+from RateLimiter import TokenBucket
+from OrderStore import OrderStore
+from BasketOrders import BasketOrderEngine
+from OrderGroups import OrderGroup
+from OrderTemplates import OrderTemplates
+from ExchangeSimulator import ExchangeSimulator
+from OrderLatency import OrderLatencyTracker
+from FillStore import FillStore
+from PositionEngine import PositionEngine
+from RiskGate import RiskGate, describe, instrumentKey
+from VolSurface import VolSurface
 
 
 def SetupLogger():
@@ -195,10 +220,191 @@ class TestApp(TestWrapper, TestClient):
         self.nKeybInt = 0
         self.started = False
         self.nextValidOrderId = None
-        self.permId2ord = {}
+        self.orderIds = OrderIdAllocator()
+        # every order of the session, from placeOrder and the order callbacks
+        self.orders = OrderStore()
         self.reqId2nErr = collections.defaultdict(int)
         self.globalCancelOnly = False
         self.simplePlaceOid = None
+        self.quoteStore = QuoteStore()
+        # pre-trade checks, unlimited until limits are set
+        self.risk = RiskGate(self.quoteStore)
+        # one message rate budget for every component sending on the connection,
+        # under IB's 50 msg/s; a small burst lets polling senders use the whole rate
+        self.throttle = TokenBucket(40., burst=5)
+        # rate limited placement of many orders at once, behind the risk checks
+        self.baskets = BasketOrderEngine(self, self.orderIds, throttle=self.throttle,
+                                         riskGate=self.risk, placeOrder=self.sendOrder)
+        # preencoded placeOrder messages patched with id, quantity and price
+        self.orderTemplates = OrderTemplates(self, throttle=self.throttle, riskGate=self.risk)
+        # local matching of the orders against the live quotes instead of TWS
+        self.simulator = None
+        # place -> openOrder / status / execution latency histograms
+        self.orderLatency = OrderLatencyTracker()
+        # executions joined with their commissions, by day
+        self.fills = FillStore()
+        self.fillDirectory = None
+        # positions from the fills, reconciled against IB's on positionEnd
+        self.positions = PositionEngine(riskGate=self.risk)
+        self.greeksStore = GreeksStore()
+        # RTVolume, shortable and fundamental ratios parsed into quoteStore columns
+        self.tickStrings = TickStringParser(self.quoteStore)
+        # underlying -> VolSurface fed by the model computations of its options
+        self.volSurfaces = {}
+        # local pricing results kept to cross-check the server's calculations
+        self.reqId2localCalc = {}
+        self.tickJournal = None
+        self.mktDataScheduler = None
+        self.latencyMonitor = None
+        self.marketDataPublisher = None
+        self.derivedStreams = None
+        self.comboQuotes = None
+        # market data and depth requests, followed when IB reroutes them
+        self.reroutes = MarketDataRerouter(self)
+        # best available data type per subscription, with fallback on entitlement errors
+        self.dataTypes = MarketDataTypeManager(self, self.quoteStore, throttle=self.throttle)
+        # cached, coalesced and budgeted snapshots for any number of callers
+        self.snapshots = SnapshotService(self, self.quoteStore, throttle=self.throttle)
+
+    def reqMktData(self, reqId: TickerId, contract: Contract, genericTickList: str,
+                   snapshot: bool, regulatorySnapshot: bool, mktDataOptions: TagValueList):
+        if self.tickJournal is not None:
+            self.tickJournal.bindContract(reqId, contract)
+        if self.simulator is not None:
+            self.simulator.bindReqId(reqId, contract)
+        if contract.secType in ("OPT", "FOP") and contract.lastTradeDateOrContractMonth and \
+                contract.strike:
+            # the model computations of the option feed the surface of its underlying
+            surface = self.volSurfaces.get(contract.symbol)
+            if surface is None:
+                surface = self.volSurfaces[contract.symbol] = VolSurface(contract.symbol)
+            surface.bindReqId(reqId, contract.lastTradeDateOrContractMonth, contract.strike)
+        slot = self.quoteStore.reqId2slot.get(reqId)
+        if slot is not None:
+            # the risk gate finds the quotes of the contract under the QuoteStore key
+            self.risk.mapQuoteKey(instrumentKey(contract), self.quoteStore.slot2key[slot])
+        args = (genericTickList, snapshot, regulatorySnapshot, mktDataOptions)
+        # snapshots are not tracked: one that errors or times out would never be
+        # untracked. Known routes still apply
+        track = not (snapshot or regulatorySnapshot)
+        if track:
+            routed = self.reroutes.track(MKT_DATA, reqId, contract, args)
+        else:
+            routed = self.reroutes.route(MKT_DATA, contract)
+        # the rerouter resends holding its lock: it is taken before the data type one
+        with self.dataTypes.sending(reqId, contract, args, track):
+            super().reqMktData(reqId, routed, *args)
+
+    def cancelMktData(self, reqId: TickerId):
+        self.reroutes.untrack(MKT_DATA, reqId)
+        self.dataTypes.untrack(reqId)
+        super().cancelMktData(reqId)
+
+    def reqMarketDataType(self, marketDataType: int):
+        with self.dataTypes.sending():
+            self.dataTypes.reqMarketDataType(marketDataType)
+            super().reqMarketDataType(marketDataType)
+
+    def reqTickByTickData(self, reqId: int, contract: Contract, tickType: str):
+        if self.tickJournal is not None:
+            self.tickJournal.bindContract(reqId, contract)
+        super().reqTickByTickData(reqId, contract, tickType)
+
+    def reqMktDepth(self, reqId: TickerId, contract: Contract, numRows: int,
+                    mktDepthOptions: TagValueList):
+        if self.tickJournal is not None:
+            self.tickJournal.bindContract(reqId, contract)
+        contract = self.reroutes.track(MKT_DEPTH, reqId, contract, (numRows, mktDepthOptions))
+        super().reqMktDepth(reqId, contract, numRows, mktDepthOptions)
+
+    def placeOrder(self, orderId: OrderId, contract: Contract, order: Order):
+        """
+        Checked by the risk gate, then paced by the shared throttle
+        :return: RiskGate REASONS bits, 0 when the order was sent
+        """
+        reasons = self.riskCheck(orderId, contract, order)
+        if reasons:
+            return reasons
+        if self.simulator is None:
+            self.throttle.acquire()
+        self.sendOrder(orderId, contract, order)
+        return 0
+
+    def riskCheck(self, orderId: OrderId, contract: Contract, order: Order):
+        reasons = int(self.risk.check([(contract, order)])[0])
+        if reasons:
+            logging.warning("order %d blocked by the risk gate: %s", orderId,
+                            ", ".join(describe(reasons)))
+        return reasons
+
+    def sendOrder(self, orderId: OrderId, contract: Contract, order: Order):
+        """
+        placeOrder without the risk gate and the throttle, for the basket engine,
+        which applies both itself
+        """
+        self.orders.placed(orderId, contract, order, self.clientId)
+        self.orderLatency.placed(orderId, contract, order)
+        if self.simulator is not None:
+            self.simulator.placeOrder(orderId, contract, order)
+            return
+        super().placeOrder(orderId, contract, order)
+
+    def cancelOrder(self, orderId: OrderId):
+        self.orderLatency.cancelled(orderId)
+        if self.simulator is not None:
+            self.simulator.cancelOrder(orderId)
+            return
+        super().cancelOrder(orderId)
+
+    def reqGlobalCancel(self):
+        if self.simulator is not None:
+            self.simulator.reqGlobalCancel()
+            return
+        super().reqGlobalCancel()
+
+    def reqExecutions(self, reqId: int, execFilter: ExecutionFilter):
+        if self.simulator is not None:
+            self.simulator.reqExecutions(reqId, execFilter)
+            return
+        super().reqExecutions(reqId, execFilter)
+
+    def reqPositions(self):
+        if self.simulator is not None:
+            self.simulator.reqPositions()
+            return
+        super().reqPositions()
+
+    def cancelPositions(self):
+        # the simulator answers reqPositions once, there is no subscription to cancel
+        if self.simulator is None:
+            super().cancelPositions()
+
+    def placeTemplated(self, key, orderId: OrderId, quantity: float, price: float = None):
+        """
+        placeOrder from the order template of key, see OrderTemplates.add
+        :return: RiskGate REASONS bits, 0 when the order was sent
+        """
+        template = self.orderTemplates.get(key)
+        order = template.patched(orderId, quantity, price)
+        if self.simulator is not None:
+            return self.placeOrder(orderId, template.contract, order)
+        reasons = self.orderTemplates.place(key, orderId, quantity, price)
+        if reasons:
+            return reasons
+        self.orderLatency.placed(orderId, template.contract, order)
+        self.orders.placed(orderId, template.contract, order, self.clientId)
+        return 0
+
+    def cancelMktDepth(self, reqId: TickerId):
+        self.reroutes.untrack(MKT_DEPTH, reqId)
+        super().cancelMktDepth(reqId)
+
+    def reqRealTimeBars(self, reqId: TickerId, contract: Contract, barSize: int,
+                        whatToShow: str, useRTH: bool, realTimeBarsOptions: TagValueList):
+        if self.tickJournal is not None:
+            self.tickJournal.bindContract(reqId, contract)
+        super().reqRealTimeBars(reqId, contract, barSize, whatToShow, useRTH,
+                                realTimeBarsOptions)
 
     def dumpTestCoverageSituation(self):
         for clntMeth in sorted(self.clntMeth2callCount.keys()):
@@ -232,6 +438,7 @@ class TestApp(TestWrapper, TestClient):
 
         logging.debug("setting nextValidOrderId: %d", orderId)
         self.nextValidOrderId = orderId
+        self.orderIds.resync(orderId)
         # ! [nextvalidid]
 
         # we can start now
@@ -242,6 +449,8 @@ class TestApp(TestWrapper, TestClient):
             return
 
         self.started = True
+        self.dataTypes.start()
+        self.snapshots.start()
 
         if self.globalCancelOnly:
             print("Executing GlobalCancel only")
@@ -252,6 +461,10 @@ class TestApp(TestWrapper, TestClient):
             #self.marketDataType_req()
             #self.accountOperations_req()
             #self.tickDataOperations_req()
+            #self.mktDataScheduler_req()
+            #self.derivedStreams_req()
+            #self.comboQuotes_req()
+            #self.snapshotService_req()
             #self.marketDepthOperations_req()
             #self.realTimeBars_req()
             #self.historicalDataRequests_req()
@@ -281,9 +494,16 @@ class TestApp(TestWrapper, TestClient):
 
     def stop(self):
         print("Executing cancels")
+        self.dataTypes.stop()
+        self.snapshots.stop()
+        self.baskets.stop()
         self.orderOperations_cancel()
         self.accountOperations_cancel()
         self.tickDataOperations_cancel()
+        self.mktDataScheduler_cancel()
+        self.derivedStreams_cancel()
+        self.comboQuotes_cancel()
+        self.snapshotService_cancel()
         self.marketDepthOperations_cancel()
         self.realTimeBars_cancel()
         self.historicalDataRequests_cancel()
@@ -294,15 +514,18 @@ class TestApp(TestWrapper, TestClient):
         print("Executing cancels ... finished")
 
     def nextOrderId(self):
-        oid = self.nextValidOrderId
-        self.nextValidOrderId += 1
-        return oid
+        return self.orderIds.next()
 
     @iswrapper
     # ! [error]
     def error(self, reqId: TickerId, errorCode: int, errorString: str):
         super().error(reqId, errorCode, errorString)
         print("Error. Id: ", reqId, " Code: ", errorCode, " Msg: ", errorString)
+        self.dataTypes.error(reqId, errorCode, errorString)
+        self.snapshots.error(reqId, errorCode, errorString)
+        self.baskets.error(reqId, errorCode, errorString)
+        if self.mktDataScheduler is not None:
+            self.mktDataScheduler.error(reqId, errorCode, errorString)
 
     # ! [error] self.reqId2nErr[reqId] += 1
 
@@ -316,13 +539,14 @@ class TestApp(TestWrapper, TestClient):
     def openOrder(self, orderId: OrderId, contract: Contract, order: Order,
                   orderState: OrderState):
         super().openOrder(orderId, contract, order, orderState)
+        self.orderLatency.openOrder(orderId, contract, order, orderState)
         print("OpenOrder. ID:", orderId, contract.symbol, contract.secType,
               "@", contract.exchange, ":", order.action, order.orderType,
               order.totalQuantity, orderState.status)
         # ! [openorder]
 
-        order.contract = contract
-        self.permId2ord[order.permId] = order
+        self.orders.openOrder(orderId, contract, order, orderState)
+        self.baskets.openOrder(orderId, contract, order, orderState)
 
     @iswrapper
     # ! [openorderend]
@@ -331,7 +555,7 @@ class TestApp(TestWrapper, TestClient):
         print("OpenOrderEnd")
         # ! [openorderend]
 
-        logging.debug("Received %d openOrders", len(self.permId2ord))
+        logging.debug("Received %d openOrders", len(self.orders))
 
     @iswrapper
     # ! [orderstatus]
@@ -341,11 +565,17 @@ class TestApp(TestWrapper, TestClient):
                     whyHeld: str, mktCapPrice: float):
         super().orderStatus(orderId, status, filled, remaining,
                             avgFillPrice, permId, parentId, lastFillPrice, clientId, whyHeld, mktCapPrice)
+        self.orderLatency.orderStatus(orderId, status, filled, remaining, avgFillPrice, permId,
+                                      parentId, lastFillPrice, clientId, whyHeld, mktCapPrice)
         print("OrderStatus. Id: ", orderId, ", Status: ", status, ", Filled: ", filled,
               ", Remaining: ", remaining, ", AvgFillPrice: ", avgFillPrice,
               ", PermId: ", permId, ", ParentId: ", parentId, ", LastFillPrice: ",
               lastFillPrice, ", ClientId: ", clientId, ", WhyHeld: ",
               whyHeld, ", MktCapPrice: ", mktCapPrice)
+        self.orders.orderStatus(orderId, status, filled, remaining, avgFillPrice, permId,
+                                parentId, lastFillPrice, clientId, whyHeld, mktCapPrice)
+        self.baskets.orderStatus(orderId, status, filled, remaining, avgFillPrice, permId,
+                                 parentId, lastFillPrice, clientId, whyHeld, mktCapPrice)
 
     # ! [orderstatus]
 
@@ -518,6 +748,7 @@ class TestApp(TestWrapper, TestClient):
     def position(self, account: str, contract: Contract, position: float,
                  avgCost: float):
         super().position(account, contract, position, avgCost)
+        self.positions.reportPosition(account, contract, position, avgCost)
         print("Position.", account, "Symbol:", contract.symbol, "SecType:",
               contract.secType, "Currency:", contract.currency,
               "Position:", position, "Avg cost:", avgCost)
@@ -530,6 +761,8 @@ class TestApp(TestWrapper, TestClient):
     def positionEnd(self):
         super().positionEnd()
         print("PositionEnd")
+        for diff in self.positions.reconcile():
+            print("Position mismatch.", diff)
 
     # ! [positionend]
 
@@ -619,6 +852,7 @@ class TestApp(TestWrapper, TestClient):
     def marketDataType(self, reqId: TickerId, marketDataType: int):
         super().marketDataType(reqId, marketDataType)
         print("MarketDataType. ", reqId, "Type:", marketDataType)
+        self.dataTypes.marketDataType(reqId, marketDataType)
 
     # ! [marketdatatype]
 
@@ -643,6 +877,7 @@ class TestApp(TestWrapper, TestClient):
 
         # ! [reqmktdata_genticks]
         # Requesting RTVolume (Time & Sales), shortable and Fundamental Ratios generic ticks
+        self.quoteStore.bindReqId(1004, "IBKR")
         self.reqMktData(1004, ContractSamples.USStock(), "233,236,258", False, False, [])
         # ! [reqmktdata_genticks]
 
@@ -668,6 +903,7 @@ class TestApp(TestWrapper, TestClient):
 
         # ! [reqoptiondatagenticks]
         # Requesting data for an option contract will return the greek values
+        self.greeksStore.bindReqId(1002, "OptionWithLocalSymbol", multiplier=100.)
         self.reqMktData(1002, ContractSamples.OptionWithLocalSymbol(), "", False, False, [])
         # ! [reqoptiondatagenticks]
 
@@ -686,11 +922,104 @@ class TestApp(TestWrapper, TestClient):
         self.cancelMktData(1003)
         # ! [cancelmktdata]
 
+    @printWhenExecuting
+    def mktDataScheduler_req(self):
+        # Quoting more instruments than we have market data lines: the priority
+        # tier streams, the rest is refreshed through rotating snapshots
+        self.mktDataScheduler = MarketDataLineScheduler(self, self.quoteStore, maxLines=100,
+                                                        tierMaxAge={1: 5., 2: 60.},
+                                                        throttle=self.throttle)
+        self.mktDataScheduler.addInstrument("ES", ContractSamples.SimpleFuture(), 0)
+        self.mktDataScheduler.addInstrument("IBKR", ContractSamples.USStockAtSmart(), 0)
+        self.mktDataScheduler.addInstrument("IBM", ContractSamples.USStock(), 1)
+        self.mktDataScheduler.addInstrument("SIE", ContractSamples.EuropeanStock(), 2)
+        self.mktDataScheduler.addInstrument("EUR.GBP", ContractSamples.EurGbpFx(), 2)
+        self.mktDataScheduler.start()
+
+    @printWhenExecuting
+    def mktDataScheduler_cancel(self):
+        if self.mktDataScheduler is not None:
+            self.mktDataScheduler.stop()
+            print("Snapshot freshness by tier:", self.mktDataScheduler.freshnessReport())
+
+    @printWhenExecuting
+    def derivedStreams_req(self):
+        # VWAP, microprice, spread and signed volume computed once from the ticks,
+        # whoever reads them
+        self.quoteStore.bindReqId(19101, "IBKR")
+        self.quoteStore.bindReqId(19102, "IBKR")
+        self.quoteStore.bindReqId(19103, "IBKR")
+        self.derivedStreams = DerivedStreamEngine(quoteStore=self.quoteStore)
+        for name in ("VWAP", "MICROPRICE", "SPREAD", "SIGNED_VOLUME"):
+            self.derivedStreams.stream(name, "IBKR")
+        self.derivedStreams.stream("VWAP", "IBKR", source="rtVolume")
+        self.reqTickByTickData(19101, ContractSamples.USStockAtSmart(), "AllLast")
+        self.reqTickByTickData(19102, ContractSamples.USStockAtSmart(), "BidAsk")
+        # RTVolume (Time & Sales)
+        self.reqMktData(19103, ContractSamples.USStockAtSmart(), "233", False, False, [])
+
+    @printWhenExecuting
+    def derivedStreams_cancel(self):
+        if self.derivedStreams is not None:
+            self.cancelTickByTickData(19101)
+            self.cancelTickByTickData(19102)
+            self.cancelMktData(19103)
+            for ((name, slot, source), stream) in self.derivedStreams.streams.items():
+                print("Derived stream", name, self.quoteStore.slot2key[slot], source or "",
+                      "value:", stream.value)
+
+    @printWhenExecuting
+    def snapshotService_req(self):
+        # callers asking for the same quote within maxAge share one snapshot; the
+        # regulatory one is charged against the daily budget
+        for _ in range(10):
+            self.snapshots.request("IBKR", ContractSamples.USStock(), callback=self.snapshotReady)
+        self.snapshots.request("IBKR", ContractSamples.USStock(), regulatory=True,
+                               callback=self.snapshotReady)
+
+    def snapshotReady(self, key, snapshot):
+        if snapshot is None:
+            print("Snapshot of", key, "failed")
+        else:
+            print("Snapshot of", key, "regulatory:", snapshot.regulatory, "values:", snapshot.values)
+
+    @printWhenExecuting
+    def snapshotService_cancel(self):
+        print("Snapshot service metrics:", self.snapshots.metrics, "spent today:", self.snapshots.spent)
+
+    @printWhenExecuting
+    def comboQuotes_req(self):
+        # synthetic combo quotes from the legs' L1, every leg streamed once
+        self.comboQuotes = SyntheticComboEngine(self.quoteStore, self)
+        for name in ("StockComboContract", "FutureComboContract", "OptionComboContract",
+                     "InterCmdtyFuturesContract"):
+            self.comboQuotes.addCombo(name, getattr(ContractSamples, name)())
+        self.comboQuotes.start()
+
+    @printWhenExecuting
+    def comboQuotes_cancel(self):
+        if self.comboQuotes is not None:
+            self.comboQuotes.stop()
+            for key in self.comboQuotes.comboKeys:
+                print("Synthetic combo quote", key, self.comboQuotes.quote(key))
+
     @iswrapper
     # ! [tickprice]
     def tickPrice(self, reqId: TickerId, tickType: TickType, price: float,
                   attrib: TickAttrib):
         super().tickPrice(reqId, tickType, price, attrib)
+        if self.tickJournal is not None:
+            self.tickJournal.tickPrice(reqId, tickType, price, attrib)
+        self.quoteStore.updatePrice(reqId, tickType, price)
+        self.dataTypes.tickPrice(reqId, tickType, price, attrib)
+        if self.simulator is not None:
+            self.simulator.tickPrice(reqId, tickType, price, attrib)
+        if self.marketDataPublisher is not None:
+            self.marketDataPublisher.tickPrice(reqId, tickType, price, attrib)
+        if self.derivedStreams is not None:
+            self.derivedStreams.tickPrice(reqId, tickType, price, attrib)
+        if self.comboQuotes is not None:
+            self.comboQuotes.tickPrice(reqId, tickType, price, attrib)
         print("Tick Price. Ticker Id:", reqId, "tickType:", tickType,
               "Price:", price, "CanAutoExecute:", attrib.canAutoExecute,
               "PastLimit:", attrib.pastLimit, end=' ')
@@ -706,6 +1035,18 @@ class TestApp(TestWrapper, TestClient):
     # ! [ticksize]
     def tickSize(self, reqId: TickerId, tickType: TickType, size: int):
         super().tickSize(reqId, tickType, size)
+        if self.tickJournal is not None:
+            self.tickJournal.tickSize(reqId, tickType, size)
+        self.quoteStore.updateSize(reqId, tickType, size)
+        self.dataTypes.tickSize(reqId, tickType, size)
+        if self.simulator is not None:
+            self.simulator.tickSize(reqId, tickType, size)
+        if self.marketDataPublisher is not None:
+            self.marketDataPublisher.tickSize(reqId, tickType, size)
+        if self.derivedStreams is not None:
+            self.derivedStreams.tickSize(reqId, tickType, size)
+        if self.comboQuotes is not None:
+            self.comboQuotes.tickSize(reqId, tickType, size)
         print("Tick Size. Ticker Id:", reqId, "tickType:", tickType, "Size:", size)
 
     # ! [ticksize]
@@ -715,6 +1056,9 @@ class TestApp(TestWrapper, TestClient):
     # ! [tickgeneric]
     def tickGeneric(self, reqId: TickerId, tickType: TickType, value: float):
         super().tickGeneric(reqId, tickType, value)
+        if self.tickJournal is not None:
+            self.tickJournal.tickGeneric(reqId, tickType, value)
+        self.tickStrings.tickGeneric(reqId, tickType, value)
         print("Tick Generic. Ticker Id:", reqId, "tickType:", tickType, "Value:", value)
 
     # ! [tickgeneric]
@@ -724,6 +1068,14 @@ class TestApp(TestWrapper, TestClient):
     # ! [tickstring]
     def tickString(self, reqId: TickerId, tickType: TickType, value: str):
         super().tickString(reqId, tickType, value)
+        if self.tickJournal is not None:
+            self.tickJournal.tickString(reqId, tickType, value)
+        rtVolume = self.tickStrings.tickString(reqId, tickType, value)
+        if rtVolume is not None and self.derivedStreams is not None:
+            # the price is empty (NaN) on volume-only updates
+            (price, size) = rtVolume[:2]
+            if price == price and size > 0:
+                self.derivedStreams.rtVolume(reqId, price, size)
         print("Tick string. Ticker Id:", reqId, "Type:", tickType, "Value:", value)
 
     # ! [tickstring]
@@ -733,7 +1085,14 @@ class TestApp(TestWrapper, TestClient):
     # ! [ticksnapshotend]
     def tickSnapshotEnd(self, reqId: int):
         super().tickSnapshotEnd(reqId)
+        if self.tickJournal is not None:
+            self.tickJournal.tickSnapshotEnd(reqId)
         print("TickSnapshotEnd:", reqId)
+        # a snapshot ends its request
+        self.dataTypes.untrack(reqId)
+        self.snapshots.tickSnapshotEnd(reqId)
+        if self.mktDataScheduler is not None:
+            self.mktDataScheduler.tickSnapshotEnd(reqId)
 
     # ! [ticksnapshotend]
 
@@ -743,6 +1102,7 @@ class TestApp(TestWrapper, TestClient):
         super().rerouteMktDataReq(reqId, conId, exchange)
         print("Re-route market data request. Req Id: ", reqId,
               ", ConId: ", conId, " Exchange: ", exchange)
+        self.reroutes.rerouteMktDataReq(reqId, conId, exchange)
 
     # ! [rerouteMktDataReq]
 
@@ -781,6 +1141,13 @@ class TestApp(TestWrapper, TestClient):
                           specialConditions: str):
         super().tickByTickAllLast(reqId, tickType, time, price, size, attribs,
                                   exchange, specialConditions)
+        if self.tickJournal is not None:
+            self.tickJournal.tickByTickAllLast(reqId, tickType, time, price, size, attribs,
+                                               exchange, specialConditions)
+        if self.marketDataPublisher is not None:
+            self.marketDataPublisher.tickByTickAllLast(reqId, tickType, time, price, size)
+        if self.derivedStreams is not None:
+            self.derivedStreams.tickByTickAllLast(reqId, tickType, time, price, size)
         if tickType == 1:
             print("Last.", end='')
         else:
@@ -800,6 +1167,14 @@ class TestApp(TestWrapper, TestClient):
                          bidSize: int, askSize: int, attribs: TickAttrib):
         super().tickByTickBidAsk(reqId, time, bidPrice, askPrice, bidSize,
                                  askSize, attribs)
+        if self.tickJournal is not None:
+            self.tickJournal.tickByTickBidAsk(reqId, time, bidPrice, askPrice, bidSize,
+                                              askSize, attribs)
+        if self.marketDataPublisher is not None:
+            self.marketDataPublisher.tickByTickBidAsk(reqId, time, bidPrice, askPrice,
+                                                      bidSize, askSize)
+        if self.derivedStreams is not None:
+            self.derivedStreams.tickByTickBidAsk(reqId, time, bidPrice, askPrice, bidSize, askSize)
         print("BidAsk. Req Id: ", reqId,
               " Time: ", datetime.datetime.fromtimestamp(time).strftime("%Y%m%d %H:%M:%S"),
               " BidPrice: ", bidPrice, " AskPrice: ", askPrice, " BidSize: ", bidSize,
@@ -813,6 +1188,10 @@ class TestApp(TestWrapper, TestClient):
     @iswrapper
     def tickByTickMidPoint(self, reqId: int, time: int, midPoint: float):
         super().tickByTickMidPoint(reqId, time, midPoint)
+        if self.tickJournal is not None:
+            self.tickJournal.tickByTickMidPoint(reqId, time, midPoint)
+        if self.marketDataPublisher is not None:
+            self.marketDataPublisher.tickByTickMidPoint(reqId, time, midPoint)
         print("Midpoint. Req Id: ", reqId,
               " Time: ", datetime.datetime.fromtimestamp(time).strftime("%Y%m%d %H:%M:%S"),
               " MidPoint: ", midPoint)
@@ -837,6 +1216,8 @@ class TestApp(TestWrapper, TestClient):
     def updateMktDepth(self, reqId: TickerId, position: int, operation: int,
                        side: int, price: float, size: int):
         super().updateMktDepth(reqId, position, operation, side, price, size)
+        if self.tickJournal is not None:
+            self.tickJournal.updateMktDepth(reqId, position, operation, side, price, size)
         print("UpdateMarketDepth. ", reqId, "Position:", position, "Operation:",
               operation, "Side:", side, "Price:", price, "Size", size)
 
@@ -849,6 +1230,9 @@ class TestApp(TestWrapper, TestClient):
                          operation: int, side: int, price: float, size: int):
         super().updateMktDepthL2(reqId, position, marketMaker, operation, side,
                                  price, size)
+        if self.tickJournal is not None:
+            self.tickJournal.updateMktDepthL2(reqId, position, marketMaker, operation, side,
+                                              price, size)
         print("UpdateMarketDepthL2. ", reqId, "Position:", position, "Operation:",
               operation, "Side:", side, "Price:", price, "Size", size)
 
@@ -857,9 +1241,10 @@ class TestApp(TestWrapper, TestClient):
     @iswrapper
     # ! [rerouteMktDepthReq]
     def rerouteMktDepthReq(self, reqId: int, conId: int, exchange: str):
-        super().rerouteMktDataReq(reqId, conId, exchange)
-        print("Re-route market data request. Req Id: ", reqId,
+        super().rerouteMktDepthReq(reqId, conId, exchange)
+        print("Re-route market depth request. Req Id: ", reqId,
               ", ConId: ", conId, " Exchange: ", exchange)
+        self.reroutes.rerouteMktDepthReq(reqId, conId, exchange)
     # ! [rerouteMktDepthReq]
 
     @printWhenExecuting
@@ -883,6 +1268,8 @@ class TestApp(TestWrapper, TestClient):
     def realtimeBar(self, reqId:TickerId, time:int, open:float, high:float,
                     low:float, close:float, volume:int, wap:float, count:int):
         super().realtimeBar(reqId, time, open, high, low, close, volume, wap, count)
+        if self.tickJournal is not None:
+            self.tickJournal.realtimeBar(reqId, time, open, high, low, close, volume, wap, count)
         print("RealTimeBars. ", reqId, ": time ", time, ", open: ",open,
               ", high: ", high, ", low: ", low, ", close: ", close, ", volume: ", volume,
               ", wap: ", wap, ", count: ", count)
@@ -1026,14 +1413,27 @@ class TestApp(TestWrapper, TestClient):
         self.calculateOptionPrice(5002, ContractSamples.OptionAtBOX(), 0.22, 85, [])
         # ! [calculateoptionprice]
 
+        # The same calculations done locally, the server's answers are compared
+        # against these in tickOptionComputation
+        self.reqId2localCalc[5001] = {"IMPLIED_VOL": OptionPricing.contractImpliedVolatility(
+            ContractSamples.OptionAtBOX(), 5, 85, r=0.)}
+        self.reqId2localCalc[5002] = OptionPricing.contractOptionPrice(
+            ContractSamples.OptionAtBOX(), 0.22, 85, r=0.)
+
         # Exercising options
         # ! [exercise_options]
         self.exerciseOptions(5003, ContractSamples.OptionWithTradingClass(), 1,
                              1, self.account, 1)
         # ! [exercise_options]
 
+        # Option market data: its model implied vols build self.volSurfaces["GOOG"]
+        self.reqMktData(5004, ContractSamples.USOptionContract(), "", False, False, [])
+
     @printWhenExecuting
     def optionsOperations_cancel(self):
+        self.cancelMktData(5004)
+        for surface in self.volSurfaces.values():
+            print("Vol surface", surface.underlying, "refit expiries:", surface.refit())
         # Canceling implied volatility
         self.cancelCalculateImpliedVolatility(5001)
         # Canceling option's price calculation
@@ -1070,10 +1470,18 @@ class TestApp(TestWrapper, TestClient):
                               gamma: float, vega: float, theta: float, undPrice: float):
         super().tickOptionComputation(reqId, tickType, impliedVol, delta,
                                       optPrice, pvDividend, gamma, vega, theta, undPrice)
+        self.greeksStore.tickOptionComputation(reqId, tickType, impliedVol, delta,
+                                               optPrice, pvDividend, gamma, vega, theta, undPrice)
+        for surface in self.volSurfaces.values():
+            surface.tickOptionComputation(reqId, tickType, impliedVol, delta,
+                                          optPrice, pvDividend, gamma, vega, theta, undPrice)
         print("TickOptionComputation. TickerId:", reqId, "tickType:", tickType,
               "ImpliedVolatility:", impliedVol, "Delta:", delta, "OptionPrice:",
               optPrice, "pvDividend:", pvDividend, "Gamma: ", gamma, "Vega:", vega,
               "Theta:", theta, "UnderlyingPrice:", undPrice)
+        localCalc = self.reqId2localCalc.pop(reqId, None)
+        if localCalc is not None:
+            print("TickOptionComputation. TickerId:", reqId, "local calculation:", localCalc)
 
     # ! [tickoptioncomputation]
 
@@ -1330,10 +1738,13 @@ class TestApp(TestWrapper, TestClient):
         # ! [ocasubmit]
         ocaOrders = [OrderSamples.LimitOrder("BUY", 1, 10), OrderSamples.LimitOrder("BUY", 1, 11),
                      OrderSamples.LimitOrder("BUY", 1, 12)]
-        OrderSamples.OneCancelsAll("TestOCA_" + self.nextValidOrderId, ocaOrders, 2)
-        for o in ocaOrders:
-            self.placeOrder(self.nextOrderId(), ContractSamples.USStock(), o)
-            # ! [ocasubmit]
+        # named TestOCA_<first order id> once the ids are reserved
+        group = OrderGroup.oca([(ContractSamples.USStock(), o) for o in ocaOrders], 2,
+                               ocaPrefix="TestOCA_")
+        self.baskets.submitGroup(group, callback=lambda basket: self.groupAcked(group))
+        # orders placed directly after this take higher ids: the group goes out first
+        group.basket.waitPlaced()
+        # ! [ocasubmit]
 
     def conditionSamples(self):
         # ! [order_conditioning_activate]
@@ -1362,29 +1773,57 @@ class TestApp(TestWrapper, TestClient):
         self.placeOrder(self.nextOrderId(), ContractSamples.EuropeanStock(), lmt)
         # ! [order_conditioning_cancel]
 
+    def templateSample(self):
+        # the message is encoded once; each order only patches id, quantity and price
+        self.orderTemplates.add("USStock/LMT/BUY", ContractSamples.USStock(),
+                                OrderSamples.LimitOrder("BUY", 1, 1))
+        for i in range(10):
+            self.placeTemplated("USStock/LMT/BUY", self.nextOrderId(), 100, 10 + 0.01 * i)
+
+    def basketSample(self):
+        # a rebalance: one block of ids, placed as fast as the message rate allows
+        orders = [(ContractSamples.USStock(), OrderSamples.LimitOrder("BUY", 1, 10 + 0.01 * i))
+                  for i in range(200)]
+        basket = self.baskets.submit(orders, callback=self.basketDone)
+        # orders placed directly after this take higher ids: the basket goes out first
+        basket.waitPlaced()
+
+    def basketDone(self, basket):
+        print("Basket of", len(basket), "orders done:", dict(basket.outcomes()))
+        for entry in basket.entries:
+            if entry.riskReasons:
+                print("Blocked:", entry.order.action, entry.order.totalQuantity,
+                      entry.contract.symbol, describe(entry.riskReasons))
+
     def bracketSample(self):
         # BRACKET ORDER
         # ! [bracketsubmit]
-        bracket = OrderSamples.BracketOrder(self.nextOrderId(), "BUY", 100, 30, 40, 20)
-        for o in bracket:
-            self.placeOrder(o.orderId, ContractSamples.EuropeanStock(), o)
-            self.nextOrderId()  # need to advance this we'll skip one extra oid, it's fine
-            # ! [bracketsubmit]
+        # the parent and its two children are numbered and linked on submission
+        group = OrderGroup.bracket(ContractSamples.EuropeanStock(),
+                                   *OrderSamples.BracketOrder(0, "BUY", 100, 30, 40, 20))
+        self.baskets.submitGroup(group, callback=lambda basket: self.groupAcked(group))
+        # orders placed directly after this take higher ids: the group goes out first
+        group.basket.waitPlaced()
+        # ! [bracketsubmit]
 
     def hedgeSample(self):
         # F Hedge order
         # ! [hedgesubmit]
         # Parent order on a contract which currency differs from your base currency
         parent = OrderSamples.LimitOrder("BUY", 100, 10)
-        parent.orderId = self.nextOrderId()
-        # Hedge on the currency conversion
-        hedge = OrderSamples.MarketFHedge(parent.orderId, "BUY")
-        # Place the parent first...
-        self.placeOrder(parent.orderId, ContractSamples.EuropeanStock(), parent)
-        # Then the hedge order
-        self.placeOrder(self.nextOrderId(), ContractSamples.EurGbpFx(), hedge)
+        # Hedge on the currency conversion, attached to the parent on submission
+        hedge = OrderSamples.MarketFHedge(0, "BUY")
+        # The parent goes first, the hedge order transmits both
+        group = OrderGroup.hedged(ContractSamples.EuropeanStock(), parent,
+                                  ContractSamples.EurGbpFx(), hedge)
+        self.baskets.submitGroup(group, callback=lambda basket: self.groupAcked(group))
+        # orders placed directly after this take higher ids: the group goes out first
+        group.basket.waitPlaced()
         # ! [hedgesubmit]
 
+    def groupAcked(self, group):
+        print("Order group", group.kind, group.orderIds, group.status(self.orders, self.clientId))
+
     def testAlgoSamples(self):
         # ! [algo_base_order]
         baseOrder = OrderSamples.LimitOrder("BUY", 1000, 1)
@@ -1625,6 +2064,10 @@ class TestApp(TestWrapper, TestClient):
                         OrderSamples.LimitOrder("SELL", 1, 50))
         # ! [order_submission]
 
+        #self.basketSample()
+
+        #self.templateSample()
+
         # ! [faorderoneaccount]
         faOrderOneAccount = OrderSamples.MarketOrder("BUY", 100)
         # Specify the Account Number directly
@@ -1774,8 +2217,12 @@ class TestApp(TestWrapper, TestClient):
     # ! [execdetails]
     def execDetails(self, reqId: int, contract: Contract, execution: Execution):
         super().execDetails(reqId, contract, execution)
+        self.orderLatency.execDetails(reqId, contract, execution)
         print("ExecDetails. ", reqId, contract.symbol, contract.secType, contract.currency,
               execution.execId, execution.orderId, execution.shares, execution.lastLiquidity)
+        self.orders.execDetails(reqId, contract, execution)
+        self.fills.execDetails(reqId, contract, execution)
+        self.positions.execDetails(reqId, contract, execution)
 
     # ! [execdetails]
 
@@ -1785,6 +2232,8 @@ class TestApp(TestWrapper, TestClient):
     def execDetailsEnd(self, reqId: int):
         super().execDetailsEnd(reqId)
         print("ExecDetailsEnd. ", reqId)
+        if self.fillDirectory is not None:
+            self.fills.save(self.fillDirectory)
 
     # ! [execdetailsend]
 
@@ -1796,6 +2245,9 @@ class TestApp(TestWrapper, TestClient):
         print("CommissionReport. ", commissionReport.execId, commissionReport.commission,
               commissionReport.currency, commissionReport.realizedPNL)
         # ! [commissionreport]
+        self.orders.commissionReport(commissionReport)
+        self.fills.commissionReport(commissionReport)
+        self.positions.commissionReport(commissionReport)
 
 
 def main():
@@ -1811,6 +2263,30 @@ def main():
     cmdLineParser.add_argument("-C", "--global-cancel", action="store_true",
                                dest="global_cancel", default=False,
                                help="whether to trigger a globalCancel req")
+    cmdLineParser.add_argument("-j", "--journal", action="store", type=str,
+                               dest="journal", default=None,
+                               help="file to record the market data callbacks to")
+    cmdLineParser.add_argument("-l", "--latency", action="store", type=str,
+                               dest="latency", default=None,
+                               help="csv file to dump the tick latency histograms to every minute")
+    cmdLineParser.add_argument("-s", "--shm", action="store", type=str,
+                               dest="shm", default=None,
+                               help="name of the shared memory segments to publish quotes and ticks to")
+    cmdLineParser.add_argument("-r", "--reroutes", action="store", type=str,
+                               dest="reroutes", default=None,
+                               help="json file of the market data reroutes seen, to pre-route on the next run")
+    cmdLineParser.add_argument("-o", "--order-latency", action="store", type=str,
+                               dest="order_latency", default=None,
+                               help="csv file to dump the order lifecycle latency histograms to every minute")
+    cmdLineParser.add_argument("-x", "--simulate-orders", action="store_true",
+                               dest="simulate_orders", default=False,
+                               help="match the orders locally against the live quotes instead of sending them")
+    cmdLineParser.add_argument("-f", "--fills", action="store", type=str,
+                               dest="fills", default=None,
+                               help="directory of the fill store, replayed incrementally on start")
+    cmdLineParser.add_argument("-P", "--reconcile-positions", action="store", type=float,
+                               dest="reconcile_positions", default=None,
+                               help="seconds between reconciliations of the local positions with IB's")
     args = cmdLineParser.parse_args()
     print("Using args", args)
     logging.debug("Using args %s", args)
@@ -1846,11 +2322,39 @@ def main():
         app = TestApp()
         if args.global_cancel:
             app.globalCancelOnly = True
+        if args.reroutes:
+            app.reroutes = MarketDataRerouter(app, args.reroutes)
+        if args.simulate_orders:
+            app.simulator = ExchangeSimulator(app)
+            # the simulator books its positions without commissions
+            app.positions.commissionInCost = False
+        if args.fills:
+            app.fills.load(args.fills)
+            app.fillDirectory = args.fills
+        if args.journal:
+            app.tickJournal = TickJournalWriter(args.journal)
+        if args.shm:
+            app.marketDataPublisher = SharedMarketDataPublisher(app.quoteStore, args.shm)
+        if args.latency:
+            # the stamping queue has to be in place before the reader thread starts
+            app.latencyMonitor = TickLatencyMonitor(app)
+            app.latencyMonitor.install()
+            app.latencyMonitor.startPeriodicDump(60, args.latency)
         # ! [connect]
         app.connect("127.0.0.1", args.port, clientId=0)
         # ! [connect]
         print("serverVersion:%s connectionTime:%s" % (app.serverVersion(),
                                                       app.twsConnectionTime()))
+        if args.order_latency:
+            # compares runs across gateway upgrades
+            app.orderLatency.label = "server%s" % app.serverVersion()
+            app.orderLatency.startPeriodicDump(60, args.order_latency)
+        if args.fills:
+            # only the executions after the last one stored
+            app.fills.replay(app, 10002)
+        if args.reconcile_positions:
+            app.reqPositions()
+            app.positions.startPeriodicReconcile(app, args.reconcile_positions)
 
         # ! [clientrun]
         app.run()
@@ -1860,6 +2364,19 @@ def main():
     finally:
         app.dumpTestCoverageSituation()
         app.dumpReqAnsErrSituation()
+        if app.tickJournal is not None:
+            app.tickJournal.close()
+        if app.marketDataPublisher is not None:
+            app.marketDataPublisher.close()
+        if app.latencyMonitor is not None:
+            app.latencyMonitor.stop()
+            app.latencyMonitor.dump(path=args.latency)
+        if args.order_latency:
+            app.orderLatency.stop()
+            app.orderLatency.dump(path=args.order_latency)
+        if args.fills:
+            app.fills.save(args.fills)
+        app.positions.stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,210 @@
+import threading
+import time
+
+import numpy as np
+
+from ibapi.ticktype import TickTypeEnum
+
+
+# L1 columns kept for every instrument, in storage order
+FIELDS = ("BID", "ASK", "LAST", "BID_SIZE", "ASK_SIZE", "LAST_SIZE",
+          "HIGH", "LOW", "CLOSE", "OPEN", "VOLUME")
+FIELD_INDEX = {name: idx for (idx, name) in enumerate(FIELDS)}
+
+# live and delayed tick types land in the same column
+TICK_TO_FIELD = {}
+for _name in FIELDS:
+    TICK_TO_FIELD[getattr(TickTypeEnum, _name)] = FIELD_INDEX[_name]
+    if hasattr(TickTypeEnum, "DELAYED_" + _name):
+        TICK_TO_FIELD[getattr(TickTypeEnum, "DELAYED_" + _name)] = FIELD_INDEX[_name]
+del _name
+
+
+class QuoteStore(object):
+    """
+    Columnar L1 quote store shared by every market data consumer
+    Each instrument owns one slot (row); each L1 field is a column. Ticks are routed
+    to a slot through the reqId bound to it, so streaming and rotating snapshot
+    requests for the same instrument write into the same row.
+    The reader thread is the only writer; other threads may read the arrays directly.
+    """
+
+    def __init__(self, capacity: int = 1024, clock=time.time):
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.key2slot = {}
+        self.slot2key = []
+        self.reqId2slot = {}
+        self.values = np.full((capacity, len(FIELDS)), np.nan)
+        # wall clock time of the last update per slot and per (slot, field)
+        self.updated = np.zeros(capacity)
+        self.fieldUpdated = np.zeros((capacity, len(FIELDS)))
+        # one (slot, field) dirty-bit array per conflating subscriber
+        self.dirtyMasks = {}
+        self._maskTuple = ()
+        self._nextMaskId = 0
+        # typed columns beyond the L1 fields, name -> array with one row per slot
+        self.columns = {}
+        self._columnFill = {}
+
+    def __len__(self):
+        return len(self.slot2key)
+
+    @property
+    def capacity(self):
+        return self.values.shape[0]
+
+    def _grow(self):
+        capacity = 2 * self.capacity
+        values = np.full((capacity, len(FIELDS)), np.nan)
+        values[:self.capacity] = self.values
+        updated = np.zeros(capacity)
+        updated[:self.capacity] = self.updated
+        fieldUpdated = np.zeros((capacity, len(FIELDS)))
+        fieldUpdated[:self.capacity] = self.fieldUpdated
+        for (maskId, mask) in list(self.dirtyMasks.items()):
+            grown = np.zeros((capacity, len(FIELDS)), dtype=bool)
+            grown[:mask.shape[0]] = mask
+            self.dirtyMasks[maskId] = grown
+        self._maskTuple = tuple(self.dirtyMasks.values())
+        for (name, column) in list(self.columns.items()):
+            self.columns[name] = self._resized(column, capacity, column.shape[1:], self._columnFill[name])
+        self.values, self.updated, self.fieldUpdated = values, updated, fieldUpdated
+
+    @staticmethod
+    def _filled(shape, fill, dtype):
+        # np.full does not broadcast a tuple fill into a structured dtype
+        column = np.empty(shape, dtype=dtype)
+        column[...] = fill
+        return column
+
+    @staticmethod
+    def _resized(column, capacity, trailing, fill):
+        grown = QuoteStore._filled((capacity,) + tuple(trailing), fill, column.dtype)
+        grown[tuple(slice(0, n) for n in column.shape)] = column
+        return grown
+
+    def addColumn(self, name: str, dtype=np.float64, fill=np.nan, width: int = None):
+        """
+        Registers a typed column (width > 1 makes it a matrix) that grows with the store
+        :return: the column array; look it up again in columns after the store grows
+        """
+        with self._lock:
+            if name not in self.columns:
+                shape = (self.capacity,) if width is None else (self.capacity, width)
+                self.columns[name] = self._filled(shape, fill, dtype)
+                self._columnFill[name] = fill
+            return self.columns[name]
+
+    def widenColumn(self, name: str, width: int):
+        with self._lock:
+            column = self.columns[name]
+            if width > column.shape[1]:
+                self.columns[name] = self._resized(column, column.shape[0], (width,), self._columnFill[name])
+            return self.columns[name]
+
+    def addInstrument(self, key):
+        """
+        Returns the slot of an instrument, allocating one the first time it is seen
+        :param key: any hashable instrument key, typically the conId
+        """
+        slot = self.key2slot.get(key)
+        if slot is not None:
+            return slot
+        with self._lock:
+            slot = self.key2slot.get(key)
+            if slot is None:
+                slot = len(self.slot2key)
+                if slot == self.capacity:
+                    self._grow()
+                self.slot2key.append(key)
+                self.key2slot[key] = slot
+        return slot
+
+    def addDirtyMask(self):
+        """
+        Registers a dirty-bit array that every subsequent update marks
+        :return: id to look the mask up in dirtyMasks (the array is replaced on growth)
+        """
+        with self._lock:
+            maskId = self._nextMaskId
+            self._nextMaskId += 1
+            self.dirtyMasks[maskId] = np.zeros(self.values.shape, dtype=bool)
+            self._maskTuple = tuple(self.dirtyMasks.values())
+        return maskId
+
+    def removeDirtyMask(self, maskId: int):
+        with self._lock:
+            self.dirtyMasks.pop(maskId, None)
+            self._maskTuple = tuple(self.dirtyMasks.values())
+
+    def slotOf(self, key):
+        return self.key2slot.get(key, -1)
+
+    def bindReqId(self, reqId: int, key):
+        slot = self.addInstrument(key)
+        self.reqId2slot[reqId] = slot
+        return slot
+
+    def unbindReqId(self, reqId: int):
+        return self.reqId2slot.pop(reqId, -1)
+
+    def updatePrice(self, reqId: int, tickType: int, price: float):
+        """
+        Stores a tickPrice value
+        :return: the slot updated, or -1 if the reqId or tick type is not tracked
+        """
+        slot = self.reqId2slot.get(reqId, -1)
+        field = TICK_TO_FIELD.get(tickType)
+        if slot < 0 or field is None:
+            return -1
+        # IB sends -1 for "no price" (e.g. a side of the book is empty); combos
+        # can legitimately trade at negative prices so only -1 itself is dropped
+        self._store(slot, field, np.nan if price == -1 else price)
+        return slot
+
+    def updateSize(self, reqId: int, tickType: int, size: int):
+        slot = self.reqId2slot.get(reqId, -1)
+        field = TICK_TO_FIELD.get(tickType)
+        if slot < 0 or field is None:
+            return -1
+        self._store(slot, field, size)
+        return slot
+
+    def _store(self, slot, field, value):
+        now = self._clock()
+        self.values[slot, field] = value
+        self.fieldUpdated[slot, field] = now
+        self.updated[slot] = now
+        # the value is written before the bit so a reader that sees the bit sees the value
+        for mask in self._maskTuple:
+            mask[slot, field] = True
+
+    def get(self, key, field: str):
+        slot = self.key2slot.get(key, -1)
+        if slot < 0:
+            return np.nan
+        return self.values[slot, FIELD_INDEX[field]]
+
+    def column(self, field: str):
+        """
+        :return: a view on one field for all allocated slots
+        """
+        return self.values[:len(self.slot2key), FIELD_INDEX[field]]
+
+    def staleness(self, key, now: float = None):
+        """
+        Seconds since the instrument was last updated, inf if it never was
+        """
+        slot = self.key2slot.get(key, -1)
+        if slot < 0 or self.updated[slot] == 0:
+            return np.inf
+        return (now if now is not None else self._clock()) - self.updated[slot]
+
+    def stalenessArray(self, now: float = None):
+        now = now if now is not None else self._clock()
+        updated = self.updated[:len(self.slot2key)]
+        return np.where(updated > 0, now - updated, np.inf)
+
+    def staleSlots(self, maxAge: float, now: float = None):
+        return np.flatnonzero(self.stalenessArray(now) > maxAge)
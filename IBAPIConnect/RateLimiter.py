@@ -0,0 +1,77 @@
+import threading
+import time
+
+
+class TokenBucket(object):
+    """
+    Token bucket used to keep outgoing API messages under IB's client message rate
+    The bucket holds at most `burst` tokens and refills at `rate` tokens per second
+    """
+
+    def __init__(self, rate: float, burst: float = None, clock=time.monotonic):
+        if rate <= 0:
+            raise ValueError("rate must be positive, got %r" % rate)
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else rate)
+        self._clock = clock
+        self._tokens = self.burst
+        self._last = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self._last
+        if elapsed > 0:
+            self._tokens = min(self.burst, self._tokens + elapsed * self.rate)
+            self._last = now
+
+    def available(self):
+        """
+        :return: number of whole tokens that can be taken right now
+        """
+        with self._lock:
+            self._refill(self._clock())
+            return int(self._tokens)
+
+    def tryAcquire(self, n: int = 1):
+        """
+        Takes n tokens if they are all available, never blocks
+        :return: True if the tokens were taken
+        """
+        with self._lock:
+            self._refill(self._clock())
+            if self._tokens >= n:
+                self._tokens -= n
+                return True
+            return False
+
+    def delayFor(self, n: int = 1):
+        """
+        :return: seconds until n tokens will be available, 0 if they are available now
+        """
+        with self._lock:
+            self._refill(self._clock())
+            missing = n - self._tokens
+            return 0.0 if missing <= 0 else missing / self.rate
+
+    def acquire(self, n: int = 1, timeout: float = None):
+        """
+        Blocks until n tokens have been taken or the timeout expires
+        :return: True if the tokens were taken
+        """
+        if n > self.burst:
+            raise ValueError("cannot take %d tokens from a bucket of %g" % (n, self.burst))
+        deadline = None if timeout is None else self._clock() + timeout
+        while True:
+            with self._lock:
+                now = self._clock()
+                self._refill(now)
+                if self._tokens >= n:
+                    self._tokens -= n
+                    return True
+                wait = (n - self._tokens) / self.rate
+            if deadline is not None:
+                remaining = deadline - self._clock()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+            time.sleep(wait)
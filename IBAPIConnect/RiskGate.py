@@ -0,0 +1,291 @@
+import collections
+import threading
+import time
+
+import numpy as np
+
+from ibapi.common import UNSET_DOUBLE
+
+from QuoteStore import FIELD_INDEX
+
+# rejection reasons, one bit each: an order can fail several checks
+OK = 0
+UNKNOWN_INSTRUMENT = 1
+FAT_FINGER = 2
+NOTIONAL = 4
+POSITION_LIMIT = 8
+PRICE_BAND = 16
+RATE = 32
+NO_REFERENCE_PRICE = 64
+REASONS = {UNKNOWN_INSTRUMENT: "UNKNOWN_INSTRUMENT", FAT_FINGER: "FAT_FINGER",
+           NOTIONAL: "NOTIONAL", POSITION_LIMIT: "POSITION_LIMIT", PRICE_BAND: "PRICE_BAND",
+           RATE: "RATE", NO_REFERENCE_PRICE: "NO_REFERENCE_PRICE"}
+
+# order types whose auxPrice is a trigger price; for the others (REL, PEG MKT,
+# PASSV REL, TRAIL, ...) it is an offset or an amount
+AUX_PRICE_TYPES = {"STP", "STP LMT", "STP PRT", "MIT", "LIT"}
+
+BID = FIELD_INDEX["BID"]
+ASK = FIELD_INDEX["ASK"]
+LAST = FIELD_INDEX["LAST"]
+
+
+def describe(reasons: int):
+    """
+    :return: names of the reasons set in a rejection code
+    """
+    return [name for (bit, name) in sorted(REASONS.items()) if reasons & bit]
+
+
+def instrumentKey(contract):
+    """
+    The conId, as QuoteStore slots are keyed, or symbol/secType/currency for
+    contracts described without one
+    """
+    if contract.conId:
+        return contract.conId
+    return "/".join((contract.symbol, contract.secType, contract.currency))
+
+
+def orderPrice(order):
+    """
+    Price an order would trade at: its limit, else its trigger price for stop and
+    if-touched orders, NaN (valued at the reference price) for the others
+    """
+    if order.lmtPrice != UNSET_DOUBLE and order.lmtPrice:
+        return order.lmtPrice
+    if order.orderType in AUX_PRICE_TYPES and order.auxPrice != UNSET_DOUBLE and order.auxPrice:
+        return order.auxPrice
+    return np.nan
+
+
+class RiskGate(object):
+    """
+    Pre-trade checks evaluated on a whole basket of orders at once
+    Limits, positions and reference prices live in arrays with one slot per
+    instrument, so a basket is checked with a handful of array operations:
+    order quantity (fat finger), order notional, projected position, distance to
+    the reference price (price band) and the number of orders accepted in the last
+    second. Orders in the same basket add up: the position check applies the
+    basket's earlier orders on the same instrument first (except those failing the
+    other checks), and only orders that increase the absolute position are held to
+    the limit. Every order gets a code
+    of REASONS bits, 0 when accepted. Reference prices are set explicitly or taken
+    from the QuoteStore mid (or last), found under the instrument key or the key
+    mapped with mapQuoteKey. Limits default to unlimited.
+    """
+
+    def __init__(self, quoteStore=None, capacity: int = 1024, maxOrderQty: float = np.inf,
+                 maxOrderNotional: float = np.inf, maxPosition: float = np.inf,
+                 priceBand: float = np.inf, maxOrdersPerSec: float = np.inf,
+                 requireReference: bool = False, allowUnknown: bool = True,
+                 clock=time.monotonic):
+        """
+        :param priceBand: largest relative distance of an order price to the reference
+        :param requireReference: reject orders on instruments without a reference price
+        :param allowUnknown: check orders on instruments never seen with the defaults
+        """
+        self.quoteStore = quoteStore
+        self.defaults = {"maxOrderQty": maxOrderQty, "maxOrderNotional": maxOrderNotional,
+                         "maxPosition": maxPosition, "priceBand": priceBand, "multiplier": 1.}
+        self.maxOrdersPerSec = maxOrdersPerSec
+        self.requireReference = requireReference
+        self.allowUnknown = allowUnknown
+        self._clock = clock
+        self._lock = threading.RLock()
+        self.key2slot = {}
+        self.slot2key = []
+        self.maxOrderQty = np.full(capacity, maxOrderQty)
+        self.maxOrderNotional = np.full(capacity, maxOrderNotional)
+        self.maxPosition = np.full(capacity, maxPosition)
+        self.priceBand = np.full(capacity, priceBand)
+        self.multiplier = np.ones(capacity)
+        self.position = np.zeros(capacity)
+        self.refPrice = np.full(capacity, np.nan)
+        # QuoteStore slot of every instrument, -1 if it has none
+        self.quoteSlot = np.full(capacity, -1, dtype=np.int64)
+        # instrument key -> QuoteStore key, for instruments quoted under another key
+        self.quoteKeys = {}
+        self._accountPositions = collections.defaultdict(dict)
+        # (time, number of orders accepted) of the last second
+        self._accepted = collections.deque()
+        self._nAccepted = 0
+        self.nChecked = 0
+        self.nRejected = 0
+
+    @property
+    def capacity(self):
+        return self.position.shape[0]
+
+    def _grow(self):
+        n = self.capacity
+        for name in ("maxOrderQty", "maxOrderNotional", "maxPosition", "priceBand", "multiplier"):
+            setattr(self, name, np.concatenate([getattr(self, name),
+                                                np.full(n, self.defaults[name])]))
+        self.position = np.concatenate([self.position, np.zeros(n)])
+        self.refPrice = np.concatenate([self.refPrice, np.full(n, np.nan)])
+        self.quoteSlot = np.concatenate([self.quoteSlot, np.full(n, -1, dtype=np.int64)])
+
+    def addInstrument(self, key):
+        slot = self.key2slot.get(key)
+        if slot is not None:
+            return slot
+        with self._lock:
+            slot = self.key2slot.get(key)
+            if slot is None:
+                slot = len(self.slot2key)
+                if slot == self.capacity:
+                    self._grow()
+                self.slot2key.append(key)
+                self.key2slot[key] = slot
+            return slot
+
+    def setLimits(self, key, maxOrderQty: float = None, maxOrderNotional: float = None,
+                  maxPosition: float = None, priceBand: float = None, multiplier: float = None):
+        slot = self.addInstrument(key)
+        for (name, value) in (("maxOrderQty", maxOrderQty), ("maxOrderNotional", maxOrderNotional),
+                              ("maxPosition", maxPosition), ("priceBand", priceBand),
+                              ("multiplier", multiplier)):
+            if value is not None:
+                getattr(self, name)[slot] = value
+
+    def setPosition(self, key, position: float, account: str = ""):
+        """
+        Position of one account; the gate checks the sum over the accounts
+        """
+        slot = self.addInstrument(key)
+        positions = self._accountPositions[key]
+        positions[account] = position
+        self.position[slot] = sum(positions.values())
+
+    def setReferencePrice(self, key, price: float):
+        """
+        Overrides the QuoteStore price of an instrument, NaN to use it again
+        """
+        self.refPrice[self.addInstrument(key)] = price
+
+    def mapQuoteKey(self, key, quoteKey):
+        """
+        Takes the reference price of an instrument from the QuoteStore row of quoteKey
+        """
+        if self.quoteKeys.get(key) == quoteKey:
+            return
+        with self._lock:
+            self.quoteKeys[key] = quoteKey
+            slot = self.key2slot.get(key)
+            if slot is not None:
+                self.quoteSlot[slot] = -1
+
+    def referencePrices(self, slots):
+        ref = self.refPrice[slots]
+        if self.quoteStore is None:
+            return ref
+        for slot in np.unique(slots[self.quoteSlot[slots] < 0]):
+            key = self.slot2key[slot]
+            quoteSlot = self.quoteStore.key2slot.get(self.quoteKeys.get(key, key))
+            if quoteSlot is not None:
+                self.quoteSlot[slot] = quoteSlot
+        quoteSlots = self.quoteSlot[slots]
+        known = quoteSlots >= 0
+        quotes = np.full((len(slots), 3), np.nan)
+        quotes[known] = self.quoteStore.values[quoteSlots[known]][:, [BID, ASK, LAST]]
+        mid = 0.5 * (quotes[:, 0] + quotes[:, 1])
+        mid = np.where(np.isnan(mid), quotes[:, 2], mid)
+        return np.where(np.isnan(ref), mid, ref)
+
+    def check(self, pairs):
+        """
+        :param pairs: (contract, order) of a basket
+        :return: int array of REASONS bits, one per order, 0 if accepted
+        """
+        n = len(pairs)
+        slots = np.empty(n, dtype=np.int64)
+        quantity = np.empty(n)
+        price = np.empty(n)
+        unknown = np.zeros(n, dtype=bool)
+        key2slot = self.key2slot
+        for (i, (contract, order)) in enumerate(pairs):
+            key = instrumentKey(contract)
+            slot = key2slot.get(key)
+            if slot is None:
+                unknown[i] = True
+                slot = self.addInstrument(key)
+            slots[i] = slot
+            quantity[i] = order.totalQuantity if order.action == "BUY" else -order.totalQuantity
+            price[i] = orderPrice(order)
+        return self.checkArrays(slots, quantity, price, None if self.allowUnknown else unknown)
+
+    def checkArrays(self, slots, quantity, price, unknown=None):
+        """
+        Vectorized checks
+        :param slots: instrument slots
+        :param quantity: signed order quantities, negative when selling
+        :param price: order prices, NaN for market orders
+        :param unknown: mask of the orders to reject as UNKNOWN_INSTRUMENT
+        :return: int array of REASONS bits
+        """
+        with self._lock:
+            return self._check(slots, quantity, price, unknown)
+
+    def _check(self, slots, quantity, price, unknown):
+        n = len(slots)
+        reasons = np.zeros(n, dtype=np.int64)
+        if n == 0:
+            return reasons
+        if unknown is not None:
+            reasons[unknown] |= UNKNOWN_INSTRUMENT
+        ref = self.referencePrices(slots)
+        size = np.abs(quantity)
+        reasons[size > self.maxOrderQty[slots]] |= FAT_FINGER
+
+        noRef = np.isnan(ref)
+        if self.requireReference:
+            reasons[noRef] |= NO_REFERENCE_PRICE
+        band = self.priceBand[slots]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            outside = np.abs(price - ref) > band * ref
+        reasons[outside] |= PRICE_BAND
+
+        # market orders are valued at the reference price
+        valued = np.where(np.isnan(price), ref, price)
+        notional = size * np.abs(valued) * self.multiplier[slots]
+        reasons[notional > self.maxOrderNotional[slots]] |= NOTIONAL
+        # a market order without any price cannot be valued
+        unvalued = np.isnan(valued) & np.isfinite(self.maxOrderNotional[slots])
+        reasons[unvalued] |= NO_REFERENCE_PRICE
+
+        # each order applies on top of the basket's earlier orders on the instrument,
+        # those rejected so far left out
+        counted = np.where(reasons == 0, quantity, 0.)
+        order = np.argsort(slots, kind="stable")
+        sortedSlots = slots[order]
+        cumulative = np.cumsum(counted[order])
+        starts = np.flatnonzero(np.r_[True, sortedSlots[1:] != sortedSlots[:-1]])
+        before = np.repeat(np.r_[0., cumulative][starts], np.diff(np.r_[starts, n]))
+        previous = np.empty(n)
+        previous[order] = self.position[sortedSlots] + cumulative - before - counted[order]
+        after = previous + quantity
+        increasing = np.abs(after) > np.abs(previous)
+        reasons[increasing & (np.abs(after) > self.maxPosition[slots])] |= POSITION_LIMIT
+
+        if self.maxOrdersPerSec != np.inf:
+            accepted = reasons == 0
+            room = max(0, int(self.maxOrdersPerSec) - self._recentlyAccepted())
+            reasons[accepted & (np.cumsum(accepted) > room)] |= RATE
+
+        nAccepted = int(np.count_nonzero(reasons == 0))
+        self._accept(nAccepted)
+        self.nChecked += n
+        self.nRejected += n - nAccepted
+        return reasons
+
+    def _recentlyAccepted(self):
+        cutoff = self._clock() - 1.
+        while self._accepted and self._accepted[0][0] <= cutoff:
+            self._nAccepted -= self._accepted.popleft()[1]
+        return self._nAccepted
+
+    def _accept(self, n: int):
+        if n:
+            self._accepted.append((self._clock(), n))
+            self._nAccepted += n
@@ -0,0 +1,302 @@
+import logging
+import time
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+
+from QuoteStore import FIELDS, FIELD_INDEX, TICK_TO_FIELD
+from TickRingBuffer import TickRingBuffer, MIDPOINT, FLAG_TICK_BY_TICK, FLAG_QUOTE_CONTINUES, \
+    DATA_TYPE_FLAGS
+from MarketDataType import DATA_TYPE_COLUMN
+
+QUOTE_MAGIC = 0x49425142  # "IBQB"
+QUOTE_VERSION = 1
+# header words: magic, version, capacity, number of fields, published slots, directory version
+HEADER_WORDS = 8
+KEY_BYTES = 64
+MAX_READ_TRIES = 1000
+
+
+def _quoteLayout(capacity: int, nFields: int):
+    # every block is a multiple of 8 bytes so the float columns stay aligned
+    offsets = {"header": 0}
+    offsets["seq"] = HEADER_WORDS * 8
+    offsets["values"] = offsets["seq"] + capacity * 8
+    offsets["updated"] = offsets["values"] + capacity * nFields * 8
+    offsets["keys"] = offsets["updated"] + capacity * 8
+    return offsets, offsets["keys"] + capacity * KEY_BYTES
+
+
+def _attach(name: str):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        # before python 3.13 attaching registers the segment with this process's
+        # resource tracker, which would unlink it under the publisher on exit
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+class SharedQuoteBook(object):
+    """
+    The QuoteStore rows laid out in a shared memory buffer, guarded by one
+    sequence counter per slot (seqlock): the writer makes the counter odd, writes
+    the row and makes it even again; a reader retries any row whose counter was odd
+    or moved while it was being copied. The slot keys are published the same way
+    under the directory version.
+    """
+
+    def __init__(self, buffer, capacity: int = None, nFields: int = len(FIELDS)):
+        if capacity is None:
+            header = np.ndarray(HEADER_WORDS, dtype=np.uint64, buffer=buffer)
+            if int(header[0]) != QUOTE_MAGIC or int(header[1]) != QUOTE_VERSION:
+                raise ValueError("buffer does not hold a version %d quote book" % QUOTE_VERSION)
+            (capacity, nFields) = (int(header[2]), int(header[3]))
+        (offsets, _) = _quoteLayout(capacity, nFields)
+        self.capacity = capacity
+        self.header = np.ndarray(HEADER_WORDS, dtype=np.uint64, buffer=buffer)
+        self.seq = np.ndarray(capacity, dtype=np.uint64, buffer=buffer, offset=offsets["seq"])
+        self.values = np.ndarray((capacity, nFields), dtype=np.float64, buffer=buffer,
+                                 offset=offsets["values"])
+        self.updated = np.ndarray(capacity, dtype=np.float64, buffer=buffer, offset=offsets["updated"])
+        self.keys = np.ndarray(capacity, dtype="S%d" % KEY_BYTES, buffer=buffer, offset=offsets["keys"])
+
+    @property
+    def nSlots(self):
+        return int(self.header[4])
+
+    def initialize(self, nFields: int):
+        self.seq[:] = 0
+        self.values[:] = np.nan
+        self.updated[:] = 0
+        self.header[:6] = (QUOTE_MAGIC, QUOTE_VERSION, self.capacity, nFields, 0, 0)
+
+    def write(self, slot: int, row, updated: float):
+        seq = int(self.seq[slot])
+        self.seq[slot] = seq + 1
+        self.values[slot] = row
+        self.updated[slot] = updated
+        self.seq[slot] = seq + 2
+
+    def read(self, slots):
+        """
+        Consistent copy of the rows of slots
+        :return: (values, updated) arrays
+        """
+        slots = np.atleast_1d(np.asarray(slots, dtype=np.int64))
+        values = np.empty((len(slots), self.values.shape[1]))
+        updated = np.empty(len(slots))
+        pending = np.arange(len(slots))
+        for _ in range(MAX_READ_TRIES):
+            rows = slots[pending]
+            before = self.seq[rows]
+            values[pending] = self.values[rows]
+            updated[pending] = self.updated[rows]
+            after = self.seq[rows]
+            pending = pending[(before != after) | ((before & np.uint64(1)) == 1)]
+            if not len(pending):
+                return values, updated
+        raise RuntimeError("quote rows %s kept changing while being read" % slots[pending])
+
+    def writeKeys(self, firstSlot: int, keys):
+        version = int(self.header[5])
+        self.header[5] = version + 1
+        for (slot, key) in enumerate(keys, firstSlot):
+            self.keys[slot] = str(key).encode("utf-8")[:KEY_BYTES]
+        self.header[4] = firstSlot + len(keys)
+        self.header[5] = version + 2
+
+    def readKeys(self):
+        """
+        :return: (directory version, list of slot keys as strings)
+        """
+        for _ in range(MAX_READ_TRIES):
+            version = int(self.header[5])
+            if version & 1:
+                continue
+            keys = [key.decode("utf-8") for key in self.keys[:int(self.header[4])]]
+            if int(self.header[5]) == version:
+                return version, keys
+        raise RuntimeError("quote book directory kept changing while being read")
+
+
+class SharedMarketDataPublisher(object):
+    """
+    Publishes the QuoteStore and a tick ring into shared memory segments
+    <name>_quotes and <name>_ticks, so strategy processes on the same host read
+    live data without a TWS connection (and client id) of their own.
+    Its callbacks take the EWrapper signatures and must be called after the
+    QuoteStore has been updated, from the reader thread (the single writer).
+    """
+
+    def __init__(self, quoteStore, name: str = "ibapi_md", capacity: int = 4096,
+                 ringCapacity: int = 1 << 16, clock=time.time_ns):
+        self.quoteStore = quoteStore
+        self.name = name
+        self._clock = clock
+        nFields = quoteStore.values.shape[1]
+        (_, size) = _quoteLayout(capacity, nFields)
+        self._quoteShm = self._create(name + "_quotes", size)
+        self._tickShm = self._create(name + "_ticks", TickRingBuffer.nbytes(ringCapacity))
+        self.book = SharedQuoteBook(self._quoteShm.buf, capacity, nFields)
+        self.book.initialize(nFields)
+        self.ring = TickRingBuffer(ringCapacity, self._tickShm.buf)
+        self._warnedFull = False
+        self.publishAll()
+
+    @staticmethod
+    def _create(name: str, size: int):
+        try:
+            return shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            # left behind by a publisher that did not shut down cleanly
+            logging.warning("replacing stale shared memory segment %s", name)
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+            return shared_memory.SharedMemory(name=name, create=True, size=size)
+
+    def _updateDirectory(self):
+        published = self.book.nSlots
+        keys = self.quoteStore.slot2key[published:self.book.capacity]
+        if keys:
+            self.book.writeKeys(published, keys)
+
+    def publishQuote(self, slot: int):
+        if slot >= self.book.capacity:
+            if not self._warnedFull:
+                logging.warning("shared quote book %s is full (%d slots), slot %d not published",
+                                self.name, self.book.capacity, slot)
+                self._warnedFull = True
+            return
+        if slot >= self.book.nSlots:
+            self._updateDirectory()
+        self.book.write(slot, self.quoteStore.values[slot], self.quoteStore.updated[slot])
+
+    def publishAll(self):
+        self._updateDirectory()
+        for slot in range(min(len(self.quoteStore), self.book.capacity)):
+            self.book.write(slot, self.quoteStore.values[slot], self.quoteStore.updated[slot])
+
+    def _flags(self, slot, field):
+        # the data type the QuoteStore value was tagged with, if it is tracked
+        tags = self.quoteStore.columns.get(DATA_TYPE_COLUMN)
+        return 0 if tags is None else DATA_TYPE_FLAGS[tags[slot, field]]
+
+    def tickPrice(self, reqId: int, tickType: int, price: float, attrib=None):
+        slot = self.quoteStore.reqId2slot.get(reqId, -1)
+        field = TICK_TO_FIELD.get(tickType)
+        if slot < 0 or field is None:
+            return
+        self.publishQuote(slot)
+        self.ring.append(self._clock(), slot, field, price, np.nan, self._flags(slot, field))
+
+    def tickSize(self, reqId: int, tickType: int, size: int):
+        slot = self.quoteStore.reqId2slot.get(reqId, -1)
+        field = TICK_TO_FIELD.get(tickType)
+        if slot < 0 or field is None:
+            return
+        self.publishQuote(slot)
+        self.ring.append(self._clock(), slot, field, np.nan, size, self._flags(slot, field))
+
+    def tickByTickAllLast(self, reqId: int, tickType: int, time: int, price: float,
+                          size: int, *args):
+        slot = self.quoteStore.reqId2slot.get(reqId, -1)
+        if slot >= 0:
+            self.ring.append(self._clock(), slot, FIELD_INDEX["LAST"], price, size, FLAG_TICK_BY_TICK)
+
+    def tickByTickBidAsk(self, reqId: int, time: int, bidPrice: float, askPrice: float,
+                         bidSize: int, askSize: int, *args):
+        slot = self.quoteStore.reqId2slot.get(reqId, -1)
+        if slot >= 0:
+            now = self._clock()
+            self.ring.append(now, slot, FIELD_INDEX["BID"], bidPrice, bidSize,
+                             FLAG_TICK_BY_TICK | FLAG_QUOTE_CONTINUES)
+            self.ring.append(now, slot, FIELD_INDEX["ASK"], askPrice, askSize, FLAG_TICK_BY_TICK)
+
+    def tickByTickMidPoint(self, reqId: int, time: int, midPoint: float):
+        slot = self.quoteStore.reqId2slot.get(reqId, -1)
+        if slot >= 0:
+            self.ring.append(self._clock(), slot, MIDPOINT, midPoint, np.nan, FLAG_TICK_BY_TICK)
+
+    def close(self):
+        # the numpy views must go before the segments can be closed
+        self.book = self.ring = None
+        for shm in (self._quoteShm, self._tickShm):
+            shm.close()
+            shm.unlink()
+
+
+class SharedMarketDataReader(object):
+    """
+    Read side of SharedMarketDataPublisher for another process
+    column() and the ring records are zero-copy views; quotes() returns rows that
+    are consistent per instrument.
+    """
+
+    def __init__(self, name: str = "ibapi_md"):
+        self._quoteShm = _attach(name + "_quotes")
+        self._tickShm = _attach(name + "_ticks")
+        self.book = SharedQuoteBook(self._quoteShm.buf)
+        self.ring = TickRingBuffer.attach(self._tickShm.buf)
+        self._directoryVersion = -1
+        self.slot2key = []
+        self.key2slot = {}
+
+    def _refreshDirectory(self):
+        if int(self.book.header[5]) != self._directoryVersion:
+            (self._directoryVersion, self.slot2key) = self.book.readKeys()
+            self.key2slot = {key: slot for (slot, key) in enumerate(self.slot2key)}
+
+    def slotOf(self, key):
+        """
+        :param key: the QuoteStore key, compared as a string
+        """
+        slot = self.key2slot.get(str(key))
+        if slot is None:
+            self._refreshDirectory()
+            slot = self.key2slot.get(str(key), -1)
+        return slot
+
+    def keys(self):
+        self._refreshDirectory()
+        return list(self.slot2key)
+
+    def quote(self, key):
+        """
+        :return: dict field -> value of one instrument, plus its update time as UPDATED
+        """
+        slot = self.slotOf(key)
+        if slot < 0:
+            raise KeyError("%r is not published" % (key,))
+        (values, updated) = self.book.read([slot])
+        result = dict(zip(FIELDS, values[0].tolist()))
+        result["UPDATED"] = float(updated[0])
+        return result
+
+    def quotes(self, slots=None):
+        """
+        :return: (values, updated) for slots, all published slots by default
+        """
+        if slots is None:
+            slots = np.arange(self.book.nSlots)
+        return self.book.read(slots)
+
+    def column(self, field: str):
+        """
+        Zero-copy view on one field; each value is read atomically but a row
+        may mix values from before and after an update
+        """
+        return self.book.values[:self.book.nSlots, FIELD_INDEX[field]]
+
+    def ticks(self, since: int, limit: int = None):
+        """
+        :return: (records, next sequence, records lost to overrun), see TickRingBuffer.read
+        """
+        return self.ring.read(since, limit)
+
+    def close(self):
+        self.book = self.ring = None
+        self._quoteShm.close()
+        self._tickShm.close()
@@ -0,0 +1,254 @@
+import logging
+import threading
+import time
+
+from RateLimiter import TokenBucket
+
+DEFAULT_FIRST_REQ_ID = 800000
+# IB's fee per regulatory snapshot, in USD
+REGULATORY_SNAPSHOT_COST = 0.01
+# errors reported on a snapshot request that do not end it
+WARNINGS = {10167, 10090}
+
+
+class SnapshotBudgetExceeded(Exception):
+    pass
+
+
+class Snapshot(object):
+    """
+    One completed snapshot: a copy of the instrument's QuoteStore row
+    """
+
+    def __init__(self, key, values, time: float, regulatory: bool):
+        self.key = key
+        self.values = values
+        self.time = time
+        self.regulatory = regulatory
+
+
+class PendingSnapshot(object):
+    def __init__(self, key, reqId: int, regulatory: bool, sent: float):
+        self.key = key
+        self.reqId = reqId
+        self.regulatory = regulatory
+        self.sent = sent
+        self.callbacks = []
+        self.event = threading.Event()
+        self.result = None
+
+
+class SnapshotService(object):
+    """
+    Shared front end for normal and regulatory snapshots
+    A snapshot younger than maxAge is served from the cache; requests for an
+    instrument already being fetched wait on that fetch instead of sending their
+    own; only the rest go to IB, through a message rate token bucket. Requests that
+    are charged (regulatory snapshots, and normal ones when snapshotCost is set)
+    count against a daily budget. A regulatory snapshot also satisfies a normal
+    request, not the other way round. Snapshots without a tickSnapshotEnd are
+    failed after timeout seconds by the poll thread started with start().
+    """
+
+    def __init__(self, client, quoteStore, maxAge: float = 5., dailyBudget: float = 1.,
+                 regulatoryCost: float = REGULATORY_SNAPSHOT_COST, snapshotCost: float = 0.,
+                 timeout: float = 11., maxMsgRate: float = 40.,
+                 firstReqId: int = DEFAULT_FIRST_REQ_ID, throttle: TokenBucket = None,
+                 clock=time.time):
+        """
+        :param throttle: the application's shared TokenBucket, when other requests
+        go out on the same connection; maxMsgRate is then ignored
+        """
+        self.client = client
+        self.quoteStore = quoteStore
+        self.maxAge = maxAge
+        self.dailyBudget = dailyBudget
+        self.regulatoryCost = regulatoryCost
+        self.snapshotCost = snapshotCost
+        self.timeout = timeout
+        self.throttle = throttle if throttle is not None else TokenBucket(maxMsgRate)
+        self._clock = clock
+        self._nextReqId = firstReqId
+        self._lock = threading.Lock()
+        self.cache = {}
+        # (key, regulatory) -> PendingSnapshot, and the same by reqId
+        self.pending = {}
+        self.reqId2pending = {}
+        self.day = None
+        self.spent = 0.
+        self.metrics = dict.fromkeys(("requests", "hits", "coalesced", "sent", "charged",
+                                      "rejected", "failed"), 0)
+        self._thread = None
+        self._running = False
+
+    def _cost(self, regulatory: bool):
+        return self.regulatoryCost if regulatory else self.snapshotCost
+
+    def _charge(self, cost: float, now: float):
+        day = time.localtime(now)[:3]
+        if day != self.day:
+            (self.day, self.spent) = (day, 0.)
+        if self.spent + cost > self.dailyBudget + 1e-9:
+            return False
+        self.spent += cost
+        return True
+
+    def cached(self, key, regulatory: bool = False, maxAge: float = None):
+        """
+        :return: the cached snapshot if fresh enough, None otherwise
+        """
+        snap = self.cache.get(key)
+        if snap is None or (regulatory and not snap.regulatory):
+            return None
+        if self._clock() - snap.time > (self.maxAge if maxAge is None else maxAge):
+            return None
+        return snap
+
+    def request(self, key, contract, regulatory: bool = False, maxAge: float = None,
+                callback=None):
+        """
+        Asks for a snapshot of contract, stored under key
+        :param callback: called with (key, Snapshot or None if it failed) once available
+        :return: the PendingSnapshot; its result is set immediately on a cache hit
+        :raise SnapshotBudgetExceeded: if the request would have to be charged
+        beyond the daily budget
+        """
+        now = self._clock()
+        expired = None
+        with self._lock:
+            self.metrics["requests"] += 1
+            snap = self.cached(key, regulatory, maxAge)
+            if snap is not None:
+                self.metrics["hits"] += 1
+                pending = PendingSnapshot(key, None, regulatory, now)
+                pending.result = snap
+                pending.event.set()
+                sent = False
+            else:
+                pending = self.pending.get((key, regulatory))
+                if pending is None and not regulatory:
+                    # a regulatory fetch under way does for a normal request too
+                    pending = self.pending.get((key, True))
+                if pending is not None and now - pending.sent > self.timeout:
+                    self._finish(pending, None)
+                    (expired, pending) = (pending, None)
+                if pending is not None:
+                    self.metrics["coalesced"] += 1
+                    if callback is not None:
+                        pending.callbacks.append(callback)
+                    return pending
+                cost = self._cost(regulatory)
+                if cost and not self._charge(cost, now):
+                    self.metrics["rejected"] += 1
+                    raise SnapshotBudgetExceeded("snapshot of %r would exceed the daily budget of %.2f"
+                                                 % (key, self.dailyBudget))
+                if cost:
+                    self.metrics["charged"] += 1
+                reqId = self._nextReqId
+                self._nextReqId += 1
+                pending = self.pending[(key, regulatory)] = PendingSnapshot(key, reqId, regulatory, now)
+                if callback is not None:
+                    pending.callbacks.append(callback)
+                self.reqId2pending[reqId] = pending
+                self.quoteStore.bindReqId(reqId, key)
+                self.metrics["sent"] += 1
+                sent = True
+        if expired is not None:
+            self._notify(expired)
+        if not sent:
+            if callback is not None:
+                callback(key, snap)
+            return pending
+        self.throttle.acquire()
+        self.client.reqMktData(pending.reqId, contract, "", not regulatory, regulatory, [])
+        return pending
+
+    def get(self, key, contract, regulatory: bool = False, maxAge: float = None,
+            timeout: float = None):
+        """
+        Blocking request()
+        :return: the Snapshot, or None if it failed or timed out
+        """
+        pending = self.request(key, contract, regulatory, maxAge)
+        pending.event.wait(self.timeout if timeout is None else timeout)
+        return pending.result
+
+    def _finish(self, pending, snap):
+        del self.reqId2pending[pending.reqId]
+        del self.pending[(pending.key, pending.regulatory)]
+        self.quoteStore.unbindReqId(pending.reqId)
+        if snap is None:
+            self.metrics["failed"] += 1
+        else:
+            self.cache[pending.key] = snap
+        pending.result = snap
+        pending.event.set()
+
+    def _notify(self, pending):
+        for callback in pending.callbacks:
+            try:
+                callback(pending.key, pending.result)
+            except Exception:
+                logging.exception("snapshot callback for %r failed", pending.key)
+
+    def poll(self):
+        """
+        Fails the snapshots that have waited longer than the timeout
+        """
+        now = self._clock()
+        with self._lock:
+            expired = [p for p in self.reqId2pending.values() if now - p.sent > self.timeout]
+            for pending in expired:
+                self._finish(pending, None)
+        for pending in expired:
+            self._notify(pending)
+
+    def start(self, pollInterval: float = 1.):
+        """
+        Times out lost snapshots from a background thread, freeing their waiters
+        """
+        if self._thread is not None:
+            return
+        self._running = True
+
+        def loop():
+            while self._running:
+                self.poll()
+                time.sleep(pollInterval)
+
+        self._thread = threading.Thread(target=loop, name="SnapshotService", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    ## callbacks
+    def tickSnapshotEnd(self, reqId: int):
+        """
+        :return: True if the reqId belonged to this service
+        """
+        with self._lock:
+            pending = self.reqId2pending.get(reqId)
+            if pending is None:
+                return False
+            slot = self.quoteStore.slotOf(pending.key)
+            snap = Snapshot(pending.key, self.quoteStore.values[slot].copy(), self._clock(),
+                            pending.regulatory)
+            self._finish(pending, snap)
+        self._notify(pending)
+        return True
+
+    def error(self, reqId: int, errorCode: int, errorString: str):
+        if errorCode in WARNINGS:
+            return False
+        with self._lock:
+            pending = self.reqId2pending.get(reqId)
+            if pending is None:
+                return False
+            logging.info("snapshot %d of %r failed (%d): %s", reqId, pending.key, errorCode, errorString)
+            self._finish(pending, None)
+        self._notify(pending)
+        return True
@@ -0,0 +1,137 @@
+import collections
+import logging
+import threading
+import time
+
+import numpy as np
+
+from QuoteStore import FIELDS, FIELD_INDEX
+
+# one coalesced publication: parallel arrays of slot, field index and latest value
+ConflatedUpdate = collections.namedtuple("ConflatedUpdate", ["slots", "fields", "values"])
+
+
+class ConflatedSubscriber(object):
+    """
+    A slow consumer of the QuoteStore that sees at most one value per (slot, field)
+    per publication, however many ticks arrived in between
+    Changes are tracked in a dirty-bit array owned by the store, so memory is fixed
+    by the number of instruments and fields, never by the tick rate.
+    """
+
+    def __init__(self, conflator, callback, interval: float = None, fields=None):
+        self.conflator = conflator
+        self.quoteStore = conflator.quoteStore
+        self.callback = callback
+        # None means on demand only: the consumer calls flush() itself
+        self.interval = interval
+        self.fieldMask = None
+        if fields is not None:
+            self.fieldMask = np.zeros(len(FIELDS), dtype=bool)
+            self.fieldMask[[FIELD_INDEX[f] for f in fields]] = True
+        self.maskId = self.quoteStore.addDirtyMask()
+        self.nextDue = 0.
+        self.nPublished = 0
+
+    def pending(self):
+        return bool(self.quoteStore.dirtyMasks[self.maskId].any())
+
+    def flush(self):
+        """
+        Publishes everything that changed since the previous flush
+        :return: the ConflatedUpdate published, None if nothing changed
+        """
+        mask = self.quoteStore.dirtyMasks[self.maskId]
+        (slots, fields) = np.nonzero(mask)
+        if len(slots) == 0:
+            return None
+        # clear before reading the values: the writer stores the value before setting
+        # its bit, so a tick racing with us is either read now or flagged again
+        mask[slots, fields] = False
+        if self.fieldMask is not None:
+            keep = self.fieldMask[fields]
+            (slots, fields) = (slots[keep], fields[keep])
+            if len(slots) == 0:
+                return None
+        update = ConflatedUpdate(slots, fields, self.quoteStore.values[slots, fields])
+        self.nPublished += 1
+        if self.callback is not None:
+            self.callback(update)
+        return update
+
+    def close(self):
+        self.conflator.unsubscribe(self)
+
+
+class TickConflator(object):
+    """
+    Runs the periodic publications of every ConflatedSubscriber on one thread
+    """
+
+    def __init__(self, quoteStore, clock=time.monotonic):
+        self.quoteStore = quoteStore
+        self.subscribers = []
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._running = False
+
+    def subscribe(self, callback, interval: float = None, fields=None):
+        """
+        :param callback: called with a ConflatedUpdate, from the conflator thread for
+                         periodic subscribers or from the caller of flush()
+        :param interval: minimum seconds between publications, None for on demand
+        :param fields: names of the QuoteStore fields of interest, None for all
+        """
+        subscriber = ConflatedSubscriber(self, callback, interval, fields)
+        with self._lock:
+            self.subscribers = self.subscribers + [subscriber]
+        self._wakeup.set()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self.subscribers = [s for s in self.subscribers if s is not subscriber]
+        self.quoteStore.removeDirtyMask(subscriber.maskId)
+
+    def publishDue(self):
+        """
+        Flushes every periodic subscriber whose interval has elapsed
+        :return: seconds until the next subscriber is due, None if there is none
+        """
+        now = self._clock()
+        nextDue = None
+        for subscriber in self.subscribers:
+            if subscriber.interval is None:
+                continue
+            if subscriber.nextDue <= now:
+                try:
+                    subscriber.flush()
+                except Exception:
+                    logging.exception("conflated subscriber callback failed")
+                subscriber.nextDue = now + subscriber.interval
+            if nextDue is None or subscriber.nextDue < nextDue:
+                nextDue = subscriber.nextDue
+        return None if nextDue is None else max(0., nextDue - now)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._running = True
+
+        def loop():
+            while self._running:
+                wait = self.publishDue()
+                self._wakeup.wait(timeout=wait)
+                self._wakeup.clear()
+
+        self._thread = threading.Thread(target=loop, name="TickConflator", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
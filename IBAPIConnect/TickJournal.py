@@ -0,0 +1,328 @@
+import json
+import logging
+import struct
+import threading
+import time
+
+from ibapi.common import TickAttrib
+from ibapi.contract import Contract
+
+MAGIC = b"IBTJ"
+VERSION = 1
+FILE_HEADER = struct.Struct("<4sHq")   # magic, version, base time (epoch ns)
+
+# every record starts with: type, flags, field (tick type / depth position),
+# reqId, microseconds since the previous record
+RECORD_HEADER = struct.Struct("<BBhiI")
+MAX_DELTA_US = 2 ** 32 - 1
+
+(REC_TIME, REC_STRING, REC_CONTRACT, REC_TICK_PRICE, REC_TICK_SIZE,
+ REC_TICK_GENERIC, REC_TICK_STRING, REC_TICK_SNAPSHOT_END, REC_TBT_LAST,
+ REC_TBT_BIDASK, REC_TBT_MIDPOINT, REC_DEPTH, REC_DEPTH_L2, REC_REALTIME_BAR) = range(14)
+
+# fixed body following the header, per record type
+BODIES = {
+    REC_TIME: struct.Struct("<q"),                  # absolute epoch ns
+    REC_STRING: struct.Struct("<iH"),               # string id, utf8 length (bytes follow)
+    REC_CONTRACT: struct.Struct("<H"),              # json length (bytes follow)
+    REC_TICK_PRICE: struct.Struct("<d"),
+    REC_TICK_SIZE: struct.Struct("<d"),
+    REC_TICK_GENERIC: struct.Struct("<d"),
+    REC_TICK_STRING: struct.Struct("<H"),           # utf8 length (bytes follow)
+    REC_TICK_SNAPSHOT_END: struct.Struct("<"),
+    REC_TBT_LAST: struct.Struct("<qddii"),          # time, price, size, exchange id, conditions id
+    REC_TBT_BIDASK: struct.Struct("<qdddd"),        # time, bid, ask, bid size, ask size
+    REC_TBT_MIDPOINT: struct.Struct("<qd"),
+    REC_DEPTH: struct.Struct("<dd"),                # price, size
+    REC_DEPTH_L2: struct.Struct("<ddi"),            # price, size, market maker id
+    REC_REALTIME_BAR: struct.Struct("<qddddddi"),   # time, o, h, l, c, volume, wap, count
+}
+RECORDS = {recType: struct.Struct(RECORD_HEADER.format + body.format[1:])
+           for (recType, body) in BODIES.items()}
+
+# attribute bits packed into the header flags
+ATTRIB_BITS = ("canAutoExecute", "pastLimit", "preOpen", "unreported", "bidPastLow", "askPastHigh")
+
+
+def packAttrib(attrib):
+    flags = 0
+    if attrib is not None:
+        for (bit, name) in enumerate(ATTRIB_BITS):
+            if getattr(attrib, name, False):
+                flags |= 1 << bit
+    return flags
+
+
+def unpackAttrib(flags):
+    attrib = TickAttrib()
+    for (bit, name) in enumerate(ATTRIB_BITS):
+        setattr(attrib, name, bool(flags & (1 << bit)))
+    return attrib
+
+
+def contractToJson(contract):
+    return json.dumps(vars(contract), default=lambda o: vars(o), sort_keys=True)
+
+
+def contractFromJson(text):
+    contract = Contract()
+    for (name, value) in json.loads(text).items():
+        # nested objects (combo legs, delta neutral) are kept as plain dicts
+        setattr(contract, name, value)
+    return contract
+
+
+class TickJournalWriter(object):
+    """
+    Append-only binary journal of the wrapper's market data callbacks
+    Records are fixed width per type, stamped with the receive time as a delta in
+    microseconds from the previous record. Repeating strings (exchanges, conditions,
+    market makers) are interned once and referenced by id, while tickString values,
+    which rarely repeat, follow their record inline. Contracts are written when a
+    reqId is bound so a replay knows what each stream was.
+    Callbacks only pack bytes into a buffer; a background thread writes it out in batches.
+    """
+
+    def __init__(self, path: str, flushInterval: float = 0.2, contracts: dict = None,
+                 clock=time.time_ns):
+        self.path = path
+        self.flushInterval = flushInterval
+        self._clock = clock
+        self._file = open(path, "ab")
+        self._lock = threading.Lock()
+        self._buffer = bytearray()
+        self._strings = {}
+        self._lastNs = clock()
+        self.nRecords = 0
+        self.nBytes = 0
+        if self._file.tell() == 0:
+            self._buffer += FILE_HEADER.pack(MAGIC, VERSION, self._lastNs)
+        else:
+            # appending to an existing journal: re-anchor the deltas
+            self._buffer += RECORDS[REC_TIME].pack(REC_TIME, 0, 0, 0, 0, self._lastNs)
+        for (reqId, contract) in (contracts or {}).items():
+            self.bindContract(reqId, contract)
+        self._running = True
+        self._wakeup = threading.Event()
+        self._thread = threading.Thread(target=self._writerLoop, name="TickJournalWriter",
+                                        daemon=True)
+        self._thread.start()
+
+    def _delta(self):
+        # caller holds the lock
+        now = self._clock()
+        delta = (now - self._lastNs) // 1000
+        if delta < 0 or delta > MAX_DELTA_US:
+            self._buffer += RECORDS[REC_TIME].pack(REC_TIME, 0, 0, 0, 0, now)
+            delta = 0
+        self._lastNs = now
+        return delta
+
+    def _append(self, recType, flags, field, reqId, *body):
+        with self._lock:
+            self._buffer += RECORDS[recType].pack(recType, flags, field, reqId, self._delta(), *body)
+            self.nRecords += 1
+
+    def _stringId(self, text):
+        # caller holds the lock
+        sid = self._strings.get(text)
+        if sid is None:
+            sid = self._strings[text] = len(self._strings)
+            data = text.encode("utf8")
+            self._buffer += RECORDS[REC_STRING].pack(REC_STRING, 0, 0, 0, 0, sid, len(data))
+            self._buffer += data
+        return sid
+
+    def _appendWithStrings(self, recType, flags, field, reqId, body, strings):
+        with self._lock:
+            ids = [self._stringId(s or "") for s in strings]
+            self._buffer += RECORDS[recType].pack(recType, flags, field, reqId, self._delta(),
+                                                  *body, *ids)
+            self.nRecords += 1
+
+    def bindContract(self, reqId: int, contract):
+        data = contractToJson(contract).encode("utf8")
+        with self._lock:
+            self._buffer += RECORDS[REC_CONTRACT].pack(REC_CONTRACT, 0, 0, reqId, 0, len(data))
+            self._buffer += data
+
+    # wrapper callbacks, same signatures as EWrapper
+
+    def tickPrice(self, reqId, tickType, price, attrib):
+        self._append(REC_TICK_PRICE, packAttrib(attrib), tickType, reqId, price)
+
+    def tickSize(self, reqId, tickType, size):
+        self._append(REC_TICK_SIZE, 0, tickType, reqId, size)
+
+    def tickGeneric(self, reqId, tickType, value):
+        self._append(REC_TICK_GENERIC, 0, tickType, reqId, value)
+
+    def tickString(self, reqId, tickType, value):
+        data = value.encode("utf8")
+        with self._lock:
+            self._buffer += RECORDS[REC_TICK_STRING].pack(REC_TICK_STRING, 0, tickType, reqId,
+                                                          self._delta(), len(data))
+            self._buffer += data
+            self.nRecords += 1
+
+    def tickSnapshotEnd(self, reqId):
+        self._append(REC_TICK_SNAPSHOT_END, 0, 0, reqId)
+
+    def tickByTickAllLast(self, reqId, tickType, time, price, size, attribs, exchange,
+                          specialConditions):
+        self._appendWithStrings(REC_TBT_LAST, packAttrib(attribs), tickType, reqId,
+                                (time, price, size), (exchange, specialConditions))
+
+    def tickByTickBidAsk(self, reqId, time, bidPrice, askPrice, bidSize, askSize, attribs):
+        self._append(REC_TBT_BIDASK, packAttrib(attribs), 0, reqId,
+                     time, bidPrice, askPrice, bidSize, askSize)
+
+    def tickByTickMidPoint(self, reqId, time, midPoint):
+        self._append(REC_TBT_MIDPOINT, 0, 0, reqId, time, midPoint)
+
+    def updateMktDepth(self, reqId, position, operation, side, price, size):
+        self._append(REC_DEPTH, operation | (side << 4), position, reqId, price, size)
+
+    def updateMktDepthL2(self, reqId, position, marketMaker, operation, side, price, size):
+        self._appendWithStrings(REC_DEPTH_L2, operation | (side << 4), position, reqId,
+                                (price, size), (marketMaker,))
+
+    def realtimeBar(self, reqId, time, open, high, low, close, volume, wap, count):
+        self._append(REC_REALTIME_BAR, 0, 0, reqId, time, open, high, low, close,
+                     volume, wap, count)
+
+    def flush(self):
+        with self._lock:
+            (data, self._buffer) = (self._buffer, bytearray())
+        if data:
+            self._file.write(data)
+            self._file.flush()
+            self.nBytes += len(data)
+
+    def _writerLoop(self):
+        while self._running:
+            self._wakeup.wait(self.flushInterval)
+            try:
+                self.flush()
+            except Exception:
+                logging.exception("tick journal write to %s failed", self.path)
+
+    def close(self):
+        self._running = False
+        self._wakeup.set()
+        self._thread.join()
+        self.flush()
+        self._file.close()
+
+
+class TickJournalReader(object):
+    """
+    Iterates a journal as (receive time in epoch ns, callback name, args) tuples
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.contracts = {}
+        self.strings = {}
+
+    def __iter__(self):
+        with open(self.path, "rb") as f:
+            data = f.read()
+        (magic, version, nowNs) = FILE_HEADER.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not a tick journal" % self.path)
+        if version != VERSION:
+            raise ValueError("unsupported tick journal version %d" % version)
+        offset = FILE_HEADER.size
+        end = len(data)
+        strings = self.strings
+        while offset < end:
+            recType = data[offset]
+            record = RECORDS[recType]
+            if offset + record.size > end:
+                logging.warning("truncated record at offset %d of %s", offset, self.path)
+                return
+            fields = record.unpack_from(data, offset)
+            offset += record.size
+            (_, flags, field, reqId, delta) = fields[:5]
+            body = fields[5:]
+            if recType == REC_TIME:
+                nowNs = body[0]
+                continue
+            nowNs += delta * 1000
+            if recType == REC_STRING:
+                (sid, length) = body
+                strings[sid] = data[offset:offset + length].decode("utf8")
+                offset += length
+            elif recType == REC_CONTRACT:
+                length = body[0]
+                self.contracts[reqId] = contractFromJson(data[offset:offset + length].decode("utf8"))
+                offset += length
+            elif recType == REC_TICK_PRICE:
+                yield nowNs, "tickPrice", (reqId, field, body[0], unpackAttrib(flags))
+            elif recType == REC_TICK_SIZE:
+                yield nowNs, "tickSize", (reqId, field, int(body[0]))
+            elif recType == REC_TICK_GENERIC:
+                yield nowNs, "tickGeneric", (reqId, field, body[0])
+            elif recType == REC_TICK_STRING:
+                length = body[0]
+                value = data[offset:offset + length].decode("utf8")
+                offset += length
+                yield nowNs, "tickString", (reqId, field, value)
+            elif recType == REC_TICK_SNAPSHOT_END:
+                yield nowNs, "tickSnapshotEnd", (reqId,)
+            elif recType == REC_TBT_LAST:
+                (t, price, size, exch, cond) = body
+                yield nowNs, "tickByTickAllLast", (reqId, field, t, price, int(size),
+                                                   unpackAttrib(flags), strings[exch], strings[cond])
+            elif recType == REC_TBT_BIDASK:
+                (t, bid, ask, bidSize, askSize) = body
+                yield nowNs, "tickByTickBidAsk", (reqId, t, bid, ask, int(bidSize), int(askSize),
+                                                  unpackAttrib(flags))
+            elif recType == REC_TBT_MIDPOINT:
+                yield nowNs, "tickByTickMidPoint", (reqId, body[0], body[1])
+            elif recType == REC_DEPTH:
+                yield nowNs, "updateMktDepth", (reqId, field, flags & 0xF, flags >> 4,
+                                                body[0], int(body[1]))
+            elif recType == REC_DEPTH_L2:
+                yield nowNs, "updateMktDepthL2", (reqId, field, strings[body[2]], flags & 0xF,
+                                                  flags >> 4, body[0], int(body[1]))
+            elif recType == REC_REALTIME_BAR:
+                (t, o, h, l, c, volume, wap, count) = body
+                yield nowNs, "realtimeBar", (reqId, t, o, h, l, c, int(volume), wap, count)
+
+
+class TickJournalReplayer(object):
+    """
+    Feeds a journal back into any EWrapper subclass through the same callbacks
+    :param speed: 1.0 replays at the recorded pace, 10.0 ten times faster,
+                  None as fast as possible
+    """
+
+    def __init__(self, path: str):
+        self.reader = TickJournalReader(path)
+
+    @property
+    def contracts(self):
+        return self.reader.contracts
+
+    def replay(self, wrapper, speed: float = None, reqIds=None):
+        """
+        :param reqIds: optional set of reqIds to replay, all by default
+        :return: number of callbacks made
+        """
+        nCalls = 0
+        startNs = None
+        startWall = None
+        for (nowNs, name, args) in self.reader:
+            if reqIds is not None and args[0] not in reqIds:
+                continue
+            if speed is not None:
+                if startNs is None:
+                    (startNs, startWall) = (nowNs, time.perf_counter())
+                wait = (nowNs - startNs) / 1e9 / speed - (time.perf_counter() - startWall)
+                if wait > 0:
+                    time.sleep(wait)
+            getattr(wrapper, name)(*args)
+            nCalls += 1
+        return nCalls
@@ -0,0 +1,102 @@
+import numpy as np
+
+from QuoteStore import FIELDS
+
+# one tick per record; time is the local receipt time in ns since the epoch and
+# field is a QuoteStore column index, or MIDPOINT
+TICK_DTYPE = np.dtype([("time", "<i8"), ("slot", "<i4"), ("field", "<i2"), ("flags", "<u2"),
+                       ("price", "<f8"), ("size", "<f8")])
+# field code of tickByTickMidPoint, which has no QuoteStore column
+MIDPOINT = len(FIELDS)
+# where a record came from: L1 ticks carry no flag
+FLAG_TICK_BY_TICK = 1
+FLAG_RT_VOLUME = 2
+# data type of the subscription, when not live
+FLAG_FROZEN = 4
+FLAG_DELAYED = 8
+# the other side of the same quote follows in the next record: readers apply both
+# before evaluating the quote
+FLAG_QUOTE_CONTINUES = 16
+# flags by market data type (0 unknown, 1 live, 2 frozen, 3 delayed, 4 delayed frozen)
+DATA_TYPE_FLAGS = (0, 0, FLAG_FROZEN, FLAG_DELAYED, FLAG_DELAYED | FLAG_FROZEN)
+
+RING_MAGIC = 0x49425452  # "IBTR"
+# header words: write sequence, capacity, record size, magic
+HEADER_WORDS = 4
+HEADER_BYTES = HEADER_WORDS * 8
+
+
+class TickRingBuffer(object):
+    """
+    Fixed-capacity single-writer ring of tick records
+    The writer stores a record and only then advances the write sequence, so
+    everything below the sequence is complete. Readers keep their own position:
+    records the writer may have lapped while they were being copied are dropped
+    and reported as lost rather than returned torn. The ring lives in any writable
+    buffer, so it works the same in process memory and in a shared memory segment.
+    """
+
+    def __init__(self, capacity: int = 65536, buffer=None, dtype=TICK_DTYPE):
+        if capacity <= 0 or capacity & (capacity - 1):
+            raise ValueError("ring capacity must be a power of two, got %d" % capacity)
+        if buffer is None:
+            buffer = bytearray(self.nbytes(capacity, dtype))
+        self.header = np.ndarray(HEADER_WORDS, dtype=np.uint64, buffer=buffer)
+        self.records = np.ndarray(capacity, dtype=dtype, buffer=buffer, offset=HEADER_BYTES)
+        self.capacity = capacity
+        self._mask = capacity - 1
+        self.header[:] = (0, capacity, dtype.itemsize, RING_MAGIC)
+
+    @staticmethod
+    def nbytes(capacity: int, dtype=TICK_DTYPE):
+        return HEADER_BYTES + capacity * dtype.itemsize
+
+    @classmethod
+    def attach(cls, buffer, dtype=TICK_DTYPE):
+        """
+        Maps a ring already laid out in buffer by another writer, without resetting it
+        """
+        header = np.ndarray(HEADER_WORDS, dtype=np.uint64, buffer=buffer)
+        if int(header[3]) != RING_MAGIC or int(header[2]) != dtype.itemsize:
+            raise ValueError("buffer does not hold a tick ring of this record type")
+        ring = cls.__new__(cls)
+        ring.header = header
+        ring.capacity = int(header[1])
+        ring._mask = ring.capacity - 1
+        ring.records = np.ndarray(ring.capacity, dtype=dtype, buffer=buffer, offset=HEADER_BYTES)
+        return ring
+
+    @property
+    def writeSeq(self):
+        return int(self.header[0])
+
+    def append(self, timeNs: int, slot: int, field: int, price: float, size: float, flags: int = 0):
+        seq = int(self.header[0])
+        self.records[seq & self._mask] = (timeNs, slot, field, flags, price, size)
+        self.header[0] = seq + 1
+
+    def push(self, record):
+        """
+        Appends one record given as a tuple in the order of the ring's dtype
+        """
+        seq = int(self.header[0])
+        self.records[seq & self._mask] = record
+        self.header[0] = seq + 1
+
+    def read(self, since: int, limit: int = None):
+        """
+        Copies the records from sequence number since up to the current write sequence
+        :return: (records, next sequence to read from, number of records lost to overrun)
+        """
+        end = int(self.header[0])
+        if limit is not None:
+            end = min(end, since + limit)
+        start = max(since, end - self.capacity)
+        out = self.records[np.arange(start, end) & self._mask]
+        # anything the writer has reached since may have been overwritten during the copy
+        valid = min(max(start, int(self.header[0]) - self.capacity + 1), end)
+        return out[valid - start:], end, max(valid - since, 0)
+
+    def latest(self, n: int):
+        end = int(self.header[0])
+        return self.read(max(end - n, 0))[0]
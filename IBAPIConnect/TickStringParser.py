@@ -0,0 +1,137 @@
+import math
+
+import numpy as np
+
+from ibapi.ticktype import TickTypeEnum
+
+# one RTVolume (generic tick 233) message: price;size;time;totalVolume;vwap;single
+RT_VOLUME_DTYPE = np.dtype([("price", "<f8"), ("size", "<f8"), ("time", "<i8"),
+                            ("totalVolume", "<f8"), ("vwap", "<f8"), ("single", "?")])
+RT_VOLUME_FILL = (math.nan, math.nan, 0, math.nan, math.nan, False)
+RT_VOLUME_TYPES = {TickTypeEnum.RT_VOLUME, TickTypeEnum.RT_TRD_VOLUME}
+RT_VOLUME_COLUMN = "RT_VOLUME"
+FUNDAMENTALS_COLUMN = "FUNDAMENTAL_RATIOS"
+SHORTABLE_COLUMN = "SHORTABLE"
+# fundamental ratios IB has no value for
+NO_DATA = -99999.99
+MAX_CACHED = 4096
+
+
+def parseRtVolume(value: str):
+    """
+    Splits an RTVolume string in one pass; the price and size are empty when the
+    message only updates the volume
+    :return: (price, size, time in ms, total volume, vwap, single market maker)
+    """
+    (price, size, time, totalVolume, vwap, single) = value.split(";")
+    return (float(price) if price else math.nan, float(size) if size else 0.,
+            int(time) if time else 0, float(totalVolume) if totalVolume else math.nan,
+            float(vwap) if vwap else math.nan, single == "true")
+
+
+class TickStringParser(object):
+    """
+    Parses the string ticks into typed QuoteStore columns
+    RTVolume goes to a structured column (one row write per message), fundamental
+    ratios to a float matrix with one column per ratio name, allocated as names are
+    first seen. Fundamental ratio strings are mostly resent unchanged: an unchanged
+    string for a slot is skipped, and parsed strings are cached across slots.
+    """
+
+    def __init__(self, quoteStore):
+        self.quoteStore = quoteStore
+        quoteStore.addColumn(RT_VOLUME_COLUMN, RT_VOLUME_DTYPE, RT_VOLUME_FILL)
+        quoteStore.addColumn(FUNDAMENTALS_COLUMN, np.float64, np.nan, width=64)
+        quoteStore.addColumn(SHORTABLE_COLUMN, np.float64, np.nan)
+        self.ratio2col = {}
+        # slot -> ratio name -> value, for the ratios that are not numbers (CURRENCY, dates)
+        self.textRatios = {}
+        self._lastRatios = {}
+        self._parsedRatios = {}
+        self.nParsed = 0
+        self.nCached = 0
+
+    def tickString(self, reqId: int, tickType: int, value: str):
+        """
+        :return: the parsed RTVolume tuple for RTVolume ticks, None otherwise
+        """
+        slot = self.quoteStore.reqId2slot.get(reqId, -1)
+        if tickType in RT_VOLUME_TYPES:
+            parsed = parseRtVolume(value)
+            if slot >= 0:
+                self.quoteStore.columns[RT_VOLUME_COLUMN][slot] = parsed
+            return parsed
+        if tickType == TickTypeEnum.FUNDAMENTAL_RATIOS and slot >= 0:
+            self.fundamentalRatios(slot, value)
+        return None
+
+    def tickGeneric(self, reqId: int, tickType: int, value: float):
+        if tickType == TickTypeEnum.SHORTABLE:
+            slot = self.quoteStore.reqId2slot.get(reqId, -1)
+            if slot >= 0:
+                self.quoteStore.columns[SHORTABLE_COLUMN][slot] = value
+
+    def _ratioColumn(self, name: str):
+        col = self.ratio2col.get(name)
+        if col is None:
+            col = self.ratio2col[name] = len(self.ratio2col)
+            width = self.quoteStore.columns[FUNDAMENTALS_COLUMN].shape[1]
+            if col >= width:
+                self.quoteStore.widenColumn(FUNDAMENTALS_COLUMN, 2 * width)
+        return col
+
+    def _parseRatios(self, value: str):
+        cols = []
+        values = []
+        text = {}
+        for item in value.split(";"):
+            (name, _, number) = item.partition("=")
+            if not name:
+                continue
+            try:
+                number = float(number)
+            except ValueError:
+                text[name] = number
+                continue
+            cols.append(self._ratioColumn(name))
+            values.append(math.nan if number == NO_DATA else number)
+        return np.array(cols, dtype=np.int64), np.array(values), text
+
+    def fundamentalRatios(self, slot: int, value: str):
+        if self._lastRatios.get(slot) == value:
+            self.nCached += 1
+            return
+        parsed = self._parsedRatios.get(value)
+        if parsed is None:
+            if len(self._parsedRatios) >= MAX_CACHED:
+                self._parsedRatios.clear()
+            parsed = self._parsedRatios[value] = self._parseRatios(value)
+            self.nParsed += 1
+        else:
+            self.nCached += 1
+        (cols, values, text) = parsed
+        self.quoteStore.columns[FUNDAMENTALS_COLUMN][slot, cols] = values
+        self.textRatios[slot] = text
+        self._lastRatios[slot] = value
+
+    def ratio(self, key, name: str):
+        """
+        :return: one fundamental ratio of an instrument, NaN if unknown
+        """
+        slot = self.quoteStore.slotOf(key)
+        col = self.ratio2col.get(name)
+        if slot < 0 or col is None:
+            return math.nan
+        return self.quoteStore.columns[FUNDAMENTALS_COLUMN][slot, col]
+
+    def ratioColumn(self, name: str):
+        """
+        :return: view on one fundamental ratio for all allocated slots
+        """
+        return self.quoteStore.columns[FUNDAMENTALS_COLUMN][:len(self.quoteStore), self.ratio2col[name]]
+
+    def rtVolumeColumn(self, field: str):
+        """
+        :return: view on one RTVolume field (price, size, time, totalVolume, vwap, single)
+        """
+        return self.quoteStore.columns[RT_VOLUME_COLUMN][:len(self.quoteStore)][field]
@@ -0,0 +1,252 @@
+import threading
+
+import numpy as np
+
+import OptionPricing
+from GreeksStore import TICK_TO_COMPUTATION, COMPUTATION_INDEX
+
+MIN_TOTAL_VARIANCE = 1e-8
+# per-slice smile: total variance w(k) = c0 + c1 k + c2 k^2 in log-moneyness k = ln(K/F)
+N_PARAMS = 3
+
+
+class SmileSlice(object):
+    """
+    Quotes and fitted smile of one expiry
+    """
+
+    def __init__(self, expiry: str, T: float):
+        self.expiry = expiry
+        self.T = T
+        self.forward = np.nan
+        # set through updateForward rather than followed from the underlying price
+        self.explicitForward = False
+        # strike -> (implied vol, weight); the latest quote per strike wins
+        self.quotes = {}
+        self.params = np.array([np.nan, 0., 0.])
+        self.kMin = 0.
+        self.kMax = 0.
+        self.dirty = False
+
+    def fit(self):
+        """
+        Weighted least squares of total variance on (1, k, k^2); the curvature is
+        kept non-negative and the wings are flat beyond the quoted moneyness range
+        :return: False if there was nothing to fit
+        """
+        self.dirty = False
+        if not self.quotes or not np.isfinite(self.forward) or self.T <= 0:
+            return False
+        strikes = np.fromiter(self.quotes.keys(), dtype=float, count=len(self.quotes))
+        (vols, weights) = np.array(list(self.quotes.values()), dtype=float).T
+        ok = np.isfinite(vols) & (vols > 0) & (weights > 0)
+        if not ok.any():
+            return False
+        k = np.log(strikes[ok] / self.forward)
+        w = vols[ok] ** 2 * self.T
+        sw = np.sqrt(weights[ok])
+        params = np.zeros(N_PARAMS)
+        if len(k) >= N_PARAMS:
+            design = np.vstack([np.ones_like(k), k, k * k]).T
+            params = np.linalg.lstsq(design * sw[:, None], w * sw, rcond=None)[0]
+        if len(k) < N_PARAMS or params[2] < 0:
+            if len(k) >= 2:
+                design = np.vstack([np.ones_like(k), k]).T
+                params = np.zeros(N_PARAMS)
+                params[:2] = np.linalg.lstsq(design * sw[:, None], w * sw, rcond=None)[0]
+            else:
+                params = np.array([w[0], 0., 0.])
+        self.params = params
+        (self.kMin, self.kMax) = (k.min(), k.max())
+        return True
+
+    def totalVariance(self, k):
+        k = np.clip(k, self.kMin, self.kMax)
+        (c0, c1, c2) = self.params
+        return np.maximum(c0 + k * (c1 + k * c2), MIN_TOTAL_VARIANCE)
+
+
+class VolSurface(object):
+    """
+    Implied volatility surface of one underlying: one parametric smile per expiry,
+    linear in total variance across expiries at fixed log-moneyness
+    Quotes only mark their own slice dirty and refit() refits just those slices, so
+    a tick on one expiry costs one small least-squares solve, not a full rebuild.
+    """
+
+    def __init__(self, underlying, now=None):
+        self.underlying = underlying
+        self._now = now
+        self._lock = threading.Lock()
+        self.slices = {}
+        self.reqId2option = {}
+        self.nRefits = 0
+        self._sorted = []
+        self._Ts = np.zeros(0)
+
+    def _slice(self, expiry: str):
+        s = self.slices.get(expiry)
+        if s is None:
+            s = self.slices[expiry] = SmileSlice(expiry, float(OptionPricing.yearFraction([expiry], self._now)[0]))
+        return s
+
+    def updateForward(self, expiry: str, forward: float, explicit: bool = True):
+        """
+        :param explicit: False for the underlying price standing in for the forward,
+        ignored once an explicit forward has been set
+        """
+        with self._lock:
+            s = self._slice(expiry)
+            if not explicit and s.explicitForward:
+                return
+            s.explicitForward = s.explicitForward or explicit
+            if forward != s.forward:
+                s.forward = forward
+                s.dirty = True
+
+    def updateVol(self, expiry: str, strike: float, vol: float, weight: float = 1.):
+        with self._lock:
+            s = self._slice(expiry)
+            if s.quotes.get(strike) != (vol, weight):
+                s.quotes[strike] = (vol, weight)
+                s.dirty = True
+
+    def updatePrices(self, expiry: str, strikes, prices, isCall, underPrice: float,
+                     r: float, q: float = 0., futures: bool = False):
+        """
+        Inverts a batch of option prices of one expiry and stores their vols,
+        weighted by vega so that wing quotes with little information count less
+        """
+        with self._lock:
+            s = self._slice(expiry)
+        T = s.T
+        if futures:
+            forward = underPrice
+            vols = OptionPricing.impliedVolBlack76(prices, isCall, forward, strikes, T, r)
+            greeks = OptionPricing.black76(isCall, forward, strikes, T, r, vols)
+        else:
+            forward = underPrice * np.exp((r - q) * T)
+            vols = OptionPricing.impliedVolBlackScholes(prices, isCall, underPrice, strikes, T, r, q)
+            greeks = OptionPricing.blackScholes(isCall, underPrice, strikes, T, r, vols, q)
+        self.updateForward(expiry, forward)
+        with self._lock:
+            for (strike, vol, vega) in zip(np.ravel(strikes), np.ravel(vols), np.ravel(greeks["VEGA"])):
+                if np.isfinite(vol) and vega > 0:
+                    s.quotes[float(strike)] = (float(vol), float(vega))
+                    s.dirty = True
+
+    def bindReqId(self, reqId: int, expiry: str, strike: float):
+        self.reqId2option[reqId] = (expiry, float(strike))
+
+    def tickOptionComputation(self, reqId: int, tickType: int, impliedVol: float,
+                              delta: float, optPrice: float, pvDividend: float,
+                              gamma: float, vega: float, theta: float, undPrice: float):
+        """
+        Feeds the model implied vol of a bound option into its slice
+        """
+        option = self.reqId2option.get(reqId)
+        if option is None or TICK_TO_COMPUTATION.get(tickType) != COMPUTATION_INDEX["MODEL"]:
+            return
+        (expiry, strike) = option
+        if undPrice is not None and undPrice > 0:
+            # the underlying price stands in for the forward until one is provided
+            self.updateForward(expiry, undPrice, explicit=False)
+        if impliedVol is not None:
+            self.updateVol(expiry, strike, impliedVol, vega if vega else 1.)
+
+    def refit(self):
+        """
+        Refits the slices whose quotes or forward changed since the last fit
+        :return: list of expiries refit
+        """
+        with self._lock:
+            dirty = [s for s in self.slices.values() if s.dirty]
+            refit = [s.expiry for s in dirty if s.fit()]
+            if dirty:
+                self._sorted = sorted((s for s in self.slices.values()
+                                       if np.isfinite(s.params[0]) and s.T > 0), key=lambda s: s.T)
+                self._Ts = np.array([s.T for s in self._sorted])
+            self.nRefits += len(refit)
+        return refit
+
+    def _forward(self, T):
+        # log-linear interpolation of the slice forwards, flat outside
+        logF = np.log([s.forward for s in self._sorted])
+        return np.exp(np.interp(T, self._Ts, logF))
+
+    def impliedVol(self, K, T):
+        """
+        Vectorized implied vol at arbitrary (strike, time to expiry in years) points
+        Inside the quoted expiries total variance is linear in T at fixed moneyness;
+        before the first (after the last) slice its vol is held constant.
+        """
+        (K, T) = np.broadcast_arrays(np.asarray(K, float), np.asarray(T, float))
+        slices = self._sorted
+        if not slices:
+            return np.full(K.shape, np.nan)
+        Ts = self._Ts
+        k = np.log(K / self._forward(T))
+        hi = np.clip(np.searchsorted(Ts, T), 1, max(len(Ts) - 1, 1))
+        lo = hi - 1
+        if len(Ts) == 1:
+            hi = lo
+        wLo = np.empty(K.shape)
+        wHi = np.empty(K.shape)
+        for (i, s) in enumerate(slices):
+            inLo = lo == i
+            if inLo.any():
+                wLo[inLo] = s.totalVariance(k[inLo])
+            inHi = hi == i
+            if inHi.any():
+                wHi[inHi] = s.totalVariance(k[inHi])
+        (T1, T2) = (Ts[lo], Ts[hi])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            frac = np.where(T2 > T1, (T - T1) / (T2 - T1), 0.)
+            inside = (T >= Ts[0]) & (T <= Ts[-1])
+            w = np.where(inside, wLo + (wHi - wLo) * frac,
+                         np.where(T < Ts[0], wLo / T1 * T, wHi / T2 * T))
+            return np.sqrt(np.maximum(w, 0.) / T)
+
+    def save(self, path: str):
+        """
+        Persists quotes, forwards and fitted parameters for a warm restart
+        """
+        with self._lock:
+            slices = sorted(self.slices.values(), key=lambda s: s.expiry)
+            quotes = np.array([(i, strike, vol, weight) for (i, s) in enumerate(slices)
+                               for (strike, (vol, weight)) in s.quotes.items()],
+                              dtype=float).reshape(-1, 4)
+            np.savez(path,
+                     underlying=np.array(str(self.underlying)),
+                     expiries=np.array([s.expiry for s in slices], dtype=str),
+                     Ts=np.array([s.T for s in slices]),
+                     forwards=np.array([s.forward for s in slices]),
+                     params=np.array([s.params for s in slices]).reshape(-1, N_PARAMS),
+                     kRange=np.array([(s.kMin, s.kMax) for s in slices]).reshape(-1, 2),
+                     quotes=quotes)
+
+    @classmethod
+    def load(cls, path: str, now=None):
+        """
+        Rebuilds a surface from save(); it evaluates immediately with the saved fit
+        and only slices receiving new quotes get refit
+        """
+        data = np.load(path if path.endswith(".npz") else path + ".npz")
+        surface = cls(str(data["underlying"]), now)
+        slices = []
+        for (expiry, T, forward, params, kRange) in zip(data["expiries"], data["Ts"], data["forwards"],
+                                                        data["params"], data["kRange"]):
+            s = SmileSlice(str(expiry), float(OptionPricing.yearFraction([str(expiry)], now)[0]))
+            (s.forward, s.params) = (float(forward), params.copy())
+            if T > 0:
+                # time has passed since the save: keep the vols, rescale the variance
+                s.params *= s.T / T
+            (s.kMin, s.kMax) = kRange
+            surface.slices[s.expiry] = s
+            slices.append(s)
+        for (i, strike, vol, weight) in data["quotes"]:
+            slices[int(i)].quotes[float(strike)] = (float(vol), float(weight))
+        surface._sorted = sorted((s for s in slices if np.isfinite(s.params[0]) and s.T > 0),
+                                 key=lambda s: s.T)
+        surface._Ts = np.array([s.T for s in surface._sorted])
+        return surface